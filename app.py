@@ -1,4 +1,9 @@
-from dash import Dash, html, Output, Input, dash_table, dcc
+from classes.startupprofiler import StartupProfiler, load_parallel
+
+profiler = StartupProfiler()
+
+from dash import Dash, html, Output, Input, State, ctx, dash_table, dcc, no_update
+from flask import Response, abort, request
 import dash_bootstrap_components as dbc
 import dash_leaflet as dl
 import dash_leaflet.express as dlx
@@ -7,33 +12,110 @@ from dash_extensions.javascript import arrow_function, assign
 import geopandas as gpd
 import pandas as pd
 import numpy as np
-import plotly.graph_objects as go
-import plotly_express as px
+import shapely
 
+import hashlib
 import json
+import os
+import threading
+import uuid
 
+from classes import (
+    amenitypoints,
+    areainsights,
+    countstore,
+    customfilter,
+    entropysurface,
+    exportapi,
+    metrics,
+    statscache,
+    typology,
+    viewportlayer,
+    whatif,
+)
 
-# load datasets
-gemeenten = gpd.read_parquet("data/gemeenten/gemeenten_stats.parquet")
-wijken = gpd.read_parquet("data/wijken/wijken_stats_lisa.parquet")
-buurten = gpd.read_parquet("data/buurten/buurten_stats.parquet")
+profiler.mark("imports")
 
-gemeenten_counts = pd.read_parquet("data/gemeenten/gemeenten_counts.parquet")
-wijken_counts = pd.read_parquet("data/wijken/wijken_counts.parquet")
-buurten_counts = pd.read_parquet("data/buurten/buurten_counts.parquet")
 
-# simplify geometry
-gemeenten["geometry"] = (
-    gemeenten.to_crs(gemeenten.estimate_utm_crs()).simplify(100).to_crs(gemeenten.crs)
-)
-wijken["geometry"] = (
-    wijken.to_crs(wijken.estimate_utm_crs()).simplify(10).to_crs(wijken.crs)
+@metrics.timed
+def load_areas(path, tolerance):
+    """This function is used to load the stats of an area type and simplify its geometry
+
+    Args:
+        path (str): the stats parquet file
+        tolerance (float): the simplification tolerance in meters
+    """
+    areas = gpd.read_parquet(path)
+    areas["geometry"] = (
+        areas.to_crs(areas.estimate_utm_crs()).simplify(tolerance).to_crs(areas.crs)
+    )
+    return areas
+
+
+@metrics.timed
+def load_amenities():
+    # the point table is loaded (or built) once, it is shared by the map layer, the
+    # custom filter entropies and the entropy surface
+    points = amenitypoints.load_amenity_points()
+    return (
+        amenitypoints.AmenityPoints(points),
+        customfilter.CustomFilterEntropy(points),
+        entropysurface.load_surface(points),
+    )
+
+
+@metrics.timed
+def load_buurten_counts():
+    # the buurten count table has no code column, take the codes from the stats
+    codes = pd.read_parquet("data/buurten/buurten_stats.parquet", columns=["buurtcode"])
+    return countstore.load_counts("buurten", codes=codes["buurtcode"])
+
+
+# load datasets, side by side
+datasets = load_parallel(
+    {
+        "gemeenten": lambda: load_areas("data/gemeenten/gemeenten_stats.parquet", 100),
+        "wijken": lambda: load_areas("data/wijken/wijken_stats_lisa.parquet", 10),
+        "buurten": lambda: load_areas("data/buurten/buurten_stats.parquet", 5),
+        "gemeenten_counts": lambda: countstore.load_counts("gemeenten"),
+        "wijken_counts": lambda: countstore.load_counts("wijken"),
+        "buurten_counts": load_buurten_counts,
+        "amenities": load_amenities,
+    },
+    profiler=profiler,
 )
+gemeenten = datasets["gemeenten"]
+wijken = datasets["wijken"]
+buurten = datasets["buurten"]
+gemeenten_counts = datasets["gemeenten_counts"]
+wijken_counts = datasets["wijken_counts"]
+buurten_counts = datasets["buurten_counts"]
+# amenity points clustered per zoom level, the entropies under a custom filter and
+# the entropy of the amenities on a regular grid, independent of the area boundaries
+amenity_points, custom_entropy, surface = datasets["amenities"]
+# fork the workers of the spatial entropies now, not from a request thread
+custom_entropy.start()
+profiler.mark("load datasets")
 
 # convert to json
 gemeenten_json = json.loads(gemeenten.to_json())
 wijken_json = json.loads(wijken.to_json())
 
+# buurten are only served for the current viewport, see buurten_viewport
+buurten_layer = viewportlayer.ViewportLayer(
+    "buurten",
+    buurten[
+        ["gemeentenaam", "buurtnaam", "buurtcode"]
+        + list(buurten.filter(regex="^L[01]_").columns)
+        + list(buurten.filter(regex=f"^{typology.COLUMN_PREFIX}").columns)
+        + ["geometry"]
+    ],
+    min_zoom=12,
+)
+# the grid cells are smaller than buurten, only serve them further zoomed in
+surface_layer = viewportlayer.ViewportLayer("grid", surface, min_zoom=13)
+profiler.mark("build layers")
+
 
 ent_max = gemeenten["L0_shannon_1"].max()
 ent_min = gemeenten["L0_shannon_1"].min()
@@ -41,6 +123,46 @@ ent_min = gemeenten["L0_shannon_1"].min()
 stedent_max = wijken["sted/entropy"].max()
 stedent_min = wijken["sted/entropy"].min()
 
+# precompute the per-wijk aggregates of the insight panel
+wijken_insights = areainsights.build_area_table(wijken, "wijkcode")
+
+featurelist = [
+    "L0_altieri_1_T_norm",
+    "L0_altieri_1_T_Is_norm",
+    "L1_altieri_1_T_norm",
+    "L1_altieri_1_T_Is_norm",
+]
+wijken_features = wijken[featurelist].to_numpy()
+
+# typologies of wijken and buurten, written to their stats by typology.build_typology
+typology_columns = sorted(
+    set(wijken.filter(regex=f"^{typology.COLUMN_PREFIX}").columns)
+    | set(buurten.filter(regex=f"^{typology.COLUMN_PREFIX}").columns)
+)
+
+# bounds of the gemeenten, to find the visible ones for the custom filter entropies
+gemeenten_bounds = gemeenten.bounds.set_index(gemeenten["gemeentenaam"])
+# to find the wijk of a location on the map, for the what-if scenarios
+wijken_tree = shapely.STRtree(wijken.geometry.values)
+profiler.mark("precompute insights")
+
+# rendered insight panels, keyed by area code
+panel_cache = statscache.StatsCache("wijk_panels", threshold=1000)
+# plotly figures are not safe to build from several threads at once
+panel_lock = threading.Lock()
+
+# editable entropies of the amenities of a wijk, the base of its what-if scenarios
+scenario_cache = statscache.StatsCache("scenarios", threshold=100)
+# the edited entropies of every scenario and the number of its edits applied to them,
+# so a click only applies its own edit
+scenario_states = statscache.LRUCache("scenario_states", max_items=32)
+scenario_lock = threading.Lock()
+
+# amenity plots rendered on demand, as (etag, png)
+area_plot_cache = statscache.LRUBytesCache(
+    "area_plots", max_bytes=128 * 1024**2, sizeof=lambda value: len(value[1])
+)
+
 
 def get_info(feature=None, hideout=None):
     if hideout:
@@ -57,6 +179,20 @@ def get_info(feature=None, hideout=None):
     header = [html.H4(f"{ent_measure} entropy of municipalities")]
     if not feature:
         return header + [html.P("Hover over a municipality")]
+    if hideout.get("values") is not None:
+        name = feature["properties"]["gemeentenaam"]
+        value = hideout["values"].get(name)
+        if value is None:
+            value = hideout.get("note") or "not computed"
+        elif name in hideout.get("approximated", []):
+            value = f"{value:.2f} (estimated from a sample of point pairs)"
+        else:
+            value = f"{value:.2f}"
+        return header + [
+            html.B(name),
+            html.Br(),
+            f"Custom filter {ent_measure} = {value}",
+        ]
     return header + [
         html.B(feature["properties"]["gemeentenaam"]),
         html.Br(),
@@ -98,6 +234,12 @@ colorbar = dlx.categorical_colorbar(
 )
 # colorbar = dl.Colorbar(position="bottomleft", width=300, height=30, min=0, max=ent_max)
 
+# base map tiles, can be overridden (e.g. with a local url to run offline)
+tile_url = os.environ.get(
+    "URBAN_TILE_URL",
+    "https://api.maptiler.com/maps/dataviz/{z}/{x}/{y}.png?key=xpqbUuTHIbezz932Aghp",
+)
+
 # chromalib
 chroma = "https://cdnjs.cloudflare.com/ajax/libs/chroma-js/2.4.2/chroma.min.js"  # js lib used for colors
 
@@ -187,6 +329,49 @@ style_wijk_stedent = assign(
 }"""
 )
 
+style_typology = assign(
+    """function(feature, context){
+    const {style, colorProp, vmax} = context.hideout;
+    const colors = chroma.scale('Set2').colors(vmax + 1);  // one color per cluster
+    const value = feature.properties[colorProp];  // the cluster, missing if not clustered
+    style.fillColor = (value === undefined || value === null) ? 'lightgray' : colors[value];
+    style.color = 'darkgrey';
+    style.fillOpacity = 0.8;
+    style.weight = 0.3;
+    return style;
+}"""
+)
+
+style_custom = assign(
+    """function(feature, context){
+    const {style, values, approximated, vmax} = context.hideout;
+    const csc = chroma.scale('YlGn').gamma(2).domain([0, vmax]);  // chroma lib to construct colorscale
+    const value = values[feature.properties.gemeentenaam];  // computed live, may still be missing
+    style.fillColor = (value === undefined || value === null) ? 'lightgray' : csc(value);
+    style.color = 'black';
+    style.fillOpacity = 1;
+    style.weight = 0.5;
+    // estimated values get a dashed border
+    style.dashArray = (approximated || []).includes(feature.properties.gemeentenaam) ? '4' : null;
+    return style;
+}"""
+)
+
+point_to_amenity = assign(
+    """function(feature, latlng, context){
+    const {colors} = context.hideout;
+    const props = feature.properties;
+    const radius = props.cluster ? 5 + 3 * Math.log2(props.point_count) : 4;  // clusters grow with their size
+    return L.circleMarker(latlng, {
+        radius: radius,
+        color: 'black',
+        weight: 0.5,
+        fillColor: colors[props.L0_category],
+        fillOpacity: 0.8
+    });
+}"""
+)
+
 
 # Create geojson.
 geojson = dl.GeoJSON(
@@ -232,6 +417,45 @@ geojson_wijken = dl.GeoJSON(
     id="geojson_wijken",
 )
 
+# buurten, loaded per viewport
+geojson_buurten = dl.GeoJSON(
+    data=viewportlayer.EMPTY,
+    style=style_wijk_stedent,
+    hoverStyle=arrow_function(dict(weight=3, color="black", dashArray="")),
+    hideout=dict(
+        colorscale=colorscale_wijken,
+        classes=classes,
+        style=style_wijk_stedent,
+        colorProp="L0_altieri_1_T",
+        testprop="gemeentenaam",
+        municipality="",
+        vmin=0,
+        vmax=stedent_max,
+    ),
+    id="geojson_buurten",
+)
+
+# entropy surface, loaded per viewport
+geojson_grid = dl.GeoJSON(
+    data=viewportlayer.EMPTY,
+    style=style_wijk_stedent,
+    hideout=dict(
+        style=style_wijk_stedent,
+        colorProp="decay_shannon",
+        vmin=0,
+        vmax=surface["decay_shannon"].max(),
+    ),
+    id="geojson_grid",
+)
+
+# amenities, loaded per viewport
+geojson_amenities = dl.GeoJSON(
+    data=viewportlayer.EMPTY,
+    pointToLayer=point_to_amenity,
+    hideout=dict(colors=amenitypoints.CATEGORY_COLORS),
+    id="geojson_amenities",
+)
+
 # Create info control.
 info = html.Div(
     children=get_info(),
@@ -263,9 +487,7 @@ app.layout = dbc.Container(
                     id="cb",
                     position="bottomleft",
                 ),
-                dl.TileLayer(
-                    url="https://api.maptiler.com/maps/dataviz/{z}/{x}/{y}.png?key=xpqbUuTHIbezz932Aghp"
-                ),
+                dl.TileLayer(url=tile_url),
                 dl.LayersControl(
                     [
                         # dl.BaseLayer(
@@ -281,6 +503,18 @@ app.layout = dbc.Container(
                         dl.BaseLayer(
                             geojson_wijken, name="wijken", checked=False, id="wk_layer"
                         ),
+                        dl.BaseLayer(
+                            geojson_buurten, name="buurten", checked=False, id="bu_layer"
+                        ),
+                        dl.BaseLayer(
+                            geojson_grid, name="grid", checked=False, id="grid_layer"
+                        ),
+                        dl.Overlay(
+                            geojson_amenities,
+                            name="amenities",
+                            checked=False,
+                            id="am_layer",
+                        ),
                     ],
                     id="lc",
                 ),
@@ -293,6 +527,7 @@ app.layout = dbc.Container(
             ],
             center=[52.2129919, 5.2793703],
             zoom=7,
+            id="map",
             style={
                 "height": "70vh",
                 "margin": "10px 0px",
@@ -347,6 +582,61 @@ app.layout = dbc.Container(
                     inline=True,
                     style={"padding": "10px 5px 10px 5px"},
                 ),
+                dcc.Dropdown(
+                    options=typology_columns,
+                    placeholder="Color wijken and buurten by typology",
+                    id="typology_selector",
+                    style={"margin-bottom": "10px"},
+                ),
+                html.H5("Custom filter"),
+                dcc.Dropdown(
+                    options=sorted(set(l0 for l0, _ in custom_entropy.categories())),
+                    multi=True,
+                    placeholder="Exclude L0 categories",
+                    id="custom_L0",
+                ),
+                dcc.Dropdown(
+                    options=[
+                        {"label": f"{l0}: {l1}", "value": f"{l0}|{l1}"}
+                        for l0, l1 in custom_entropy.categories()
+                    ],
+                    multi=True,
+                    placeholder="Exclude L1 categories",
+                    id="custom_L1",
+                    style={"margin-top": "5px"},
+                ),
+                # repaints the map while spatial entropies are computed in the background
+                dcc.Interval(id="custom_poll", interval=500, disabled=True),
+                html.H5("What if", style={"margin-top": "10px"}),
+                dcc.RadioItems(
+                    options=[
+                        {"label": " Off", "value": "off"},
+                        {"label": " Add an amenity", "value": "add"},
+                        {"label": " Remove an amenity", "value": "remove"},
+                    ],
+                    value="off",
+                    inline=True,
+                    inputStyle={"margin-left": "10px"},
+                    id="scenario_action",
+                ),
+                dcc.Dropdown(
+                    options=[
+                        {"label": f"{l0}: {l1}", "value": f"{l0}|{l1}"}
+                        for l0, l1 in custom_entropy.categories()
+                    ],
+                    placeholder="Category of the amenity, click the map to place it",
+                    id="scenario_category",
+                    style={"margin-top": "5px"},
+                ),
+                dbc.Button(
+                    "Reset scenario",
+                    color="secondary",
+                    className="me-1",
+                    id="scenario_reset",
+                    style={"margin-top": "5px"},
+                ),
+                dcc.Store(id="scenario", data=None),
+                html.Div(id="scenario_result", style={"margin-top": "10px"}),
                 html.Div(id="wijk_insight", children="", style={"margin-top": "10px"}),
                 dbc.Offcanvas(
                     children=[],
@@ -368,12 +658,38 @@ app.layout = dbc.Container(
     Output("cb", "max"),
     Output("geojson_wijken", "hideout", allow_duplicate=True),
     Output("geojson_wijken", "style", allow_duplicate=True),
+    Output("geojson_buurten", "hideout"),
+    Output("geojson_buurten", "style"),
+    Output("custom_poll", "disabled"),
     Input("category_selector", "value"),
     Input("entropy_selector", "value"),
     Input("filter_selector", "value"),
     Input("norm_selector", "value"),
+    Input("custom_L0", "value"),
+    Input("custom_L1", "value"),
+    Input("custom_poll", "n_intervals"),
+    Input("typology_selector", "value"),
+    Input("map", "bounds"),
+    State("map", "zoom"),
 )
-def update_filter(cat_value, entropy_value, filter_value, normalize):
+def update_filter(
+    cat_value,
+    entropy_value,
+    filter_value,
+    normalize,
+    custom_L0,
+    custom_L1,
+    n_intervals,
+    typology_column,
+    bounds,
+    zoom,
+):
+    # only the spatial entropies under a custom filter depend on the viewport
+    if ctx.triggered_id == "map" and not (
+        (custom_L0 or custom_L1) and entropy_value in customfilter.SPATIAL_MEASURES
+    ):
+        return (no_update,) * 8
+
     hideout = geojson.__getattribute__("hideout")
     hideout["colorProp"] = f"L{cat_value}_{entropy_value}_{filter_value}{normalize}"
     if normalize == "_norm":
@@ -383,6 +699,30 @@ def update_filter(cat_value, entropy_value, filter_value, normalize):
         hideout["vmax"] = 10
         cbmax = 10
 
+    # a custom filter replaces the precomputed entropies of the gemeenten
+    pending = 0
+    style_gm = style_handle
+    for key in ["values", "approximated", "note"]:
+        hideout.pop(key, None)
+    if custom_L0 or custom_L1:
+        values, pending, approximated = custom_filter_values(
+            int(cat_value),
+            entropy_value,
+            custom_L0 or [],
+            custom_L1 or [],
+            bounds,
+            zoom,
+        )
+        hideout["values"] = values
+        hideout["approximated"] = approximated
+        if entropy_value in customfilter.SPATIAL_MEASURES and (
+            not bounds or zoom is None or zoom < customfilter.SPATIAL_MIN_ZOOM
+        ):
+            hideout["note"] = "zoom in to compute"
+        hideout["vmax"] = max([v for v in values.values() if v is not None], default=1)
+        cbmax = round(hideout["vmax"], 2)
+        style_gm = style_custom
+
     hideout_wk = geojson_wijken.__getattribute__("hideout")
     hideout_wk["colorProp"] = f"L{cat_value}_{entropy_value}_{filter_value}{normalize}"
     if normalize == "_norm":
@@ -390,7 +730,108 @@ def update_filter(cat_value, entropy_value, filter_value, normalize):
     else:
         hideout_wk["vmax"] = 10
 
-    return hideout, style_handle, cbmax, hideout_wk, style_wijk_stedent
+    hideout_bu = geojson_buurten.__getattribute__("hideout")
+    hideout_bu["colorProp"] = hideout_wk["colorProp"]
+    hideout_bu["vmax"] = hideout_wk["vmax"]
+
+    # a typology colors the wijken and buurten by cluster instead
+    style_wk = style_wijk_stedent
+    if typology_column:
+        hideout_wk["colorProp"] = hideout_bu["colorProp"] = typology_column
+        # the columns are named typology_<method>_<k>
+        k = int(typology_column.split("_")[-1])
+        hideout_wk["vmax"] = hideout_bu["vmax"] = k - 1
+        style_wk = style_typology
+
+    return (
+        hideout,
+        style_gm,
+        cbmax,
+        hideout_wk,
+        style_wk,
+        hideout_bu,
+        style_wk,
+        pending == 0,
+    )
+
+
+def custom_filter_values(level, measure, excluded_L0, excluded_L1, bounds, zoom=None):
+    """This function is used to get the entropy of the gemeenten under a custom filter
+
+    Shannon entropy is computed for all gemeenten at once, the spatial entropies only
+    for the visible gemeenten, from zoom level SPATIAL_MIN_ZOOM on, and in the
+    background.
+
+    Args:
+        level (int): the category level, 0 or 1
+        measure (str): "shannon", "altieri" or "leibovici"
+        excluded_L0 (list): the excluded L0 categories
+        excluded_L1 (list): the excluded L1 categories, as "<L0 category>|<L1 category>"
+        bounds (list): the map bounds, without bounds no spatial entropies are computed
+        zoom (int, optional): the map zoom level
+
+    Returns:
+        tuple: the entropies by gemeentenaam (None if not computed), the number of
+            gemeenten that are still being computed and the gemeenten whose spatial
+            entropy is estimated
+    """
+
+    L1_blacklist = {}
+    for item in excluded_L1:
+        l0, l1 = item.split("|", 1)
+        L1_blacklist.setdefault(l0, []).append(l1)
+
+    if measure == "shannon":
+        values = custom_entropy.shannon(level, excluded_L0, L1_blacklist).to_dict()
+        pending, approximated = 0, []
+    elif not bounds:
+        values, pending, approximated = {}, 0, []
+    else:
+        west, south, east, north = viewportlayer.leaflet_bounds(bounds)
+        visible = gemeenten_bounds[
+            (gemeenten_bounds["minx"] <= east)
+            & (gemeenten_bounds["maxx"] >= west)
+            & (gemeenten_bounds["miny"] <= north)
+            & (gemeenten_bounds["maxy"] >= south)
+        ]
+        values, pending, approximated = custom_entropy.spatial(
+            measure, level, excluded_L0, L1_blacklist, list(visible.index), zoom
+        )
+    values = {k: None if np.isnan(v) else float(v) for k, v in values.items()}
+    return values, pending, approximated
+
+
+@app.callback(
+    Output("geojson_buurten", "data"),
+    Input("map", "bounds"),
+    Input("map", "zoom"),
+)
+def buurten_viewport(bounds, zoom):
+    if not bounds:
+        return no_update
+    return buurten_layer.query(viewportlayer.leaflet_bounds(bounds), zoom)
+
+
+@app.callback(
+    Output("geojson_grid", "data"),
+    Input("map", "bounds"),
+    Input("map", "zoom"),
+)
+def grid_viewport(bounds, zoom):
+    if not bounds:
+        return no_update
+    return surface_layer.query(viewportlayer.leaflet_bounds(bounds), zoom)
+
+
+@app.callback(
+    Output("geojson_amenities", "data"),
+    Input("map", "bounds"),
+    Input("map", "zoom"),
+)
+def amenities_viewport(bounds, zoom):
+    if not bounds:
+        return no_update
+    return amenity_points.query(viewportlayer.leaflet_bounds(bounds), zoom)
 
 
 @app.callback(
@@ -442,144 +883,141 @@ def municipality_click(clickData):
     return hideout, style_spotlight, hideout_wk, style_spotlight_wijk
 
 
-@app.callback(
-    Output("offcanvas-placement", "is_open"),
-    Output("offcanvas-placement", "children"),
-    # Output("wijk_insight", "children"),
-    Input("geojson_wijken", "clickData"),
-)
-def wijk_click(clickData):
-    if clickData:
-        gm_naam = clickData["properties"]["gemeentenaam"]
-        wijknaam = clickData["properties"]["wijknaam"]
-        wijkcode = clickData["properties"]["wijkcode"]
-        gdf = wijken[wijken["wijkcode"] == wijkcode]
-        df_counts = wijken_counts[wijken_counts["wijkcode"] == wijkcode]
-
-        ####################################################################
-        # make horizontal bar plot of the amenities present in the wijk
-        L0_counts = df_counts.filter(regex="L0_1.*").sum()
+def build_wijk_panel(wijkcode):
+    """Build the figures and similarity table of the insight panel of a wijk"""
+    # plotly is only needed for the insight panel, keep it out of the startup
+    import plotly.graph_objects as go
+    import plotly_express as px
 
-        counts = L0_counts.reset_index()
-        counts.columns = ["category", "count"]
-        counts.category = counts.category.str.replace("L0_1_count_", "")
-        amenity_bar = px.bar(counts, x="count", y="category", orientation="h")
+    row = wijken_insights.loc[wijkcode]
 
-        ####################################################################
-        agecols = gdf.filter(regex="P_.*_JR$").columns
-        cols_gebnl = gdf.filter(regex="P_GEBNL.*").columns
-        cols_gebbl = gdf.filter(regex="P_GEBBL.*").columns
+    ####################################################################
+    # make horizontal bar plot of the amenities present in the wijk
+    counts = areainsights.amenity_counts(wijken_counts, wijkcode, level=0, filter_i=1)
+    amenity_bar = px.bar(counts, x="count", y="category", orientation="h")
 
-        aantal_inwoners = wijken["AANT_INW"]
+    ####################################################################
+    agecols = wijken_insights.attrs["agecols"]
+    cols_gebnl = wijken_insights.attrs["cols_gebnl"]
+    cols_gebbl = wijken_insights.attrs["cols_gebbl"]
 
-        gdf.loc[:, agecols] = gdf.loc[:, agecols].apply(
-            lambda x: np.ceil(aantal_inwoners * x / 100)
-        )
-        gdf.loc[:, cols_gebnl] = gdf.loc[:, cols_gebnl].apply(
-            lambda x: np.ceil(aantal_inwoners * x / 100)
+    # make relative bar plot of the amount of mannen en vrouwen
+    mv_bar = go.Figure()
+    mv_bar.add_trace(
+        go.Bar(
+            y=["Gender"],
+            x=[row["AANT_MAN"]],
+            name="Male",
+            orientation="h",
+            marker=dict(
+                color="rgba(36, 111, 219, 0.4)",
+                line=dict(color="rgba(36, 111, 219, 0.4)"),
+            ),
         )
-        gdf.loc[:, cols_gebbl] = gdf.loc[:, cols_gebbl].apply(
-            lambda x: np.ceil(aantal_inwoners * x / 100)
+    )
+    mv_bar.add_trace(
+        go.Bar(
+            y=["Gender"],
+            x=[row["AANT_VROUW"]],
+            name="Female",
+            orientation="h",
+            marker=dict(
+                color="rgba(245, 40, 145, 0.4)",
+                line=dict(color="rgba(245, 40, 145, 0.4)"),
+            ),
         )
-
-        # make relative bar plot of the amount of mannen en vrouwen
-        mv_bar = go.Figure()
+    )
+    names = ["0-14", "15-24", "25-44", "45-64", "65+"]
+    for col, name_ in zip(agecols, names):
         mv_bar.add_trace(
             go.Bar(
-                y=["Gender"],
-                x=gdf["AANT_MAN"],
-                name="Male",
+                y=["Age"],
+                x=[row[col]],
+                name=name_ + " years",
                 orientation="h",
-                marker=dict(
-                    color="rgba(36, 111, 219, 0.4)",
-                    line=dict(color="rgba(36, 111, 219, 0.4)"),
-                ),
             )
         )
+    names = [
+        "NL born, NL heritage",
+        "NL born, EU heritage",
+        "NL born, non-EU heritage",
+    ]
+    for col, name_ in zip(cols_gebnl, names):
         mv_bar.add_trace(
             go.Bar(
-                y=["Gender"],
-                x=gdf["AANT_VROUW"],
-                name="Female",
+                y=["Birth and heritage"],
+                x=[row[col]],
+                name=name_,
                 orientation="h",
-                marker=dict(
-                    color="rgba(245, 40, 145, 0.4)",
-                    line=dict(color="rgba(245, 40, 145, 0.4)"),
-                ),
             )
         )
-        names = ["0-14", "15-24", "25-44", "45-64", "65+"]
-        for col, name_ in zip(agecols, names):
-            mv_bar.add_trace(
-                go.Bar(
-                    y=["Age"],
-                    x=gdf[col],
-                    name=name_ + " years",
-                    orientation="h",
-                )
-            )
-        names = [
-            "NL born, NL heritage",
-            "NL born, EU heritage",
-            "NL born, non-EU heritage",
-        ]
-        for col, name_ in zip(cols_gebnl, names):
-            mv_bar.add_trace(
-                go.Bar(
-                    y=["Birth and heritage"],
-                    x=gdf[col],
-                    name=name_,
-                    orientation="h",
-                )
-            )
-        names = ["Foreign born, EU heritage", "Foreign born, non-EU heritage"]
-        for col, name_ in zip(cols_gebbl, names):
-            mv_bar.add_trace(
-                go.Bar(
-                    y=["Birth and heritage"],
-                    x=gdf[col],
-                    name=name_,
-                    orientation="h",
-                )
+    names = ["Foreign born, EU heritage", "Foreign born, non-EU heritage"]
+    for col, name_ in zip(cols_gebbl, names):
+        mv_bar.add_trace(
+            go.Bar(
+                y=["Birth and heritage"],
+                x=[row[col]],
+                name=name_,
+                orientation="h",
             )
-        mv_bar.update_layout(
-            barmode="relative",
-            # height=250,
-            xaxis_autorange=True,
         )
-        ####################################################################
+    mv_bar.update_layout(
+        barmode="relative",
+        # height=250,
+        xaxis_autorange=True,
+    )
+    ####################################################################
 
-        featurelist = [
-            "L0_altieri_1_T_norm",
-            "L0_altieri_1_T_Is_norm",
-            "L1_altieri_1_T_norm",
-            "L1_altieri_1_T_Is_norm",
-        ]
-        distcopy = wijken.copy()
-        sample = distcopy[distcopy["wijkcode"] == wijkcode]
+    # calculate the distance between the sample and all other wijken
+    sample = wijken_features[wijken["wijkcode"].values == wijkcode][0]
+    distance = np.linalg.norm(wijken_features - sample, axis=1)
 
-        # calculate the distance between the sample and all other wijken, don't use the index
-        distcopy["distance"] = np.linalg.norm(
-            distcopy[featurelist] - sample[featurelist].values[0], axis=1
-        )
+    # sort by distance ascending
+    nearest = np.argsort(distance, kind="stable")[:6]
+    similarities = wijken.iloc[nearest][["gemeentenaam", "wijknaam"]]
 
-        # sort by distance ascending
-        similarities = distcopy.sort_values("distance").reset_index(drop=True)
+    # leave the sample out
+    similarities = similarities[similarities["wijknaam"] != row["wijknaam"]]
+    # rename gemeentenaam, wijknaam to municipality, district
+    similarities = similarities.rename(
+        columns={"gemeentenaam": "Municipality", "wijknaam": "District"}
+    )
 
-        similarities = similarities[["gemeentenaam", "wijknaam"]].head(6)
-        # leave the sample out
-        similarities = similarities[similarities["wijknaam"] != wijknaam]
-        # rename gemeentenaam, wijknaam to municipality, district
-        similarities = similarities.rename(
-            columns={"gemeentenaam": "Municipality", "wijknaam": "District"}
-        )
+    ####################################################################
+
+    return {
+        "amenity_bar": amenity_bar.to_dict(),
+        "mv_bar": mv_bar.to_dict(),
+        "similarities": similarities.to_dict("records"),
+    }
+
+
+@app.callback(
+    Output("offcanvas-placement", "is_open"),
+    Output("offcanvas-placement", "children"),
+    # Output("wijk_insight", "children"),
+    Input("geojson_wijken", "clickData"),
+    State("scenario_action", "value"),
+)
+def wijk_click(clickData, scenario_action):
+    # while editing a scenario, clicks on the map place or remove amenities
+    if scenario_action != "off":
+        return no_update, no_update
+    if clickData:
+        gm_naam = clickData["properties"]["gemeentenaam"]
+        wijknaam = clickData["properties"]["wijknaam"]
+        wijkcode = clickData["properties"]["wijkcode"]
 
-        ####################################################################
+        def build():
+            with panel_lock:
+                return build_wijk_panel(wijkcode)
+
+        panel = panel_cache.get_or_build(wijkcode, build)
 
         return True, [
             html.H3(f"{gm_naam} - {wijknaam}"),
             html.Img(
-                src=f"/assets/amenity_plots/wijken/WK077271.png", style={"width": "80%"}
+                src=f"/area_plot/wijken/{wijkcode}.png", style={"width": "80%"}
             ),
             html.Hr(
                 style={
@@ -590,7 +1028,7 @@ def wijk_click(clickData):
                 }
             ),
             html.H4("Amenities"),
-            dcc.Graph(figure=amenity_bar),
+            dcc.Graph(figure=panel["amenity_bar"]),
             html.Hr(
                 style={
                     "borderWidth": "0.3vh",
@@ -600,7 +1038,7 @@ def wijk_click(clickData):
                 }
             ),
             html.H4("Demographics"),
-            dcc.Graph(figure=mv_bar),
+            dcc.Graph(figure=panel["mv_bar"]),
             html.Hr(
                 style={
                     "borderWidth": "0.3vh",
@@ -611,11 +1049,189 @@ def wijk_click(clickData):
             ),
             html.H4("Similar neighbourhoods"),
             # table with similar neighbourhoods
-            dash_table.DataTable(similarities.to_dict("records")),
+            dash_table.DataTable(panel["similarities"]),
         ]
 
     return ""
 
 
+def scenario_base(wijkcode):
+    """This function is used to build the editable entropies of the amenities of a wijk"""
+
+    wijk = wijken[wijken["wijkcode"] == wijkcode].iloc[0]
+    points = custom_entropy.area_points(wijk["gemeentenaam"])
+    points = points[shapely.contains_xy(wijk.geometry, points["x"], points["y"])]
+    return whatif.IncrementalEntropy(
+        points[["x", "y"]].to_numpy(), points["category"], points["subcategory"]
+    )
+
+
+def apply_edit(scenario, edit):
+    """This function is used to apply one edit of a scenario to its entropies, in place
+
+    Args:
+        scenario (IncrementalEntropy): the edited entropies of the wijk
+        edit (dict): the action ("add" or "remove"), the location (x, y) and the
+            category ("<L0 category>|<L1 category>", optional for a removal)
+    """
+
+    L0, L1 = edit["category"].split("|", 1) if edit["category"] else (None, None)
+    if edit["action"] == "add":
+        scenario.add(edit["x"], edit["y"], L0, L1)
+    else:
+        # remove the nearest amenity (of the category)
+        index = scenario.nearest(edit["x"], edit["y"], L0, L1)
+        if index is not None:
+            scenario.remove(index)
+
+
+@app.callback(
+    Output("scenario", "data"),
+    Output("scenario_result", "children"),
+    Input("map", "clickData"),
+    Input("scenario_reset", "n_clicks"),
+    State("scenario_action", "value"),
+    State("scenario_category", "value"),
+    State("scenario", "data"),
+)
+def scenario_click(clickData, n_clicks, action, category, scenario):
+    if ctx.triggered_id == "scenario_reset":
+        return None, ""
+    if action == "off" or not clickData:
+        return no_update, no_update
+    if action == "add" and not category:
+        return no_update, html.P("Choose the category of the amenity to add")
+
+    x, y = clickData["latlng"]["lng"], clickData["latlng"]["lat"]
+    hits = wijken_tree.query(shapely.Point(x, y), predicate="intersects")
+    if len(hits) == 0:
+        return no_update, html.P("Click within a wijk")
+    wijk = wijken.iloc[hits[0]]
+
+    # a click in another wijk starts a new scenario
+    if not scenario or scenario["wijkcode"] != wijk["wijkcode"]:
+        scenario = {"id": uuid.uuid4().hex, "wijkcode": wijk["wijkcode"], "edits": []}
+    scenario["edits"].append({"action": action, "x": x, "y": y, "category": category})
+
+    base = scenario_cache.get_or_build(
+        wijk["wijkcode"], lambda: scenario_base(wijk["wijkcode"])
+    )
+    with scenario_lock:
+        # the edits are only replayed when the state was evicted
+        state = scenario_states.get_or_build(
+            scenario["id"], lambda: [base.copy(), 0]
+        )
+        edited, applied = state
+        for edit in scenario["edits"][applied:]:
+            apply_edit(edited, edit)
+        state[1] = len(scenario["edits"])
+        after = edited.entropies()
+        amenities = len(edited)
+
+    before = base.entropies()
+    rows = [
+        {
+            "Entropy": name.replace("_", " "),
+            "Current": round(before[name], 3),
+            "Scenario": round(after[name], 3),
+            "Change": round(after[name] - before[name], 3),
+        }
+        for name in before
+    ]
+    return scenario, [
+        html.B(f"{wijk['gemeentenaam']} - {wijk['wijknaam']}"),
+        html.P(
+            f"{len(scenario['edits'])} edits, {len(base)} -> {amenities} amenities"
+        ),
+        dash_table.DataTable(rows),
+    ]
+
+
+def build_area_plot(level, code, size):
+    # matplotlib is only needed for the area plots, keep it out of the startup
+    from classes import areaplotter
+
+    png = areaplotter.render_area(code, level, dpi=areaplotter.RENDER_DPI[size])
+    return hashlib.sha1(png).hexdigest(), png
+
+
+@app.server.route("/area_plot/<level>/<code>.png")
+def area_plot(level, code):
+    from classes import areaplotter
+
+    size = request.args.get("size", "full")
+    if level not in areaplotter.AREA_FILES or size not in areaplotter.RENDER_DPI:
+        abort(404)
+
+    try:
+        etag, png = area_plot_cache.get_or_build(
+            f"{level}/{code}/{size}", lambda: build_area_plot(level, code, size)
+        )
+    # an unknown area code, or a gemeente without an amenity file
+    except (KeyError, FileNotFoundError):
+        abort(404)
+
+    response = Response(png, mimetype="image/png")
+    response.set_etag(etag)
+    response.cache_control.max_age = 3600
+    return response.make_conditional(request)
+
+
+@app.server.route("/export/<level>.<fmt>")
+def export(level, fmt):
+    if fmt not in exportapi.FORMATS:
+        abort(404)
+    gemeenten = [
+        name
+        for value in request.args.getlist("gemeente")
+        for name in value.split(",")
+        if name
+    ]
+    try:
+        query = exportapi.parse_query(
+            level, request.args.get("columns"), gemeenten, request.args.get("bbox")
+        )
+    except KeyError:
+        abort(404)
+    except exportapi.ExportError as e:
+        abort(400, str(e))
+
+    # the body is a generator, it is only read when the export is not cached
+    response = Response(
+        exportapi.stream_export(level, fmt, query), mimetype=exportapi.FORMATS[fmt]
+    )
+    response.set_etag(exportapi.export_etag(level, fmt, query))
+    response.cache_control.max_age = 3600
+    response.headers["Content-Disposition"] = f"attachment; filename={level}.{fmt}"
+    return response.make_conditional(request)
+
+
+@app.server.route("/cache_stats")
+def cache_stats():
+    return statscache.all_stats()
+
+
+@app.server.route("/metrics")
+def metrics_route():
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
+# record the latency and response size of all callbacks above
+metrics.instrument_callbacks(app)
+
+
+@app.server.before_request
+def first_request():
+    profiler.request_started()
+
+
+profiler.mark("build app")
+profiler.set_ready()
+profiler.report()
+for phase, seconds in profiler.phases.items():
+    metrics.startup_seconds.set(seconds, phase=phase)
+metrics.startup_seconds.set(profiler.ready, phase="ready to serve")
+
+
 if __name__ == "__main__":
     app.run_server(debug=False)
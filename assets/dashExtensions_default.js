@@ -113,6 +113,51 @@ window.dashExtensions = Object.assign({}, window.dashExtensions, {
             style.fillOpacity = 0.8;
             style.weight = 0.3;
             return style;
+        },
+        function5: function(feature, context) {
+            const {
+                style,
+                colorProp,
+                vmax
+            } = context.hideout;
+            const colors = chroma.scale('Set2').colors(vmax + 1); // one color per cluster
+            const value = feature.properties[colorProp]; // the cluster, missing if not clustered
+            style.fillColor = (value === undefined || value === null) ? 'lightgray' : colors[value];
+            style.color = 'darkgrey';
+            style.fillOpacity = 0.8;
+            style.weight = 0.3;
+            return style;
+        },
+        function6: function(feature, context) {
+            const {
+                style,
+                values,
+                approximated,
+                vmax
+            } = context.hideout;
+            const csc = chroma.scale('YlGn').gamma(2).domain([0, vmax]); // chroma lib to construct colorscale
+            const value = values[feature.properties.gemeentenaam]; // computed live, may still be missing
+            style.fillColor = (value === undefined || value === null) ? 'lightgray' : csc(value);
+            style.color = 'black';
+            style.fillOpacity = 1;
+            style.weight = 0.5;
+            // estimated values get a dashed border
+            style.dashArray = (approximated || []).includes(feature.properties.gemeentenaam) ? '4' : null;
+            return style;
+        },
+        function7: function(feature, latlng, context) {
+            const {
+                colors
+            } = context.hideout;
+            const props = feature.properties;
+            const radius = props.cluster ? 5 + 3 * Math.log2(props.point_count) : 4; // clusters grow with their size
+            return L.circleMarker(latlng, {
+                radius: radius,
+                color: 'black',
+                weight: 0.5,
+                fillColor: colors[props.L0_category],
+                fillOpacity: 0.8
+            });
         }
     }
 });
\ No newline at end of file
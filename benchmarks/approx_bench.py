@@ -0,0 +1,235 @@
+"""Benchmark of the approximate spatial entropies against the exact ones.
+
+Estimates Altieri and Leibovici entropy from samples of point pairs of several sizes
+on the amenities of municipalities, and compares the estimates, their confidence
+intervals and their speed with the exact calculation. Municipalities that are too
+large for the exact calculation only get the estimates.
+
+Run from the root of the repository:
+
+    python benchmarks/approx_bench.py
+    python benchmarks/approx_bench.py --datasets Assen --sample-sizes 10000 100000
+    python benchmarks/approx_bench.py --check
+"""
+
+import argparse
+import datetime
+import json
+import os
+import statistics
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from classes import approxentropy  # noqa: E402
+from classes.entropycalculator import altieri_entropy, leibovici_entropy  # noqa: E402
+from entropy_bench import BYTES_PER_PAIR, MUNICIPALITIES, apply_filter, load_dataset  # noqa: E402
+
+MEASURES = ["altieri", "leibovici"]
+LEVELS = ["L0", "L1"]
+SAMPLE_SIZES = [10000, 50000, 200000, 1000000]
+
+
+def _exact(measure, points, labels, distance):
+    start = time.perf_counter()
+    if measure == "altieri":
+        value = altieri_entropy(points, labels, base=2).entropy
+    else:
+        value = leibovici_entropy(points, labels, d=distance, base=2).entropy
+    return float(value), time.perf_counter() - start
+
+
+def _estimate(measure, points, labels, sample_size, distance, seed):
+    start = time.perf_counter()
+    if measure == "altieri":
+        estimate = approxentropy.approximate_altieri(
+            points, labels, sample_size=sample_size, seed=seed
+        )
+    else:
+        estimate = approxentropy.approximate_leibovici(
+            points, labels, d=distance, sample_size=sample_size, seed=seed
+        )
+    return estimate, time.perf_counter() - start
+
+
+def run_case(measure, points, labels, sample_size, distance, repeat, exact):
+    """This function is used to estimate one entropy repeat times with different seeds
+
+    Returns:
+        dict: the median time, the mean estimate and interval width and, if the exact
+            value is known, the mean and largest error and the share of intervals that
+            contain the exact value
+    """
+
+    seconds, values, widths, covered = [], [], [], 0
+    for seed in range(repeat):
+        estimate, elapsed = _estimate(measure, points, labels, sample_size, distance, seed)
+        seconds.append(elapsed)
+        values.append(estimate.entropy)
+        widths.append(estimate.high - estimate.low)
+        if exact is not None:
+            covered += estimate.low - 1e-9 <= exact <= estimate.high + 1e-9
+
+    result = {
+        "sample_size": sample_size,
+        "pairs": estimate.pairs,
+        "seconds_median": statistics.median(seconds),
+        "value_mean": statistics.mean(values),
+        "ci_width_mean": statistics.mean(widths),
+    }
+    if exact is not None:
+        errors = np.abs(np.asarray(values) - exact)
+        result.update(
+            error_mean=float(errors.mean()),
+            error_max=float(errors.max()),
+            coverage=covered / repeat,
+        )
+    return result
+
+
+def run(datasets, measures, levels, filter_i, sample_sizes, distance, repeat, max_memory_gb):
+    results = {}
+    for dataset in datasets:
+        amenities = apply_filter(load_dataset(dataset), filter_i)
+        points = amenities[["x", "y"]].values.tolist()
+        n = len(points)
+        if n < 2:
+            continue
+        for measure in measures:
+            for level in levels:
+                key = f"{dataset}/{measure}/{level}/filter{filter_i}"
+                labels = amenities[f"{level}_category"].values
+
+                exact, exact_seconds = None, None
+                if BYTES_PER_PAIR[measure] * n**2 / 1024**3 <= max_memory_gb:
+                    exact, exact_seconds = _exact(measure, points, labels, distance)
+
+                cases = [
+                    run_case(measure, points, labels, size, distance, repeat, exact)
+                    for size in sample_sizes
+                ]
+                results[key] = {
+                    "points": n,
+                    "exact": exact,
+                    "exact_seconds": exact_seconds,
+                    "estimates": cases,
+                }
+                _print_result(key, results[key])
+    return results
+
+
+def check():
+    """This function is used to check the estimators on small cases with a known answer
+
+    Returns:
+        list: a description of every failed check
+    """
+
+    failures = []
+    rng = np.random.default_rng(0)
+
+    # many small categories: every stratum is counted exactly although the sample
+    # size is below the number of pairs, the sampling has to stop by itself
+    points = rng.random((200, 2))
+    labels = np.repeat(np.arange(20), 10)
+    estimate = approxentropy.approximate_altieri(points, labels, sample_size=1000)
+    exact = altieri_entropy(points, labels, base=2).entropy
+    if not estimate.exact or not np.isclose(estimate.entropy, exact):
+        failures.append(f"small strata: {estimate} against exact {exact:.4f}")
+
+    # counting all pairs has to give leibovici_entropy, which counts every point as
+    # its own neighbour, also with categories of a single point
+    points = rng.random((300, 2))
+    labels = np.concatenate([rng.integers(8, size=297), [8, 9, 10]])
+    for distance in [0.05, 0.2]:
+        estimate = approxentropy.approximate_leibovici(
+            points, labels, d=distance, sample_size=10**6
+        )
+        exact = leibovici_entropy(points.tolist(), labels, d=distance, base=2).entropy
+        if not estimate.exact or not np.isclose(estimate.entropy, exact):
+            failures.append(f"leibovici d={distance}: {estimate} against exact {exact:.4f}")
+    return failures
+
+
+def _print_result(key, result):
+    exact = result["exact"]
+    if exact is None:
+        print(f"{key} ({result['points']} points), exact skipped")
+    else:
+        print(
+            f"{key} ({result['points']} points), exact {exact:.4f} "
+            f"in {result['exact_seconds'] * 1000:.1f}ms"
+        )
+    for case in result["estimates"]:
+        line = (
+            f"  {case['sample_size']:>9} {case['seconds_median'] * 1000:>9.1f}ms "
+            f"{case['value_mean']:>8.4f} +-{case['ci_width_mean'] / 2:.4f}"
+        )
+        if exact is not None:
+            line += (
+                f"  error {case['error_mean']:.4f} (max {case['error_max']:.4f})"
+                f"  coverage {case['coverage']:.0%}"
+            )
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--datasets", nargs="+", default=MUNICIPALITIES)
+    parser.add_argument("--measures", nargs="+", default=MEASURES, choices=MEASURES)
+    parser.add_argument("--levels", nargs="+", default=LEVELS, choices=LEVELS)
+    parser.add_argument("--filter", type=int, default=1, choices=[0, 1, 2])
+    parser.add_argument("--sample-sizes", nargs="+", type=int, default=SAMPLE_SIZES)
+    parser.add_argument(
+        "--distance",
+        type=float,
+        default=approxentropy.LEIBOVICI_DISTANCE,
+        help="cut-off distance of the leibovici entropy, in degrees",
+    )
+    parser.add_argument("--repeat", type=int, default=5, help="estimates per case")
+    parser.add_argument(
+        "--max-memory-gb",
+        type=float,
+        default=4,
+        help="skip exact cases that would need more memory than this",
+    )
+    parser.add_argument("--output", default=None, help="json file to store the results in")
+    parser.add_argument(
+        "--check", action="store_true", help="only check the estimators on small cases"
+    )
+    args = parser.parse_args()
+
+    if args.check:
+        failures = check()
+        for failure in failures:
+            print(f"FAILED {failure}")
+        print("checks passed" if not failures else f"{len(failures)} checks failed")
+        sys.exit(1 if failures else 0)
+
+    timestamp = datetime.datetime.now().isoformat(timespec="seconds")
+    print(f"{'sample size':>11} {'median':>11} {'estimate':>8} +-half CI")
+    results = run(
+        args.datasets,
+        args.measures,
+        args.levels,
+        args.filter,
+        args.sample_sizes,
+        args.distance,
+        args.repeat,
+        args.max_memory_gb,
+    )
+
+    output = args.output or os.path.join(
+        "benchmarks", "results", f"approx_{timestamp.replace(':', '')}.json"
+    )
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump({"timestamp": timestamp, "results": results}, f, indent=2)
+    print(f"\nResults written to {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,14 @@
+"""Helpers shared by the benchmark scripts."""
+
+import subprocess
+
+
+def git_commit():
+    """This function is used to get the short hash of the checked out commit, None outside a git repository"""
+
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], text=True, stderr=subprocess.DEVNULL
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
@@ -0,0 +1,198 @@
+"""Load test of the dashboard callbacks.
+
+Drives the real callbacks of app.py through Flask's test client with the payloads
+the Dash renderer sends, at a configurable concurrency, and reports the latency
+percentiles, response sizes and throughput per callback.
+
+Run from the root of the repository:
+
+    python benchmarks/callback_load.py --concurrency 8 --requests 200
+    python benchmarks/callback_load.py --compare benchmarks/results/old.json
+"""
+
+import argparse
+import datetime
+import json
+import os
+import random
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+# the tiles are only requested by browsers, but make sure nothing points outside
+os.environ.setdefault("URBAN_TILE_URL", "")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dash._utils import split_callback_id  # noqa: E402
+
+import app as dashboard  # noqa: E402
+from benchutils import git_commit  # noqa: E402
+from classes import statscache  # noqa: E402
+
+CALLBACKS = [
+    "update_filter",
+    "info_hover",
+    "municipality_click",
+    "wijk_click",
+    "scenario_click",
+]
+
+
+def _callback_output(name):
+    for output, spec in dashboard.app.callback_map.items():
+        if spec["callback"].__name__ == name:
+            return output, spec
+    raise KeyError(name)
+
+
+def _payload(name, rng):
+    """Build the body of a /_dash-update-component request for a callback"""
+
+    output, spec = _callback_output(name)
+    gemeente = rng.choice(dashboard.gemeenten_json["features"])
+    wijk = rng.choice(dashboard.wijken_json["features"])
+    # a location within a wijk, for the what-if scenarios
+    point = dashboard.wijken.geometry.iloc[rng.randrange(len(dashboard.wijken))]
+    point = point.representative_point()
+
+    values = {
+        "update_filter": {
+            "category_selector.value": rng.choice(["0", "1"]),
+            "entropy_selector.value": rng.choice(["shannon", "altieri", "leibovici"]),
+            "filter_selector.value": rng.choice(["0", "1", "2"]),
+            "norm_selector.value": rng.choice(["_T", "_norm"]),
+            "custom_L0.value": [],
+            "custom_L1.value": [],
+            "typology_selector.value": rng.choice([None] + dashboard.typology_columns),
+        },
+        "info_hover": {
+            "geojson.hoverData": gemeente,
+            "geojson_wijken.hoverData": rng.choice([None, wijk]),
+        },
+        "municipality_click": {"geojson.clickData": gemeente},
+        "wijk_click": {
+            "geojson_wijken.clickData": wijk,
+            "scenario_action.value": "off",
+        },
+        "scenario_click": {
+            "map.clickData": {"latlng": {"lat": point.y, "lng": point.x}},
+            "scenario_action.value": rng.choice(["add", "remove"]),
+            "scenario_category.value": "|".join(
+                rng.choice(dashboard.custom_entropy.categories())
+            ),
+        },
+    }[name]
+
+    def with_value(item):
+        return dict(item, value=values.get(f"{item['id']}.{item['property']}"))
+
+    return {
+        "output": output,
+        "outputs": split_callback_id(output),
+        "inputs": [with_value(item) for item in spec["inputs"]],
+        "changedPropIds": [list(values)[0]],
+        "state": [with_value(item) for item in spec["state"]],
+    }
+
+
+def _request(payload):
+    client = dashboard.app.server.test_client()
+    start = time.perf_counter()
+    response = client.post("/_dash-update-component", json=payload)
+    latency = time.perf_counter() - start
+    return latency, len(response.data), response.status_code
+
+
+def run_callback(name, n_requests, concurrency, seed=0):
+    """This function is used to fire n_requests at one callback and summarise the results"""
+
+    rng = random.Random(seed)
+    payloads = [_payload(name, rng) for _ in range(n_requests)]
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(_request, payloads))
+    seconds = time.perf_counter() - start
+
+    latency = np.array([r[0] for r in results]) * 1000
+    size = np.array([r[1] for r in results])
+    errors = sum(r[2] not in (200, 204) for r in results)
+    return {
+        "requests": n_requests,
+        "errors": errors,
+        "p50_ms": float(np.percentile(latency, 50)),
+        "p95_ms": float(np.percentile(latency, 95)),
+        "p99_ms": float(np.percentile(latency, 99)),
+        "mean_ms": float(latency.mean()),
+        "mean_bytes": float(size.mean()),
+        "max_bytes": int(size.max()),
+        "throughput_rps": n_requests / seconds,
+    }
+
+
+def compare(current, previous):
+    """This function is used to print the change of the latencies and throughput against an earlier run"""
+
+    print(f"\nCompared to {previous['commit']} ({previous['timestamp']}):")
+    for name, result in current["callbacks"].items():
+        old = previous["callbacks"].get(name)
+        if old is None:
+            continue
+        changes = ", ".join(
+            f"{key} {100 * (result[key] / old[key] - 1):+.1f}%"
+            for key in ["p50_ms", "p95_ms", "p99_ms", "throughput_rps"]
+            if old[key]
+        )
+        print(f"  {name:<20} {changes}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--callbacks", nargs="+", default=CALLBACKS, choices=CALLBACKS)
+    parser.add_argument("--requests", type=int, default=200, help="requests per callback")
+    parser.add_argument("--concurrency", type=int, default=4, help="simultaneous users")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--clear-caches", action="store_true", help="start every callback cold")
+    parser.add_argument("--output", default=None, help="json file to store the results in")
+    parser.add_argument("--compare", default=None, help="json file of an earlier run")
+    args = parser.parse_args()
+
+    run = {
+        "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+        "commit": git_commit(),
+        "concurrency": args.concurrency,
+        "callbacks": {},
+    }
+
+    print(f"{'callback':<20} {'p50':>8} {'p95':>8} {'p99':>8} {'bytes':>10} {'req/s':>8}")
+    for name in args.callbacks:
+        if args.clear_caches:
+            for cache in statscache.CACHES.values():
+                cache.clear()
+        result = run_callback(name, args.requests, args.concurrency, seed=args.seed)
+        run["callbacks"][name] = result
+        print(
+            f"{name:<20} {result['p50_ms']:>8.1f} {result['p95_ms']:>8.1f} "
+            f"{result['p99_ms']:>8.1f} {result['mean_bytes']:>10.0f} "
+            f"{result['throughput_rps']:>8.1f}"
+            + (f"  ({result['errors']} errors)" if result["errors"] else "")
+        )
+
+    output = args.output or os.path.join(
+        "benchmarks", "results", f"callbacks_{run['timestamp'].replace(':', '')}.json"
+    )
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(run, f, indent=2)
+    print(f"\nResults written to {output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(run, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,409 @@
+"""Benchmark of the entropy calculations.
+
+Times Shannon, Altieri and Leibovici entropy at level L0 and L1 under filters 0, 1
+and 2 through calculate_entropies (the stored amenities of a small, a medium and the
+largest municipality) and on the frame of an area pipeline, as the frame the OSM API
+would give (the municipalities and synthetic point sets of 1k to 200k points), and
+the six entropies of the dashboard together through _entropies_fromapi. The peak
+memory is recorded too, spatial cases that would not fit in memory are skipped. A
+run can be stored as baseline, later runs are compared with it and regressions are
+flagged.
+
+Run from the root of the repository:
+
+    python benchmarks/entropy_bench.py --save-baseline
+    python benchmarks/entropy_bench.py --datasets Assen synthetic-10000
+    python benchmarks/entropy_bench.py --datasets Amsterdam --sample-size 200000
+"""
+
+import argparse
+import datetime
+import json
+import os
+import statistics
+import sys
+import time
+import tracemalloc
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchutils import git_commit  # noqa: E402
+from classes import entropycalculator  # noqa: E402
+
+MUNICIPALITIES = ["Noord-Beveland", "Assen", "Amsterdam"]
+SYNTHETIC_SIZES = [1000, 10000, 50000, 200000]
+DATASETS = MUNICIPALITIES + [f"synthetic-{n}" for n in SYNTHETIC_SIZES]
+MEASURES = ["shannon", "altieri", "leibovici"]
+LEVELS = ["L0", "L1"]
+FILTERS = [0, 1, 2]
+# calculate_entropies reads the stored amenities of a municipality, _entropies_fromapi
+# gets the frame of the area pipeline
+PATHS = ["calculate_entropies", "fromapi"]
+GEMEENTEN = "data/gemeenten/gemeenten_stats.parquet"
+
+BASELINE = os.path.join("benchmarks", "results", "entropy_baseline.json")
+
+# rough memory use per pair of points: altieri keeps a dense distance matrix and
+# several int64 masks of it, leibovici builds python lists of all neighbouring pairs
+BYTES_PER_PAIR = {"shannon": 0, "altieri": 32, "leibovici": 160}
+
+# synthetic points are spread over a box of about 7 by 11 km around Utrecht
+SYNTHETIC_BOUNDS = (5.05, 52.05, 5.15, 52.15)
+
+
+def _municipality(gm_name):
+    amenities = pd.read_parquet(
+        f"data/gm_amenities/amenities_{gm_name}.parquet",
+        columns=["geometry", "L0_category", "L1_category"],
+    )
+    coords = shapely.get_coordinates(shapely.from_wkb(amenities["geometry"].values))
+    return pd.DataFrame(
+        {
+            "x": coords[:, 0],
+            "y": coords[:, 1],
+            "L0_category": amenities["L0_category"].values,
+            "L1_category": amenities["L1_category"].values,
+        }
+    )
+
+
+def _synthetic(n, seed=0):
+    # categories are drawn from the categorisation, so the filters still apply
+    rng = np.random.default_rng(seed)
+    categories = (
+        entropycalculator.CATEGORISATION[["L0 category", "L1 category"]]
+        .dropna()
+        .drop_duplicates()
+    )
+    picked = categories.iloc[rng.integers(len(categories), size=n)]
+    minx, miny, maxx, maxy = SYNTHETIC_BOUNDS
+    return pd.DataFrame(
+        {
+            "x": rng.uniform(minx, maxx, n),
+            "y": rng.uniform(miny, maxy, n),
+            "L0_category": picked["L0 category"].values,
+            "L1_category": picked["L1 category"].values,
+        }
+    )
+
+
+def load_dataset(name):
+    if name.startswith("synthetic-"):
+        return _synthetic(int(name.split("-")[1]))
+    return _municipality(name)
+
+
+def apply_filter(amenities, filter_i):
+    """This function is used to apply a filter of getfilter, the same way calculate_entropies does"""
+
+    L0_BLACKLIST, L1_BLACKLIST = entropycalculator.getfilter(filter_i)
+    amenities = amenities[~amenities.L0_category.isin(L0_BLACKLIST)]
+    for key, value in L1_BLACKLIST.items():
+        amenities = amenities[
+            ~((amenities.L0_category == key) & (amenities.L1_category.isin(value)))
+        ]
+    return amenities
+
+
+def load_area(name):
+    """This function is used to get the area of a dataset: the municipality, or the box of the synthetic points"""
+
+    if name.startswith("synthetic-"):
+        return shapely.box(*SYNTHETIC_BOUNDS)
+    gemeenten = gpd.read_parquet(GEMEENTEN, columns=["gemeentenaam", "geometry"])
+    return gemeenten.loc[gemeenten["gemeentenaam"] == name, "geometry"].iloc[0]
+
+
+def cached_pipeline(name, amenities, area):
+    """This function is used to get an area pipeline with the amenities as its categorised stage
+
+    _entropies_fromapi then runs its filter and entropies on them without a request
+    to the OSM API.
+    """
+
+    pipeline = entropycalculator.AreaPipeline(area, name)
+    pipeline.stages["categorised"] = gpd.GeoDataFrame(
+        amenities[["L0_category", "L1_category"]].reset_index(drop=True),
+        geometry=gpd.points_from_xy(amenities["x"], amenities["y"]),
+        crs="EPSG:4326",
+    )
+    return pipeline
+
+
+def run_case(calculate, repeat, memory=True):
+    """This function is used to time one entropy calculation and measure its peak memory
+
+    Args:
+        calculate (callable): function without arguments that returns the entropy, or a list of entropies
+        repeat (int): the number of timed runs
+        memory (bool): measure the peak memory in a separate run
+
+    Returns:
+        dict: the best and median time, the peak traced memory and the entropy
+    """
+
+    seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        value = calculate()
+        seconds.append(time.perf_counter() - start)
+
+    peak = None
+    if memory:
+        # a separate run, tracemalloc slows the python parts down
+        tracemalloc.start()
+        calculate()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    return {
+        "seconds_min": min(seconds),
+        "seconds_median": statistics.median(seconds),
+        "peak_bytes": peak,
+        "value": np.asarray(value, dtype=np.float64).tolist(),
+    }
+
+
+def _run_or_skip(key, n, needed_gb, max_memory_gb, calculate, repeat, memory):
+    if n < 2:
+        result = {"skipped": "fewer than two points"}
+    elif needed_gb > max_memory_gb:
+        result = {"skipped": f"needs about {needed_gb:.0f} GB"}
+    else:
+        result = run_case(calculate, repeat, memory)
+    result["points"] = n
+    _print_result(key, result)
+    return result
+
+
+def frame_entropy(pipeline, measure, level, filter_i, sample_size=None):
+    """This function is used to calculate one entropy on the filtered frame of an area pipeline, the way _entropies_fromapi does"""
+
+    gdf = pipeline.filtered(*entropycalculator.getfilter(filter_i))
+    if gdf.empty:
+        return 0
+    labels = gdf[f"{level}_category"].values
+    if measure == "shannon":
+        return entropycalculator._get_shannon_entropy(labels, base=2)
+
+    points = entropycalculator._points_to_2darray(gdf)
+    if sample_size is not None:
+        estimate = {
+            "altieri": entropycalculator.approxentropy.approximate_altieri,
+            "leibovici": entropycalculator.approxentropy.approximate_leibovici,
+        }[measure]
+        return estimate(points, labels, sample_size=sample_size, base=2).entropy
+    calculate = {
+        "altieri": entropycalculator.altieri_entropy,
+        "leibovici": entropycalculator.leibovici_entropy,
+    }[measure]
+    return calculate(points, labels, base=2).entropy
+
+
+def run(
+    datasets,
+    measures,
+    levels,
+    filters,
+    repeat,
+    max_memory_gb,
+    memory=True,
+    paths=PATHS,
+    sample_size=None,
+):
+    results = {}
+    for dataset in datasets:
+        amenities = load_dataset(dataset)
+        area = load_area(dataset)
+        synthetic = dataset.startswith("synthetic-")
+        pipeline = cached_pipeline(dataset, amenities, area)
+
+        for filter_i in filters:
+            n = len(apply_filter(amenities, filter_i))
+            for measure in measures:
+                for level in levels:
+                    case = f"{measure}/{level}/filter{filter_i}"
+                    needed_gb = BYTES_PER_PAIR[measure] * n**2 / 1024**3
+                    if sample_size is not None and measure != "shannon":
+                        case += f"/sample{sample_size}"
+                        needed_gb = 0
+
+                    # the stored amenities of a municipality, read, clipped and
+                    # filtered by calculate_entropies itself
+                    if "calculate_entropies" in paths and not synthetic:
+
+                        def calculate(measure=measure, level=level, filter_i=filter_i):
+                            return entropycalculator.calculate_entropies(
+                                area,
+                                dataset,
+                                [f"{level}_{measure}"],
+                                filter_i,
+                                sample_size=sample_size,
+                            )[0]
+
+                        key = f"{dataset}/{case}"
+                        results[key] = _run_or_skip(
+                            key, n, needed_gb, max_memory_gb, calculate, repeat, memory
+                        )
+
+                    # the frame of the area pipeline, also for the synthetic sets
+                    if "fromapi" in paths:
+
+                        def calculate(measure=measure, level=level, filter_i=filter_i):
+                            return frame_entropy(
+                                pipeline, measure, level, filter_i, sample_size
+                            )
+
+                        key = f"{dataset}/fromapi/{case}"
+                        results[key] = _run_or_skip(
+                            key, n, needed_gb, max_memory_gb, calculate, repeat, memory
+                        )
+
+        # the six entropies of the dashboard together, under its own filter
+        if "fromapi" in paths:
+            n = len(pipeline.filtered())
+            needed_gb = sum(BYTES_PER_PAIR.values()) * n**2 / 1024**3
+            key = f"{dataset}/fromapi"
+            results[key] = _run_or_skip(
+                key,
+                n,
+                needed_gb,
+                max_memory_gb,
+                lambda: entropycalculator._entropies_fromapi(pipeline, dataset),
+                repeat,
+                memory,
+            )
+    return results
+
+
+def _print_result(key, result):
+    if "skipped" in result:
+        print(f"{key:<50} {result['points']:>7} skipped, {result['skipped']}")
+        return
+    peak = result["peak_bytes"]
+    peak = f"{peak / 1024**2:>9.1f}MB" if peak is not None else f"{'-':>11}"
+    print(
+        f"{key:<50} {result['points']:>7} {result['seconds_min'] * 1000:>10.1f}ms "
+        f"{result['seconds_median'] * 1000:>10.1f}ms {peak}"
+    )
+
+
+def find_regressions(results, baseline, tolerance, min_seconds=0.005):
+    """This function is used to compare the results with a baseline
+
+    A case regresses when it got more than tolerance slower (and at least min_seconds,
+    so noise on tiny cases is ignored), used more than tolerance more memory, or gave
+    a different entropy.
+
+    Returns:
+        list: a description of every regression
+    """
+
+    regressions = []
+    for key, result in results.items():
+        old = baseline["results"].get(key)
+        if old is None or "skipped" in result or "skipped" in old:
+            continue
+        if (
+            result["seconds_min"] > old["seconds_min"] * (1 + tolerance)
+            and result["seconds_min"] - old["seconds_min"] > min_seconds
+        ):
+            regressions.append(
+                f"{key}: {old['seconds_min'] * 1000:.1f}ms -> {result['seconds_min'] * 1000:.1f}ms"
+            )
+        if (
+            result["peak_bytes"] is not None
+            and old["peak_bytes"] is not None
+            and result["peak_bytes"] > old["peak_bytes"] * (1 + tolerance)
+        ):
+            regressions.append(
+                f"{key}: peak memory {old['peak_bytes'] / 1024**2:.1f}MB -> "
+                f"{result['peak_bytes'] / 1024**2:.1f}MB"
+            )
+        old_value, value = np.asarray(old["value"]), np.asarray(result["value"])
+        if old_value.shape != value.shape or not np.allclose(
+            value, old_value, rtol=1e-9, atol=1e-12
+        ):
+            regressions.append(
+                f"{key}: entropy changed {np.round(old_value, 6)} -> {np.round(value, 6)}"
+            )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--datasets", nargs="+", default=DATASETS)
+    parser.add_argument("--measures", nargs="+", default=MEASURES, choices=MEASURES)
+    parser.add_argument("--levels", nargs="+", default=LEVELS, choices=LEVELS)
+    parser.add_argument("--filters", nargs="+", type=int, default=FILTERS, choices=FILTERS)
+    parser.add_argument("--paths", nargs="+", default=PATHS, choices=PATHS)
+    parser.add_argument(
+        "--sample-size",
+        type=int,
+        default=None,
+        help="estimate the spatial entropies from this many pairs",
+    )
+    parser.add_argument("--repeat", type=int, default=3, help="timed runs per case")
+    parser.add_argument(
+        "--max-memory-gb",
+        type=float,
+        default=4,
+        help="skip spatial cases that would need more memory than this",
+    )
+    parser.add_argument("--no-memory", action="store_true", help="skip the peak memory runs")
+    parser.add_argument("--output", default=None, help="json file to store the results in")
+    parser.add_argument("--baseline", default=BASELINE, help="json file of the baseline")
+    parser.add_argument("--save-baseline", action="store_true", help="store this run as baseline")
+    parser.add_argument(
+        "--tolerance", type=float, default=0.2, help="allowed relative slowdown, 0.2 is 20%%"
+    )
+    args = parser.parse_args()
+
+    print(f"{'case':<50} {'points':>7} {'min':>12} {'median':>12} {'peak':>11}")
+    current = {
+        "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+        "commit": git_commit(),
+        "results": run(
+            args.datasets,
+            args.measures,
+            args.levels,
+            args.filters,
+            args.repeat,
+            args.max_memory_gb,
+            memory=not args.no_memory,
+            paths=args.paths,
+            sample_size=args.sample_size,
+        ),
+    }
+
+    output = args.baseline if args.save_baseline else args.output
+    output = output or os.path.join(
+        "benchmarks", "results", f"entropy_{current['timestamp'].replace(':', '')}.json"
+    )
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(current, f, indent=2)
+    print(f"\nResults written to {output}")
+
+    if args.save_baseline or not os.path.exists(args.baseline):
+        return
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    regressions = find_regressions(current["results"], baseline, args.tolerance)
+    print(f"\nCompared to the baseline of {baseline['commit']} ({baseline['timestamp']}):")
+    if not regressions:
+        print("  no regressions")
+        return
+    for regression in regressions:
+        print(f"  REGRESSION {regression}")
+    sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
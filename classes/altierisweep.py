@@ -0,0 +1,201 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import shapely
+
+from .entropycalculator import getfilter
+
+# ------- CONSTANTS -------#
+
+# the number of point pairs whose distances are computed at once
+CHUNK_PAIRS = 4 * 1024**2
+
+
+class PairDistances:
+    """The distances of all point pairs of an area, sorted once per category pair
+
+    The pairs are grouped by their unordered category pair and sorted by distance
+    within a group, so the number of pairs of every category pair up to any distance
+    is a binary search. Every break scheme of the Altieri entropy is then a few lookups
+    instead of a new pass over all pairs.
+    """
+
+    def __init__(self, points, types):
+        """
+        Args:
+            points (array): the [x, y] of every point
+            types (array): the category of every point
+        """
+
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        assert len(points) == len(types), "Points and types must have the same length"
+        self.categories, codes = np.unique(np.asarray(types), return_inverse=True)
+        m = len(self.categories)
+        n = len(points)
+        self.diagonal = (
+            np.hypot(*(points.max(axis=0) - points.min(axis=0))) if n else 0.0
+        )
+
+        # every unordered pair once, the lower category first; a stable sort of small
+        # integers is a radix sort, so the category pairs are grouped in linear time
+        dtype = np.uint16 if m * m <= 2**16 else np.int64
+        distances, strata = [], []
+        chunk = max(1, CHUNK_PAIRS // max(n, 1))
+        for start in range(0, n, chunk):
+            r, c = np.triu_indices(min(chunk, n - start), k=1, m=n - start)
+            i, j = start + r, start + c
+            distances.append(np.hypot(*(points[i] - points[j]).T))
+            a, b = codes[i], codes[j]
+            strata.append((np.minimum(a, b) * m + np.maximum(a, b)).astype(dtype))
+        distance = np.concatenate(distances) if distances else np.zeros(0)
+        stratum = np.concatenate(strata) if strata else np.zeros(0, dtype=dtype)
+
+        order = np.argsort(stratum, kind="stable")
+        self.distance = distance[order]
+        self.offsets = np.searchsorted(stratum[order], np.arange(m * m + 1))
+        # then every category pair is sorted on its own, much faster than one lexsort
+        for lo, hi in zip(self.offsets[:-1], self.offsets[1:]):
+            self.distance[lo:hi].sort()
+        a, b = np.divmod(np.arange(m * m), m)
+        self.same = a == b
+
+    def counts(self, distances):
+        """This function is used to count the pairs of every category pair up to the given distances
+
+        Returns:
+            array: category pairs x distances, the number of pairs at most that far apart
+        """
+
+        distances = np.asarray(distances, dtype=np.float64)
+        counts = np.zeros((len(self.same), len(distances)), dtype=np.int64)
+        for s in np.flatnonzero(np.diff(self.offsets)):
+            lo, hi = self.offsets[s], self.offsets[s + 1]
+            counts[s] = np.searchsorted(self.distance[lo:hi], distances, side="right")
+        return counts
+
+    def breaks(self, scheme):
+        """This function is used to get the breaks of a scheme, like the cut of altieri_entropy
+
+        Args:
+            scheme (int or list): the number of cuts between 0 and the diagonal of the
+                bounding box, or the breaks themselves
+        """
+
+        if isinstance(scheme, (int, np.integer)):
+            return np.linspace(0, self.diagonal, scheme + 2)
+        breaks = np.asarray(scheme, dtype=np.float64)
+        assert len(breaks) >= 2, "A scheme needs at least two breaks"
+        assert (breaks[0] >= 0) and (np.diff(breaks) > 0).all(), (
+            "Breaks must be increasing and not negative"
+        )
+        return breaks
+
+
+def _plogp(values, weights):
+    # probabilities of counts along the last axis and -sum(p log p), every count
+    # standing for weights entries of the distribution
+    total = (values * weights).sum(axis=-1, keepdims=True)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        probs = np.where(total > 0, values / total, 0.0)
+        terms = np.where(probs > 0, probs * np.log(probs), 0.0)
+    return probs, -(terms * weights).sum(axis=-1)
+
+
+def altieri_sweep(points, types, schemes, base=2):
+    """This function is used to compute the Altieri entropy of one set of points for many break schemes
+
+    The pair distances are computed and sorted once. The entropies are the same as
+    those of spatialentropy.altieri_entropy with the scheme as cut and order=True:
+    the intervals (b_i, b_i+1] are weighted by their width and pairs at distance 0
+    are left out.
+
+    Args:
+        points (array): the [x, y] of every point
+        types (array): the category of every point
+        schemes (dict): the break schemes by name, see PairDistances.breaks
+        base (float): the base of the logarithm
+
+    Returns:
+        dict: the entropy of every scheme
+    """
+
+    pairs = PairDistances(points, types)
+    breaks = {name: pairs.breaks(scheme) for name, scheme in schemes.items()}
+    lookup = np.unique(np.concatenate([[0.0]] + list(breaks.values())))
+    cumulative = pairs.counts(lookup).T
+
+    # altieri counts ordered category pairs: (a, b) and (b, a) for two categories,
+    # (a, a) twice
+    values = np.where(pairs.same, 2, 1)
+    weights = np.where(pairs.same, 1, 2)
+    total = np.diff(pairs.offsets)
+    pz, _ = _plogp((total - cumulative[0]) * values, weights)
+
+    entropies = {}
+    for name, cuts in breaks.items():
+        counts = np.diff(cumulative[np.searchsorted(lookup, cuts)], axis=0) * values
+        v, H = _plogp(counts, weights)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            PI = (np.where(v > 0, v * np.log(v / pz), 0.0) * weights).sum(axis=-1)
+        widths = np.diff(cuts) / (cuts[-1] - cuts[0])
+        entropies[name] = float((widths * (H + PI)).sum() / np.log(base))
+    return entropies
+
+
+def _sweep_area(points, types, schemes, base):
+    if len(points) == 0:
+        return {name: 0.0 for name in schemes}
+    return altieri_sweep(points, types, schemes, base=base)
+
+
+def sweep_areas(
+    points, areas, code_col, schemes, level=0, filter_i=1, base=2, workers=None
+):
+    """This function is used to compute the Altieri entropy of every area for every break scheme
+
+    The amenities are assigned to the areas with an STRtree and the areas are spread
+    over a process pool.
+
+    Args:
+        points (DataFrame): the point table from load_amenity_points
+        areas (GeoDataFrame): the areas, in EPSG:4326
+        code_col (str): the column with the area code
+        schemes (dict): the break schemes by name, see PairDistances.breaks
+        level (int): the category level, 0 or 1
+        filter_i (int): the filter number, see getfilter
+        base (float): the base of the logarithm
+        workers (int, optional): the number of processes, 1 runs in this process
+
+    Returns:
+        DataFrame: the entropy of every area (rows, by code) and scheme (columns)
+    """
+
+    assert level in [0, 1], "Level must be 0 or 1"
+    L0_BLACKLIST, L1_BLACKLIST = getfilter(filter_i)
+    keep = ~points["category"].isin(L0_BLACKLIST)
+    for key, value in L1_BLACKLIST.items():
+        keep &= ~((points["category"] == key) & points["subcategory"].isin(value))
+    points = points[keep.to_numpy()]
+
+    xy = points[["x", "y"]].to_numpy(dtype=np.float64)
+    types = points["category" if level == 0 else "subcategory"].astype(str).to_numpy()
+    tree = shapely.STRtree(areas.geometry.values)
+    i, j = tree.query(shapely.points(xy), predicate="within")
+    order = np.argsort(j, kind="stable")
+    i, j = i[order], j[order]
+    bounds = np.searchsorted(j, np.arange(len(areas) + 1))
+    args = [
+        (xy[i[lo:hi]], types[i[lo:hi]], schemes, base)
+        for lo, hi in zip(bounds[:-1], bounds[1:])
+    ]
+
+    if workers == 1:
+        results = [_sweep_area(*a) for a in args]
+    else:
+        with ProcessPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+            results = list(pool.map(_sweep_area, *zip(*args)))
+    return pd.DataFrame(
+        results, index=pd.Index(areas[code_col].to_numpy(), name=code_col)
+    )
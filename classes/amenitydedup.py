@@ -0,0 +1,148 @@
+import numpy as np
+import pandas as pd
+import shapely
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
+from .tagtable import TagTable
+
+# ------- CONSTANTS -------#
+
+# amenities of the same kind closer than this many metres can be the same facility
+DEDUP_RADIUS = 25
+METRES_PER_DEGREE = 111_320
+# the grid cells that can hold an amenity within the radius of an amenity in cell
+# (0, 0), the other half of the neighbourhood is covered from the other side
+NEIGHBOUR_CELLS = [(0, 0), (1, -1), (1, 0), (1, 1), (0, 1)]
+# the preferred representative of a merged group, after the number of tags
+TYPE_ORDER = {"node": 0, "way": 1, "relation": 2}
+
+
+def _kinds(tags, keys):
+    # the key=value pairs of every amenity for the categorisation keys, one row each,
+    # the kind is a code of the key and the value
+    codes = tags._key_codes(keys)
+    entries = np.flatnonzero(np.isin(tags.keys, codes[codes >= 0]))
+    kind = tags.keys[entries].astype(np.int64) * len(tags.value_names)
+    return pd.DataFrame(
+        {"row": tags.rows()[entries], "kind": kind + tags.values[entries]}
+    )
+
+
+def duplicate_pairs(gdf, keys, radius=DEDUP_RADIUS, tags=None):
+    """This function is used to find the pairs of amenities that are the same facility
+
+    The amenities are hashed to a grid of cells of the radius by their kind (a
+    key=value tag of one of keys), so only amenities of the same kind in the same or a
+    neighbouring cell are compared, which is linear in the number of amenities. Two
+    amenities are the same facility when they are of a different OSM type (a node and
+    the building way it lies in), within the radius, do not have different names and
+    are each other's nearest such amenity.
+
+    Args:
+        gdf (GeoDataFrame): the cleaned amenities, points in EPSG:4326
+        keys (list): the tag keys that make the kind of an amenity
+        radius (float): the distance in metres
+        tags (TagTable, optional): the tags of the amenities, interned from gdf by default
+
+    Returns:
+        array: pairs x 2, the rows of the duplicate amenities
+    """
+
+    if len(gdf) < 2:
+        return np.zeros((0, 2), dtype=np.int64)
+
+    # metres on a plane tangent at the middle of the amenities
+    coords = shapely.get_coordinates(gdf.geometry.values)
+    scale = np.cos(np.radians(coords[:, 1].mean())) * METRES_PER_DEGREE
+    xy = coords * [scale, METRES_PER_DEGREE]
+    cells = np.floor(xy / radius).astype(np.int64)
+
+    tags = TagTable.from_dicts(gdf["tags"]) if tags is None else tags
+    kinds = _kinds(tags, keys)
+    if kinds.empty:
+        return np.zeros((0, 2), dtype=np.int64)
+    kinds["cx"] = cells[kinds["row"], 0]
+    kinds["cy"] = cells[kinds["row"], 1]
+
+    candidates = []
+    for dx, dy in NEIGHBOUR_CELLS:
+        shifted = kinds.assign(cx=kinds["cx"] + dx, cy=kinds["cy"] + dy)
+        pairs = kinds.merge(shifted, on=["kind", "cx", "cy"], suffixes=("_a", "_b"))
+        pairs = pairs[pairs["row_a"] != pairs["row_b"]]
+        if (dx, dy) == (0, 0):
+            pairs = pairs[pairs["row_a"] < pairs["row_b"]]
+        candidates.append(pairs[["row_a", "row_b"]].to_numpy())
+    # amenities sharing several kinds are candidates more than once
+    candidates = np.unique(np.sort(np.concatenate(candidates), axis=1), axis=0)
+    a, b = candidates[:, 0], candidates[:, 1]
+
+    distance = np.hypot(*(xy[a] - xy[b]).T)
+    types = gdf["type"].to_numpy()
+    names = tags.get("name")
+    unnamed = pd.isna(names)
+    same_name = unnamed[a] | unnamed[b] | (names[a] == names[b])
+    keep = (distance <= radius) & (types[a] != types[b]) & same_name
+    candidates, distance = candidates[keep], distance[keep]
+
+    # a facility is mapped at most twice, so only mutually nearest amenities are
+    # paired, a building does not swallow every unnamed amenity of its kind around it
+    nearest = np.full(len(gdf), np.inf)
+    np.minimum.at(nearest, candidates[:, 0], distance)
+    np.minimum.at(nearest, candidates[:, 1], distance)
+    mutual = (distance == nearest[candidates[:, 0]]) & (
+        distance == nearest[candidates[:, 1]]
+    )
+    return candidates[mutual]
+
+
+def representatives(gdf, keys, radius=DEDUP_RADIUS, tags=None):
+    """This function is used to find the amenities to keep when the duplicates are merged, see duplicate_pairs
+
+    Every group of duplicates is represented by the amenity with the most tags, a node
+    before a way before a relation.
+
+    Args:
+        gdf (GeoDataFrame): the cleaned amenities, points in EPSG:4326
+        keys (list): the tag keys that make the kind of an amenity
+        radius (float): the distance in metres
+        tags (TagTable, optional): the tags of the amenities, interned from gdf by default
+
+    Returns:
+        array: the rows of the amenities to keep, in order
+    """
+
+    tags = TagTable.from_dicts(gdf["tags"]) if tags is None else tags
+    pairs = duplicate_pairs(gdf, keys, radius=radius, tags=tags)
+    n = len(gdf)
+    if len(pairs) == 0:
+        return np.arange(n)
+
+    graph = coo_matrix((np.ones(len(pairs)), (pairs[:, 0], pairs[:, 1])), shape=(n, n))
+    _, group = connected_components(graph, directed=False)
+
+    type_order = gdf["type"].map(TYPE_ORDER).fillna(len(TYPE_ORDER)).to_numpy()
+    # the first row of every group in this order is its representative
+    order = np.lexsort((np.arange(n), type_order, -tags.counts(), group))
+    first = np.ones(n, dtype=bool)
+    first[1:] = group[order][1:] != group[order][:-1]
+    return np.sort(order[first])
+
+
+def deduplicate_amenities(gdf, keys, radius=DEDUP_RADIUS, tags=None):
+    """This function is used to merge the amenities that are the same facility, see representatives
+
+    Args:
+        gdf (GeoDataFrame): the cleaned amenities, points in EPSG:4326
+        keys (list): the tag keys that make the kind of an amenity
+        radius (float): the distance in metres
+        tags (TagTable, optional): the tags of the amenities, interned from gdf by default
+
+    Returns:
+        tuple: the amenities without duplicates and the number of amenities merged away
+    """
+
+    keep = representatives(gdf, keys, radius=radius, tags=tags)
+    if len(keep) == len(gdf):
+        return gdf, 0
+    return gdf.iloc[keep].reset_index(drop=True), len(gdf) - len(keep)
@@ -0,0 +1,202 @@
+import glob
+import math
+import os
+import threading
+
+import numpy as np
+import pandas as pd
+import shapely
+
+from .countstore import L0_CATEGORIES
+from .metrics import timed
+
+# ------- CONSTANTS -------#
+
+AMENITY_FOLDER = "data/gm_amenities"
+POINTS_PATH = "data/amenity_points.parquet"
+POINT_COLUMNS = {"x", "y", "category", "subcategory", "gemeentenaam"}
+
+CATEGORY_COLORS = {
+    "Education": "#1f77b4",
+    "Sports": "#2ca02c",
+    "Shopping": "#ff7f0e",
+    "Entertainment, arts and culture": "#9467bd",
+    "Sustenance": "#d62728",
+    "Public service": "#8c564b",
+    "Facilities": "#7f7f7f",
+    "Financial": "#bcbd22",
+    "Healthcare": "#e377c2",
+    "Places of worship": "#17becf",
+    "Public transportation": "#393b79",
+    "Private transportation": "#637939",
+    "Waste management": "#843c39",
+}
+
+# the point table is built once, also when it is loaded from several threads
+_build_lock = threading.Lock()
+
+
+def build_amenity_points(folder=AMENITY_FOLDER, path=POINTS_PATH):
+    """This function is used to collect the amenities of all municipalities into one compact point table
+
+    Only the coordinates, the L0 and L1 category and the municipality are kept, sorted by longitude.
+
+    Args:
+        folder (str): the folder with the amenities_<gemeente>.parquet files
+        path (str): where to write the point table
+    """
+
+    frames = []
+    for file in sorted(glob.glob(os.path.join(folder, "amenities_*.parquet"))):
+        gm_name = os.path.basename(file)[len("amenities_") : -len(".parquet")]
+        df = pd.read_parquet(file, columns=["geometry", "L0_category", "L1_category"])
+        coords = shapely.get_coordinates(shapely.from_wkb(df["geometry"].values))
+        frames.append(
+            pd.DataFrame(
+                {
+                    "x": coords[:, 0],
+                    "y": coords[:, 1],
+                    "category": df["L0_category"].values,
+                    "subcategory": df["L1_category"].values,
+                    "gemeentenaam": gm_name,
+                }
+            )
+        )
+
+    points = pd.concat(frames, ignore_index=True)
+    points = points[points["category"].isin(L0_CATEGORIES)]
+    points["category"] = pd.Categorical(points["category"], categories=L0_CATEGORIES)
+    points["subcategory"] = points["subcategory"].astype("category")
+    points["gemeentenaam"] = points["gemeentenaam"].astype("category")
+    points = points.sort_values("x", kind="stable").reset_index(drop=True)
+    # written next to the table and renamed, so a reader never sees half a file
+    points.to_parquet(f"{path}.tmp")
+    os.replace(f"{path}.tmp", path)
+    return points
+
+
+@timed
+def load_amenity_points(path=POINTS_PATH):
+    """This function is used to load the point table, building it first if it does not exist or is outdated"""
+
+    with _build_lock:
+        if os.path.exists(path):
+            points = pd.read_parquet(path)
+            if POINT_COLUMNS <= set(points.columns):
+                return points
+        return build_amenity_points(path=path)
+
+
+class AmenityPoints:
+    """Amenity points served per viewport, clustered on a grid below a zoom threshold
+
+    For every cluster zoom level the points are aggregated once into grid cells, so a
+    query only has to select the cells (or points) within the bounds. All levels are
+    sorted by longitude, which makes the selection a binary search plus a latitude mask.
+    """
+
+    def __init__(self, points, min_zoom=7, max_cluster_zoom=15, radius=40):
+        """
+        Args:
+            points (DataFrame): the point table from load_amenity_points
+            min_zoom (int): the coarsest zoom level, lower zoom levels use this level
+            max_cluster_zoom (int): above this zoom level the individual points are served
+            radius (int): the size in pixels of a cluster cell
+        """
+
+        points = points.sort_values("x", kind="stable")
+        self.x = points["x"].to_numpy(dtype=np.float64)
+        self.y = points["y"].to_numpy(dtype=np.float64)
+        self.category = points["category"].cat.codes.to_numpy().astype(np.int8)
+        self.categories = list(points["category"].cat.categories)
+
+        self.min_zoom = min_zoom
+        self.max_cluster_zoom = max_cluster_zoom
+        self.radius = radius
+        # latitude degrees are longer on a mercator map than longitude degrees
+        self.aspect = math.cos(math.radians(np.median(self.y))) if len(self.y) else 1.0
+
+        # without points there is nothing to cluster, every level is empty
+        self.levels = {
+            zoom: self._cluster(zoom) if len(self.x) else self._empty_level()
+            for zoom in range(min_zoom, max_cluster_zoom + 1)
+        }
+
+    def _cell_size(self, zoom):
+        # degrees longitude covered by radius pixels of a 256 pixel tile
+        return 360 / 2**zoom * self.radius / 256
+
+    @staticmethod
+    def _empty_level():
+        empty = np.zeros(0)
+        return {
+            "x": empty,
+            "y": empty,
+            "count": empty.astype(np.int64),
+            "category": empty.astype(np.int64),
+        }
+
+    def _cluster(self, zoom):
+        size_x = self._cell_size(zoom)
+        size_y = size_x * self.aspect
+        ix = np.floor(self.x / size_x).astype(np.int64)
+        iy = np.floor(self.y / size_y).astype(np.int64)
+        cell = (ix - ix.min()) * (iy.max() - iy.min() + 1) + (iy - iy.min())
+
+        _, inverse, counts = np.unique(cell, return_inverse=True, return_counts=True)
+        n_cat = len(self.categories)
+        category_counts = np.bincount(
+            inverse * n_cat + self.category, minlength=len(counts) * n_cat
+        ).reshape(-1, n_cat)
+
+        cx = np.bincount(inverse, weights=self.x) / counts
+        cy = np.bincount(inverse, weights=self.y) / counts
+        order = np.argsort(cx, kind="stable")
+        return {
+            "x": cx[order],
+            "y": cy[order],
+            "count": counts[order],
+            "category": category_counts.argmax(axis=1)[order],
+        }
+
+    @staticmethod
+    def _select(x, y, bounds):
+        minx, miny, maxx, maxy = bounds
+        lo, hi = np.searchsorted(x, [minx, maxx], side="left")
+        inside = (y[lo:hi] >= miny) & (y[lo:hi] <= maxy)
+        return lo + np.flatnonzero(inside)
+
+    def _feature(self, x, y, category, count):
+        properties = {"L0_category": self.categories[category]}
+        if count > 1:
+            properties.update(cluster=True, point_count=int(count))
+        return {
+            "type": "Feature",
+            "geometry": {"type": "Point", "coordinates": [float(x), float(y)]},
+            "properties": properties,
+        }
+
+    def query(self, bounds, zoom):
+        """This function is used to get the (clustered) amenities within the bounds as a FeatureCollection
+
+        Args:
+            bounds (tuple): minx, miny, maxx, maxy of the viewport
+            zoom (int): the zoom level of the map, None gives the coarsest clusters
+        """
+
+        if zoom is not None and zoom > self.max_cluster_zoom:
+            idx = self._select(self.x, self.y, bounds)
+            features = [
+                self._feature(self.x[i], self.y[i], self.category[i], 1) for i in idx
+            ]
+        else:
+            zoom = self.min_zoom if zoom is None else max(int(zoom), self.min_zoom)
+            level = self.levels[zoom]
+            idx = self._select(level["x"], level["y"], bounds)
+            features = [
+                self._feature(
+                    level["x"][i], level["y"][i], level["category"][i], level["count"][i]
+                )
+                for i in idx
+            ]
+        return {"type": "FeatureCollection", "features": features}
@@ -0,0 +1,317 @@
+import time
+
+import numpy as np
+
+# ------- CONSTANTS -------#
+
+# the default number of point pairs to sample
+SAMPLE_SIZE = 200000
+# pairs are sampled in rounds of this size, so a time budget can stop in between
+ROUND_SIZE = 50000
+# category pairs with at most this many point pairs are counted exactly
+EXACT_PAIRS = 100
+# the number of bootstrap replicates of the confidence interval
+BOOTSTRAP = 200
+# the default cut-off distance of leibovici_entropy
+LEIBOVICI_DISTANCE = 10
+
+
+class EntropyEstimate:
+    """An entropy estimated from sampled point pairs
+
+    Like the entropy objects of spatialentropy it has an entropy attribute, so it can
+    be used in their place.
+
+    Attributes:
+        entropy (float): the estimate
+        low, high (float): the bounds of the confidence interval
+        confidence (float): the confidence level of the interval
+        pairs (int): the number of point pairs sampled or counted exactly
+        total_pairs (int): the number of point pairs of the points
+        exact (bool): True if all point pairs were counted, the interval is then the entropy
+    """
+
+    def __init__(self, entropy, low, high, confidence, pairs, total_pairs, exact):
+        self.entropy = entropy
+        self.low = low
+        self.high = high
+        self.confidence = confidence
+        self.pairs = pairs
+        self.total_pairs = total_pairs
+        self.exact = exact
+
+    def __repr__(self):
+        return (
+            f"EntropyEstimate({self.entropy:.4f}, {self.confidence:.0%} CI "
+            f"[{self.low:.4f}, {self.high:.4f}], {self.pairs}/{self.total_pairs} pairs)"
+        )
+
+
+class _PairSampler:
+    """Stratified sample of point pairs, the strata are the (unordered) category pairs
+
+    The number of point pairs of every stratum is known from the category counts, only
+    the share of them in every distance class is estimated. Every round samples the
+    strata in proportion to their size, small strata are counted exactly.
+    """
+
+    def __init__(self, points, types, breaks, seed=None):
+        points = np.asarray(points, dtype=np.float64)
+        codes, counts = np.unique(types, return_inverse=True, return_counts=True)[1:]
+        order = np.argsort(codes, kind="stable")
+        self.points = points[order]
+        self.breaks = np.asarray(breaks, dtype=np.float64)
+        self.n_classes = len(breaks) + 1
+        self.rng = np.random.default_rng(seed)
+        self.counts = counts
+
+        offsets = np.concatenate([[0], np.cumsum(counts)])
+        a, b = np.triu_indices(len(counts))
+        sizes = np.where(
+            a == b, counts[a] * (counts[a] - 1) // 2, counts[a] * counts[b]
+        ).astype(np.int64)
+        keep = sizes > 0
+        self.a, self.b, self.sizes = a[keep], b[keep], sizes[keep]
+        self.start_a, self.n_a = offsets[self.a], counts[self.a]
+        self.start_b, self.n_b = offsets[self.b], counts[self.b]
+        self.total_pairs = int(self.sizes.sum())
+
+        # distance class counts of the exact strata, and of the samples of the others
+        self.class_counts = np.zeros((len(self.sizes), self.n_classes), dtype=np.int64)
+        self.sampled = np.zeros(len(self.sizes), dtype=np.int64)
+        self.exact = np.zeros(len(self.sizes), dtype=bool)
+
+    def _classify(self, i, j):
+        distance = np.hypot(*(self.points[i] - self.points[j]).T)
+        return np.searchsorted(self.breaks, distance, side="left")
+
+    def count_exact(self, strata):
+        strata = np.asarray(strata, dtype=np.int64)
+        same = self.a[strata] == self.b[strata]
+        n_a, n_b = self.n_a[strata], self.n_b[strata]
+        # all ordered pairs, within a category every pair is then counted twice
+        pairs = np.where(same, n_a * (n_a - 1), n_a * n_b)
+        stratum = np.repeat(np.arange(len(strata)), pairs)
+        p = np.arange(pairs.sum()) - np.repeat(np.cumsum(pairs) - pairs, pairs)
+
+        others = np.where(same, n_b - 1, n_b)[stratum]
+        i, j = np.divmod(p, others)
+        j += same[stratum] & (j >= i)
+        classes = self._classify(
+            self.start_a[strata][stratum] + i, self.start_b[strata][stratum] + j
+        )
+        counts = np.bincount(
+            stratum * self.n_classes + classes, minlength=len(strata) * self.n_classes
+        ).reshape(-1, self.n_classes)
+        counts[same] //= 2
+
+        self.class_counts[strata] = counts
+        self.sampled[strata] = self.sizes[strata]
+        self.exact[strata] = True
+
+    def sample(self, n_pairs):
+        strata = np.flatnonzero(~self.exact)
+        if len(strata) == 0:
+            return 0
+        sizes = self.sizes[strata]
+        draws = np.maximum(1, np.round(n_pairs * sizes / sizes.sum())).astype(np.int64)
+        stratum = np.repeat(strata, draws)
+
+        n_a, n_b = self.n_a[stratum], self.n_b[stratum]
+        same = self.a[stratum] == self.b[stratum]
+        i = (self.rng.random(len(stratum)) * n_a).astype(np.int64)
+        # within a category the second point is drawn from the others
+        others = np.where(same, n_b - 1, n_b)
+        j = (self.rng.random(len(stratum)) * others).astype(np.int64)
+        j += same & (j >= i)
+
+        classes = self._classify(self.start_a[stratum] + i, self.start_b[stratum] + j)
+        self.class_counts += np.bincount(
+            stratum * self.n_classes + classes,
+            minlength=len(self.sizes) * self.n_classes,
+        ).reshape(-1, self.n_classes)
+        self.sampled[strata] += draws
+        return len(stratum)
+
+    def run(self, sample_size, time_budget):
+        if sample_size is not None and sample_size >= self.total_pairs:
+            self.count_exact(np.arange(len(self.sizes)))
+            return
+        self.count_exact(np.flatnonzero(self.sizes <= EXACT_PAIRS))
+
+        start = time.perf_counter()
+        done = 0
+        while sample_size is None or done < sample_size:
+            size = ROUND_SIZE
+            if sample_size is not None:
+                size = min(size, sample_size - done)
+            sampled = self.sample(size)
+            # all strata are counted exactly, there is nothing left to sample
+            if sampled == 0:
+                break
+            done += sampled
+            if time_budget is not None and time.perf_counter() - start >= time_budget:
+                break
+
+    def estimated_pairs(self, class_counts=None):
+        """The estimated number of point pairs of every stratum in every distance class"""
+
+        class_counts = self.class_counts if class_counts is None else class_counts
+        return class_counts * (self.sizes / np.maximum(self.sampled, 1))[:, None]
+
+    def bootstrap(self, replicates):
+        """Resampled class counts, the exact strata stay as they are"""
+
+        sampled = np.flatnonzero(~self.exact)
+        counts = np.broadcast_to(
+            self.class_counts, (replicates,) + self.class_counts.shape
+        ).copy()
+        if len(sampled):
+            shares = self.class_counts[sampled] / self.sampled[sampled, None]
+            counts[:, sampled] = self.rng.multinomial(
+                self.sampled[sampled], shares, size=(replicates, len(sampled))
+            )
+        return counts
+
+
+def _plogp(values, weights=1):
+    # probabilities of counts along the last axis and -sum(p log p), every count
+    # standing for weights entries of the distribution
+    total = (values * weights).sum(axis=-1, keepdims=True)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        probs = np.where(total > 0, values / total, 0.0)
+        terms = np.where(probs > 0, probs * np.log(probs), 0.0)
+    return probs, -(terms * weights).sum(axis=-1)
+
+
+def _altieri(pairs, same, base):
+    # pairs: ... x strata x classes, class 0 is distance 0, the others the distance intervals
+    # altieri counts ordered category pairs: (a, b) and (b, a) for two categories, (a, a) twice
+    pairs = np.moveaxis(pairs * np.where(same, 2, 1)[:, None], -1, 0)
+    weights = np.where(same, 1, 2)
+    pz, _ = _plogp(pairs[1:].sum(axis=0), weights)
+    entropy = 0
+    for k in range(1, len(pairs)):
+        v, H = _plogp(pairs[k], weights)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            PI = (np.where(v > 0, v * np.log(v / pz), 0.0) * weights).sum(axis=-1)
+        # equal intervals, so every interval has the same weight
+        entropy = entropy + (H + PI) / (len(pairs) - 1)
+    return entropy / np.log(base)
+
+
+def _leibovici(pairs, own, single, base):
+    # pairs: ... x strata x classes, class 1 is within the cut-off distance
+    # leibovici_entropy counts both orders of every pair and every point as its own
+    # neighbour: own is n_a for the (a, a) strata and 0 for the others, the single
+    # categories with one point have no stratum but an (a, a) count of 1
+    near = 2 * pairs[..., 1] + own
+    lone = np.ones(near.shape[:-1] + (single,))
+    _, H = _plogp(np.concatenate([near, lone], axis=-1))
+    return H / np.log(base)
+
+
+def _estimate(sampler, entropy, confidence, replicates):
+    value = entropy(sampler.estimated_pairs())
+    if sampler.exact.all():
+        low = high = value
+    else:
+        # the plug-in entropy of sparse pair counts is biased low, so the estimate is
+        # bias corrected with the bootstrap and the interval is the basic bootstrap interval
+        replicated = entropy(sampler.estimated_pairs(sampler.bootstrap(replicates)))
+        alpha = (1 - confidence) / 2
+        q_low, q_high = np.quantile(replicated, [alpha, 1 - alpha])
+        low, high = 2 * value - q_high, 2 * value - q_low
+        value = 2 * value - replicated.mean()
+    return EntropyEstimate(
+        float(value),
+        float(low),
+        float(high),
+        confidence,
+        int(sampler.sampled.sum()),
+        sampler.total_pairs,
+        bool(sampler.exact.all()),
+    )
+
+
+def approximate_altieri(
+    points,
+    types,
+    sample_size=SAMPLE_SIZE,
+    time_budget=None,
+    confidence=0.95,
+    base=2,
+    seed=None,
+    replicates=BOOTSTRAP,
+):
+    """This function is used to estimate the Altieri entropy from a stratified sample of point pairs
+
+    Estimates spatialentropy.altieri_entropy with its default distance breaks (two
+    equal intervals up to the diagonal of the bounding box) and ordered pairs. The
+    estimate is bias corrected and the interval is a bootstrap interval of the sampling
+    error, both are exact when the sample covers all pairs.
+
+    Args:
+        points (list): the [x, y] of every point
+        types (array): the category of every point
+        sample_size (int, optional): the number of pairs to sample, None to sample until the time budget
+        time_budget (float, optional): the number of seconds to sample for
+        confidence (float): the confidence level of the interval
+        base (float): the base of the logarithm
+        seed (int, optional): seed of the random number generator
+
+    Returns:
+        EntropyEstimate: the estimate and its confidence interval
+    """
+
+    assert len(points) == len(types), "Points and types must have the same length"
+    assert (
+        sample_size is not None or time_budget is not None
+    ), "Give a sample size or a time budget"
+    points = np.asarray(points, dtype=np.float64)
+    dist_max = np.hypot(*(points.max(axis=0) - points.min(axis=0)))
+    sampler = _PairSampler(points, types, [0, dist_max / 2], seed=seed)
+    sampler.run(sample_size, time_budget)
+
+    same = sampler.a == sampler.b
+    return _estimate(
+        sampler, lambda pairs: _altieri(pairs, same, base), confidence, replicates
+    )
+
+
+def approximate_leibovici(
+    points,
+    types,
+    d=LEIBOVICI_DISTANCE,
+    sample_size=SAMPLE_SIZE,
+    time_budget=None,
+    confidence=0.95,
+    base=2,
+    seed=None,
+    replicates=BOOTSTRAP,
+):
+    """This function is used to estimate the Leibovici entropy from a stratified sample of point pairs
+
+    Estimates spatialentropy.leibovici_entropy with unordered pairs, where every point
+    is also its own neighbour. Arguments like approximate_altieri, d is the cut-off
+    distance.
+
+    Returns:
+        EntropyEstimate: the estimate and its confidence interval
+    """
+
+    assert len(points) == len(types), "Points and types must have the same length"
+    assert (
+        sample_size is not None or time_budget is not None
+    ), "Give a sample size or a time budget"
+    sampler = _PairSampler(points, types, [-np.inf, d], seed=seed)
+    sampler.run(sample_size, time_budget)
+
+    own = np.where(sampler.a == sampler.b, sampler.n_a, 0)
+    single = int((sampler.counts == 1).sum())
+    return _estimate(
+        sampler,
+        lambda pairs: _leibovici(pairs, own, single, base),
+        confidence,
+        replicates,
+    )
@@ -0,0 +1,60 @@
+import numpy as np
+import pandas as pd
+
+# ------- CONSTANTS -------#
+
+AGE_REGEX = "P_.*_JR$"
+GEBNL_REGEX = "P_GEBNL.*"
+GEBBL_REGEX = "P_GEBBL.*"
+INFO_COLS = ["gemeentenaam", "wijknaam", "buurtnaam", "AANT_INW", "AANT_MAN", "AANT_VROUW"]
+
+
+def _scale_to_inhabitants(stats, cols):
+    # percentages to (rounded up) number of inhabitants, per area
+    return np.ceil(stats[cols].mul(stats["AANT_INW"], axis=0) / 100)
+
+
+def build_area_table(stats, code_col):
+    """This function is used to precompute the demographics shown in the insight panel of an area
+
+    Args:
+        stats (GeoDataFrame): the stats of the areas (e.g. wijken_stats)
+        code_col (str): the column with the area code, e.g. "wijkcode" or "buurtcode"
+
+    Returns:
+        DataFrame: one row per area, indexed and sorted by the area code
+    """
+
+    agecols = stats.filter(regex=AGE_REGEX).columns
+    cols_gebnl = stats.filter(regex=GEBNL_REGEX).columns
+    cols_gebbl = stats.filter(regex=GEBBL_REGEX).columns
+    info_cols = [col for col in INFO_COLS if col in stats.columns]
+
+    table = pd.concat(
+        [
+            stats[[code_col] + info_cols],
+            _scale_to_inhabitants(stats, agecols),
+            _scale_to_inhabitants(stats, cols_gebnl),
+            _scale_to_inhabitants(stats, cols_gebbl),
+        ],
+        axis=1,
+    )
+    table = table.drop_duplicates(code_col).set_index(code_col).sort_index()
+
+    table.attrs["agecols"] = list(agecols)
+    table.attrs["cols_gebnl"] = list(cols_gebnl)
+    table.attrs["cols_gebbl"] = list(cols_gebbl)
+    return table
+
+
+def amenity_counts(store, code, level=0, filter_i=1):
+    """This function is used to get the amenity counts of an area as a category/count frame
+
+    Args:
+        store (CountStore): the amenity count store of the area type
+        code (str): the area code
+    """
+
+    counts = store.area(code, level, filter_i).reset_index()
+    counts.columns = ["category", "count"]
+    return counts
@@ -1,28 +1,203 @@
+import io
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+
+import matplotlib
 import matplotlib.pyplot as plt
 import geopandas as gpd
+from matplotlib.figure import Figure
 
+from .metrics import timed
 
-def plot_area(gdf_area, gdf_pts, gdf_blds_i, gdf_blds_o):
+# ------- CONSTANTS -------#
 
-    fig, ax = plt.subplots(figsize=(24, 10))
+AREA_FILES = {
+    "wijken": ("data/wijken/wijken_stats_lisa.parquet", "wijkcode"),
+    "buurten": ("data/buurten/buurten_stats.parquet", "buurtcode"),
+}
+PLOT_FOLDER = "assets/amenity_plots"
+
+# resolution of the plots rendered on demand
+RENDER_DPI = {"full": 100, "thumb": 30}
+
+
+def plot_area(
+    gdf_area, gdf_pts, gdf_blds_i, gdf_blds_o, path="assets/area_plot.png", dpi=300, ax=None
+):
+    """This function is used to plot an area with its amenities and buildings
+
+    Args:
+        path (str or file-like): where to save the png
+        dpi (int): the resolution of the png
+        ax (Axes, optional): axes to draw on, they are cleared first so a figure can be reused
+    """
+
+    if ax is None:
+        fig, ax = plt.subplots(figsize=(24, 10))
+    else:
+        fig = ax.figure
+        ax.clear()
 
     # plot the boundaries of the wijk
     gdf_area.boundary.plot(ax=ax, color="black")
 
     # plot the buildings
-    # gdf_blds_i.plot(ax=ax, color="black", alpha=0.5)
-    # gdf_blds_o.plot(ax=ax, color="gray", alpha=0.5)
+    if gdf_blds_i is not None and not gdf_blds_i.empty:
+        gdf_blds_i.plot(ax=ax, color="black", alpha=0.5)
+    if gdf_blds_o is not None and not gdf_blds_o.empty:
+        gdf_blds_o.plot(ax=ax, color="gray", alpha=0.5)
 
     # plot the points
-    # gdf_pts.plot(
-    #     ax=ax, column="L0_category", legend=True, legend_kwds={"loc": "upper left"}
-    # )
+    if gdf_pts is not None and not gdf_pts.empty:
+        gdf_pts.plot(
+            ax=ax, column="L0_category", legend=True, legend_kwds={"loc": "upper left"}
+        )
 
     # no axis
     ax.axis("off")
 
     # set tight layout
-    plt.tight_layout()
+    fig.tight_layout()
 
     # save the figure as a png
-    plt.savefig("assets/area_plot.png", dpi=300)
+    fig.savefig(path, dpi=dpi)
+
+
+# ----------- BATCH RENDERING ------------#
+
+# state of a render worker, set up once by _init_worker
+_worker = {}
+
+
+def _amenity_file(gm_name):
+    return f"data/gm_amenities/amenities_{gm_name}.parquet"
+
+
+@timed
+def _load_areas(level):
+    path, code_col = AREA_FILES[level]
+    areas = gpd.read_parquet(path, columns=[code_col, "gemeentenaam", "geometry"])
+    return areas.set_index(code_col)
+
+
+@lru_cache(maxsize=8)
+@timed
+def _load_amenities(gm_name):
+    return gpd.read_parquet(_amenity_file(gm_name), columns=["geometry", "L0_category"])
+
+
+def _init_worker(level, dpi):
+    matplotlib.use("Agg")
+    fig, ax = plt.subplots(figsize=(24, 10))
+    _worker.update(level=level, dpi=dpi, areas=_load_areas(level), ax=ax)
+
+
+def _area_and_points(areas, code):
+    area = areas.loc[[code]]
+    amenities = _load_amenities(area["gemeentenaam"].iloc[0])
+    points = amenities[amenities.within(area.geometry.iloc[0])]
+    return area, points
+
+
+def _render(code):
+    area, points = _area_and_points(_worker["areas"], code)
+    path = os.path.join(PLOT_FOLDER, _worker["level"], f"{code}.png")
+    plot_area(area, points, None, None, path=path, dpi=_worker["dpi"], ax=_worker["ax"])
+    return code
+
+
+def _is_up_to_date(path, inputs):
+    if not os.path.exists(path):
+        return False
+    modified = os.path.getmtime(path)
+    return all(os.path.getmtime(i) <= modified for i in inputs if os.path.exists(i))
+
+
+def render_areas(codes, level, dpi=300, workers=None, force=False):
+    """This function is used to render the amenity plots of many areas in parallel
+
+    The plots are written to assets/amenity_plots/<level>/<code>.png. Plots that are
+    newer than both the area and the amenity data are skipped, unless force is set.
+
+    Args:
+        codes (list): the wijk- or buurtcodes to render
+        level (str): "wijken" or "buurten"
+        dpi (int): the resolution of the pngs
+        workers (int, optional): the number of processes, defaults to the number of cpus
+        force (bool): render all plots, also the up to date ones
+
+    Returns:
+        dict: the number of rendered and skipped plots and the throughput
+    """
+
+    assert level in AREA_FILES, "Level must be wijken or buurten"
+    os.makedirs(os.path.join(PLOT_FOLDER, level), exist_ok=True)
+
+    gm_names = _load_areas(level)["gemeentenaam"]
+    area_file = AREA_FILES[level][0]
+    todo = [
+        code
+        for code in codes
+        if force
+        or not _is_up_to_date(
+            os.path.join(PLOT_FOLDER, level, f"{code}.png"),
+            [area_file, _amenity_file(gm_names[code])],
+        )
+    ]
+    # group the areas per municipality, so the workers can reuse the amenities
+    todo.sort(key=lambda code: gm_names[code])
+
+    start = time.perf_counter()
+    if todo:
+        with ProcessPoolExecutor(
+            max_workers=workers, initializer=_init_worker, initargs=(level, dpi)
+        ) as executor:
+            for _ in executor.map(_render, todo, chunksize=16):
+                pass
+    seconds = time.perf_counter() - start
+
+    stats = {
+        "rendered": len(todo),
+        "skipped": len(codes) - len(todo),
+        "seconds": seconds,
+        "images_per_second": len(todo) / seconds if seconds else 0.0,
+    }
+    print(
+        f"Rendered {stats['rendered']} plots ({stats['skipped']} up to date) "
+        f"in {seconds:.1f}s, {stats['images_per_second']:.2f} images/s"
+    )
+    return stats
+
+
+# ----------- ON DEMAND RENDERING ------------#
+
+
+@lru_cache(maxsize=None)
+def _areas(level):
+    return _load_areas(level)
+
+
+def render_area(code, level, dpi=RENDER_DPI["full"]):
+    """This function is used to render the amenity plot of an area into memory
+
+    A new Figure is used for every call (no pyplot state), so it is safe to call from
+    the threads of a web server.
+
+    Args:
+        code (str): the wijk- or buurtcode, raises a KeyError if it does not exist
+        level (str): "wijken" or "buurten"
+        dpi (int): the resolution of the png
+
+    Returns:
+        bytes: the png
+    """
+
+    assert level in AREA_FILES, "Level must be wijken or buurten"
+    area, points = _area_and_points(_areas(level), code)
+
+    fig = Figure(figsize=(24, 10))
+    buffer = io.BytesIO()
+    plot_area(area, points, None, None, path=buffer, dpi=dpi, ax=fig.subplots())
+    return buffer.getvalue()
@@ -0,0 +1,281 @@
+import glob
+import os
+from functools import lru_cache
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import shapely
+
+from .gdfbuilder import GdfBuilder
+from .metrics import timed
+from .osmapi import OSM_API
+
+# ------- CONSTANTS -------#
+
+BUILDING_FOLDER = "data/buildings"
+INDEX_FILE = "index.parquet"
+
+# the buildings are partitioned in tiles of this many degrees, by the centre of their
+# bounding box, a tile is also the size of one Overpass request when building
+TILE_DEGREES = 0.05
+# within a tile the buildings are ordered by cells of this many degrees, so the
+# bounding box statistics of a row group cover a small part of the tile
+CELL_DEGREES = TILE_DEGREES / 16
+ROW_GROUP_SIZE = 4096
+BUILDING_COLUMNS = ["type", "id", "building", "geometry"]
+BBOX_COLUMNS = ["xmin", "ymin", "xmax", "ymax"]
+CRS = "EPSG:4326"
+GEOMETRY = "geometry"
+# areas in square meters are computed in the Dutch national grid
+METRIC_CRS = "EPSG:28992"
+
+
+def _footprints(gdf):
+    # only the polygons, open ways are not footprints
+    gdf = gdf[shapely.get_type_id(gdf.geometry.values) != 1]
+    gdf = gdf[~gdf.geometry.isna()]
+    return gpd.GeoDataFrame(gdf[BUILDING_COLUMNS], geometry="geometry", crs=CRS)
+
+
+@timed
+def buildings_from_overpass(bbox, tile=TILE_DEGREES):
+    """This function is used to fetch the building footprints in a bounding box from the OSM API
+
+    The bounding box is queried tile by tile, so no request gets too large.
+
+    Args:
+        bbox (tuple): minx, miny, maxx, maxy in EPSG:4326
+        tile (float): the size of a request, in degrees
+    """
+
+    api, builder = OSM_API(), GdfBuilder()
+    frames = []
+    for minx in np.arange(bbox[0], bbox[2], tile):
+        for miny in np.arange(bbox[1], bbox[3], tile):
+            box = (minx, miny, min(minx + tile, bbox[2]), min(miny + tile, bbox[3]))
+            gdf = builder.json_to_gdf(api.query_buildings(box))
+            if gdf.empty:
+                continue
+            gdf["building"] = gdf["tags"].map(lambda tags: tags.get("building"))
+            frames.append(_footprints(gdf))
+
+    if not frames:
+        return gpd.GeoDataFrame(columns=BUILDING_COLUMNS, geometry="geometry", crs=CRS)
+    buildings = pd.concat(frames, ignore_index=True)
+    # a building on the edge of two requests is returned by both
+    return buildings.drop_duplicates(["type", "id"], ignore_index=True)
+
+
+@timed
+def buildings_from_pbf(path, bbox=None):
+    """This function is used to read the building footprints from an OSM PBF extract
+
+    Uses the OSM driver of GDAL, its multipolygons layer holds the closed ways and the
+    multipolygon relations.
+
+    Args:
+        path (str): the .osm.pbf file
+        bbox (tuple, optional): minx, miny, maxx, maxy in EPSG:4326 to read
+    """
+
+    gdf = gpd.read_file(path, layer="multipolygons", bbox=bbox)
+    gdf = gdf[gdf["building"].notna()]
+    way = gdf["osm_way_id"].notna()
+    gdf = gdf.assign(
+        type=np.where(way, "way", "relation"),
+        id=gdf["osm_way_id"].where(way, gdf["osm_id"]).astype(np.int64),
+    )
+    return _footprints(gdf.to_crs(CRS))
+
+
+@timed
+def build_building_store(buildings, folder=BUILDING_FOLDER):
+    """This function is used to write building footprints as a store of GeoParquet tiles
+
+    Every tile holds the buildings whose bounding box centre lies in it, with the
+    bounding box of every building as columns. The index lists the tiles with the
+    bounding box of their buildings, so a query reads only the tiles and, through the
+    row group statistics, the row groups that can intersect it.
+
+    Args:
+        buildings (GeoDataFrame): the footprints, from buildings_from_overpass or buildings_from_pbf
+        folder (str): the folder of the store, earlier tiles are removed
+
+    Returns:
+        DataFrame: the index of the tiles
+    """
+
+    buildings = buildings.to_crs(CRS)
+    bounds = shapely.bounds(buildings.geometry.values)
+    centre = (bounds[:, :2] + bounds[:, 2:]) / 2
+    tiles = np.floor(centre / TILE_DEGREES).astype(np.int64)
+    cells = np.floor(centre / CELL_DEGREES).astype(np.int64)
+    # by tile (x, then y) like np.unique below, then by cell within the tile
+    order = np.lexsort((cells[:, 0], cells[:, 1], tiles[:, 1], tiles[:, 0]))
+
+    buildings = buildings.iloc[order].reset_index(drop=True)
+    for i, col in enumerate(BBOX_COLUMNS):
+        buildings[col] = bounds[order, i]
+    tiles = tiles[order]
+
+    os.makedirs(folder, exist_ok=True)
+    for file in glob.glob(os.path.join(folder, "tile_*.parquet")):
+        os.remove(file)
+
+    index = []
+    keys, starts = np.unique(tiles, axis=0, return_index=True)
+    for (tx, ty), lo, hi in zip(keys, starts, list(starts[1:]) + [len(buildings)]):
+        tile = buildings.iloc[lo:hi]
+        file = f"tile_{tx}_{ty}.parquet"
+        tile.to_parquet(os.path.join(folder, file), row_group_size=ROW_GROUP_SIZE)
+        index.append(
+            {
+                "file": file,
+                "xmin": tile["xmin"].min(),
+                "ymin": tile["ymin"].min(),
+                "xmax": tile["xmax"].max(),
+                "ymax": tile["ymax"].max(),
+                "rows": len(tile),
+            }
+        )
+
+    index = pd.DataFrame(index)
+    index.to_parquet(os.path.join(folder, INDEX_FILE))
+    # the stores opened before hold the index of the earlier tiles
+    _open_building_store.cache_clear()
+    print(f"Stored {len(buildings)} buildings in {len(index)} tiles")
+    return index
+
+
+def split_buildings(buildings, area, simplify=None):
+    """This function is used to split buildings into those outside and those within an area
+
+    Args:
+        buildings (GeoDataFrame): the buildings, in EPSG:4326
+        area (Polygon or MultiPolygon): the area
+        simplify (float, optional): the tolerance to simplify the footprints with, in degrees
+
+    Returns:
+        tuple: the buildings outside and within the area
+    """
+
+    # one predicate pass, against the prepared area
+    shapely.prepare(area)
+    inside = shapely.contains(area, buildings.geometry.values)
+    if simplify:
+        buildings = buildings.assign(
+            geometry=buildings.geometry.simplify(simplify, preserve_topology=True)
+        )
+    return buildings[~inside], buildings[inside]
+
+
+class BuildingStore:
+    """Building footprints stored as GeoParquet tiles, see build_building_store
+
+    Reading the buildings of an area needs no request to the OSM API: the index selects
+    the tiles and the bounding box columns the row groups and rows.
+    """
+
+    def __init__(self, folder=BUILDING_FOLDER):
+        self.folder = folder
+        self.index = pd.read_parquet(os.path.join(folder, INDEX_FILE))
+
+    def query(self, bbox, columns=None):
+        """This function is used to get the buildings that intersect a bounding box
+
+        Args:
+            bbox (tuple): minx, miny, maxx, maxy in EPSG:4326
+            columns (list, optional): the columns to read, all by default
+
+        Returns:
+            GeoDataFrame: the buildings whose bounding box intersects it
+        """
+
+        minx, miny, maxx, maxy = bbox
+        index = self.index
+        tiles = index[
+            (index["xmin"] <= maxx)
+            & (index["xmax"] >= minx)
+            & (index["ymin"] <= maxy)
+            & (index["ymax"] >= miny)
+        ]
+        filters = [
+            ("xmin", "<=", maxx),
+            ("xmax", ">=", minx),
+            ("ymin", "<=", maxy),
+            ("ymax", ">=", miny),
+        ]
+        tables = [
+            pq.read_table(
+                os.path.join(self.folder, file), columns=columns, filters=filters
+            )
+            for file in tiles["file"]
+        ]
+        # the tiles are converted at once, parsing the crs of every tile is slow
+        table = pa.concat_tables(tables) if tables else None
+        if table is None:
+            names = columns or BUILDING_COLUMNS + BBOX_COLUMNS
+            return gpd.GeoDataFrame(columns=names, geometry="geometry", crs=CRS)
+        df = table.drop([GEOMETRY]).to_pandas()
+        geometry = gpd.GeoSeries.from_wkb(table.column(GEOMETRY).to_numpy(), crs=CRS)
+        return gpd.GeoDataFrame(df, geometry=geometry.values, crs=CRS)
+
+    def split(self, area, simplify=None):
+        """This function is used to get the buildings around and within an area, like return_buildings
+
+        Args:
+            area (Polygon or MultiPolygon): the area
+            simplify (float, optional): the tolerance to simplify the footprints with, in degrees
+
+        Returns:
+            tuple: the buildings in the bounding box outside the area, and within it
+        """
+
+        buildings = self.query(shapely.bounds(area), columns=BUILDING_COLUMNS)
+        return split_buildings(buildings, area, simplify=simplify)
+
+    def built_up_area(self, areas, code_col):
+        """This function is used to compute the area covered by buildings of every area
+
+        Buildings on the border count with the part that lies within the area. Divide
+        the number of amenities by it for the amenity density per built-up square meter.
+
+        Args:
+            areas (GeoDataFrame): the areas, in EPSG:4326
+            code_col (str): the column with the area code
+
+        Returns:
+            Series: the built-up area in square meters, by area code
+        """
+
+        buildings = self.query(areas.total_bounds, columns=["geometry"])
+        footprints = buildings.to_crs(METRIC_CRS).geometry.values
+        polygons = areas.to_crs(METRIC_CRS).geometry.values
+        i, j = shapely.STRtree(footprints).query(polygons, predicate="intersects")
+        overlap = shapely.area(shapely.intersection(polygons[i], footprints[j]))
+        return pd.Series(
+            np.bincount(i, weights=overlap, minlength=len(areas)),
+            index=pd.Index(areas[code_col].to_numpy(), name=code_col),
+            name="built_up_m2",
+        )
+
+
+@lru_cache(maxsize=8)
+def _open_building_store(folder, mtime):
+    # keyed on the modification time of the index, so a rebuilt store is opened again
+    return BuildingStore(folder)
+
+
+def load_building_store(folder=BUILDING_FOLDER):
+    """This function is used to open the store once, None if it has not been built
+
+    A missing store is not remembered, so the store is used as soon as it is built.
+    """
+
+    path = os.path.join(folder, INDEX_FILE)
+    if not os.path.exists(path):
+        return None
+    return _open_building_store(folder, os.path.getmtime(path))
@@ -0,0 +1,266 @@
+import json
+import re
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from .metrics import timed
+
+# ------- CONSTANTS -------#
+
+# wide count columns look like L0_1_count_<category>
+COUNT_COLUMN = re.compile(r"^L(?P<level>\d)_(?P<filter>\d)_count_(?P<category>.+)$")
+N_FILTERS = 3
+
+# the L0 categories of data/categorisation.xlsx, used to recognise the level of a
+# group of count columns (the gemeenten and buurten tables have their labels swapped)
+L0_CATEGORIES = [
+    "Education",
+    "Sports",
+    "Shopping",
+    "Entertainment, arts and culture",
+    "Sustenance",
+    "Public service",
+    "Facilities",
+    "Financial",
+    "Healthcare",
+    "Places of worship",
+    "Public transportation",
+    "Private transportation",
+    "Waste management",
+]
+
+CODE_COLS = {
+    "gemeenten": "gemeentecode",
+    "wijken": "wijkcode",
+    "buurten": "buurtcode",
+}
+
+METADATA_KEY = b"urban_count_groups"
+
+
+def _parse_wide_columns(columns):
+    """This function is used to map the wide count columns to (level, filter, category)
+
+    The level is derived from the categories of a (level, filter) group rather than
+    from the column prefix, so mislabelled tables end up in the right level.
+    """
+
+    groups = {}
+    for col in columns:
+        match = COUNT_COLUMN.match(col)
+        if match:
+            key = (int(match["level"]), int(match["filter"]))
+            groups.setdefault(key, []).append((col, match["category"]))
+
+    parsed = {}
+    for (_, filter_i), cols in groups.items():
+        categories = [category for _, category in cols]
+        level = 0 if set(categories) <= set(L0_CATEGORIES) else 1
+        for col, category in cols:
+            parsed[col] = (level, filter_i, category)
+    return parsed
+
+
+class CountStore:
+    """Long-format amenity count store indexed by (area code, level, filter, category)
+
+    Only non-zero counts are stored. The rows are kept in two orders: sorted by area
+    (for all categories of one area) and sorted by category (for one category across
+    all areas), so that every slice is a binary search plus a contiguous read.
+    """
+
+    def __init__(self, frame, groups, areas=None):
+        """
+        Args:
+            frame (DataFrame): long counts with the columns code, level, filter, category, count
+            groups (dict): the categories of every (level, filter) group, in display order
+            areas (array, optional): all area codes, also those without amenities
+        """
+
+        if areas is None:
+            areas = frame["code"].unique()
+        self.groups = {key: list(categories) for key, categories in groups.items()}
+        self.areas = np.sort(np.asarray(areas).astype(str))
+        self.category_names = np.array(
+            sorted({c for categories in self.groups.values() for c in categories})
+        )
+
+        # position of every category within the display order of its group
+        self._positions = {}
+        for (level, filter_i), categories in self.groups.items():
+            positions = np.full(len(self.category_names), -1)
+            positions[np.searchsorted(self.category_names, categories)] = np.arange(
+                len(categories)
+            )
+            self._positions[level * N_FILTERS + filter_i] = positions
+
+        area = np.searchsorted(self.areas, frame["code"].to_numpy().astype(str))
+        group = (frame["level"].to_numpy() * N_FILTERS + frame["filter"].to_numpy()).astype(
+            np.int8
+        )
+        category = np.searchsorted(
+            self.category_names, frame["category"].to_numpy().astype(str)
+        ).astype(np.int16)
+        count = frame["count"].to_numpy().astype(np.int32)
+
+        # area order
+        order = np.lexsort((category, group, area))
+        self._area = area[order].astype(np.int32)
+        self._area_group = group[order]
+        self._area_category = category[order]
+        self._area_count = count[order]
+
+        # category order
+        cat_key = group.astype(np.int32) * len(self.category_names) + category
+        order = np.lexsort((area, cat_key))
+        self._cat_key = cat_key[order]
+        self._cat_area = area[order].astype(np.int32)
+        self._cat_count = count[order]
+
+    @classmethod
+    def from_wide(cls, counts, code_col, codes=None):
+        """This function is used to build the store from a wide *_counts table
+
+        Args:
+            counts (DataFrame): the wide count table
+            code_col (str): the column with the area code
+            codes (array, optional): the area codes, if they are not a column of counts
+        """
+
+        if codes is not None:
+            assert len(codes) == len(counts), "Codes and counts are not aligned"
+            counts = counts.assign(**{code_col: np.asarray(codes)})
+
+        parsed = _parse_wide_columns(counts.columns)
+        wide = counts.groupby(code_col)[list(parsed)].sum()
+
+        long = wide.rename_axis(columns="column").stack().rename("count").reset_index()
+        long = long[long["count"] > 0]
+        long = long.rename(columns={code_col: "code"})
+
+        mapping = pd.DataFrame(
+            list(parsed.values()),
+            index=list(parsed),
+            columns=["level", "filter", "category"],
+        )
+        long = long.join(mapping, on="column").drop(columns="column")
+
+        groups = {}
+        for col, (level, filter_i, category) in parsed.items():
+            groups.setdefault((level, filter_i), []).append(category)
+
+        return cls(long, groups, areas=wide.index.to_numpy())
+
+    # ----------- QUERIES ------------#
+
+    def _area_index(self, code):
+        i = np.searchsorted(self.areas, code)
+        if i == len(self.areas) or self.areas[i] != code:
+            raise KeyError(code)
+        return i
+
+    def categories(self, level, filter_i):
+        """This function is used to get the categories of a (level, filter) group"""
+
+        return self.groups[(level, filter_i)]
+
+    def area(self, code, level, filter_i):
+        """This function is used to get the counts of all categories of one area
+
+        Args:
+            code (str): the area code
+            level (int): the category level, 0 or 1
+            filter_i (int): the filter number, 0, 1 or 2
+
+        Returns:
+            Series: the counts indexed by category, including the categories without amenities
+        """
+
+        i = self._area_index(code)
+        lo, hi = np.searchsorted(self._area, [i, i + 1])
+        group = level * N_FILTERS + filter_i
+        glo, ghi = np.searchsorted(self._area_group[lo:hi], [group, group + 1])
+
+        categories = self.categories(level, filter_i)
+        counts = np.zeros(len(categories), dtype=np.int32)
+        positions = self._positions[group][self._area_category[lo + glo : lo + ghi]]
+        counts[positions] = self._area_count[lo + glo : lo + ghi]
+        return pd.Series(counts, index=categories, name=code)
+
+    def category(self, level, filter_i, category):
+        """This function is used to get the counts of one category across all areas
+
+        Returns:
+            Series: the counts indexed by area code, including the areas without amenities
+        """
+
+        c = np.searchsorted(self.category_names, category)
+        if c == len(self.category_names) or self.category_names[c] != category:
+            raise KeyError(category)
+        key = (level * N_FILTERS + filter_i) * len(self.category_names) + c
+        lo, hi = np.searchsorted(self._cat_key, [key, key + 1])
+
+        counts = np.zeros(len(self.areas), dtype=np.int32)
+        counts[self._cat_area[lo:hi]] = self._cat_count[lo:hi]
+        return pd.Series(counts, index=self.areas, name=category)
+
+    def wide(self, level, filter_i):
+        """This function is used to get an area x category table of one (level, filter) group"""
+
+        group = level * N_FILTERS + filter_i
+        n_cat = len(self.category_names)
+        lo, hi = np.searchsorted(self._cat_key, [group * n_cat, (group + 1) * n_cat])
+
+        table = np.zeros((len(self.areas), n_cat), dtype=np.int32)
+        table[self._cat_area[lo:hi], self._cat_key[lo:hi] - group * n_cat] = self._cat_count[
+            lo:hi
+        ]
+        table = pd.DataFrame(table, index=self.areas, columns=self.category_names)
+        return table[self.categories(level, filter_i)]
+
+    # ----------- STORAGE ------------#
+
+    def to_frame(self):
+        """This function is used to get the store as a long DataFrame"""
+
+        return pd.DataFrame(
+            {
+                "code": self.areas[self._area],
+                "level": self._area_group // N_FILTERS,
+                "filter": self._area_group % N_FILTERS,
+                "category": self.category_names[self._area_category],
+                "count": self._area_count,
+            }
+        )
+
+    def to_parquet(self, path):
+        table = pa.Table.from_pandas(self.to_frame(), preserve_index=False)
+        groups = [[level, filter_i, cats] for (level, filter_i), cats in self.groups.items()]
+        metadata = dict(table.schema.metadata or {})
+        metadata[METADATA_KEY] = json.dumps({"groups": groups, "areas": self.areas.tolist()})
+        pq.write_table(table.replace_schema_metadata(metadata), path)
+
+    @classmethod
+    def read_parquet(cls, path):
+        table = pq.read_table(path)
+        metadata = json.loads(table.schema.metadata[METADATA_KEY])
+        groups = {(level, filter_i): cats for level, filter_i, cats in metadata["groups"]}
+
+        return cls(table.to_pandas(), groups, areas=metadata["areas"])
+
+
+@timed
+def load_counts(areatype, codes=None):
+    """This function is used to load the count store of gemeenten, wijken or buurten
+
+    Args:
+        areatype (str): "gemeenten", "wijken" or "buurten"
+        codes (array, optional): the area codes, for count tables without a code column
+    """
+
+    assert areatype in CODE_COLS, "Area type must be gemeenten, wijken or buurten"
+    counts = pd.read_parquet(f"data/{areatype}/{areatype}_counts.parquet")
+    return CountStore.from_wide(counts, CODE_COLS[areatype], codes=codes)
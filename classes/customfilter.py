@@ -0,0 +1,272 @@
+import hashlib
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from .statscache import StatsCache
+
+# ------- CONSTANTS -------#
+
+SPATIAL_MEASURES = ["altieri", "leibovici"]
+
+# the spatial measures look at all pairs of points, larger areas are estimated live
+MAX_SPATIAL_POINTS = 3000
+# the number of seconds an estimate may sample point pairs for
+APPROXIMATE_TIME_BUDGET = 0.5
+# below this map zoom level no spatial entropies are computed, at zoom 7 all 342
+# gemeenten are visible and would be queued at once
+SPATIAL_MIN_ZOOM = 9
+
+
+def signature(L0_blacklist, L1_blacklist):
+    """This function is used to get a short key that identifies a custom filter
+
+    Args:
+        L0_blacklist (list): the excluded L0 categories
+        L1_blacklist (dict): the excluded L1 categories per L0 category, like getfilter
+    """
+
+    items = sorted(f"L0:{l0}" for l0 in L0_blacklist) + sorted(
+        f"L1:{l0}|{l1}" for l0, l1s in L1_blacklist.items() for l1 in l1s
+    )
+    return hashlib.sha1("\n".join(items).encode()).hexdigest()[:16]
+
+
+def _shannon(counts):
+    # shannon entropy in bits of every row of a count matrix, 0 for empty rows
+    totals = counts.sum(axis=1, keepdims=True)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        probs = counts / totals
+        terms = np.where(counts > 0, probs * np.log2(probs), 0.0)
+    return -terms.sum(axis=1)
+
+
+def _ready():
+    # runs in a worker process, forces the pool to start its workers
+    return True
+
+
+def _spatial_entropy(measure, points, labels, approximate=False):
+    # runs in a worker process, spatialentropy is only imported there
+    if approximate:
+        from .approxentropy import approximate_altieri, approximate_leibovici
+
+        estimate = approximate_altieri if measure == "altieri" else approximate_leibovici
+        return float(
+            estimate(
+                points, labels, sample_size=None, time_budget=APPROXIMATE_TIME_BUDGET
+            ).entropy
+        )
+
+    from spatialentropy import altieri_entropy, leibovici_entropy
+
+    if measure == "altieri":
+        return float(altieri_entropy(points, labels, base=2).entropy)
+    return float(leibovici_entropy(points, labels, base=2).entropy)
+
+
+class CustomFilterEntropy:
+    """Entropy of every area under a user defined filter, computed live
+
+    A filter excludes L0 categories and L1 categories per L0 category, like the
+    blacklists of getfilter. The amenities are counted once per area and (L0, L1)
+    pair, so the Shannon entropy of all areas under any filter is one matrix product.
+    Spatial entropies need the points themselves: they are computed for the requested
+    areas on a process pool and cached by filter signature. Areas with too many points
+    for the exact measures get an estimate from a sample of point pairs.
+
+    The pool forks the process, so start it with start() before serving requests from
+    threads.
+    """
+
+    def __init__(
+        self, points, area_col="gemeentenaam", max_workers=2, max_points=MAX_SPATIAL_POINTS
+    ):
+        """
+        Args:
+            points (DataFrame): the point table from load_amenity_points
+            area_col (str): the column with the area of every point
+            max_workers (int): the number of processes for the spatial entropies
+            max_points (int): areas with more points get an estimated spatial entropy
+        """
+
+        area, self.areas = pd.factorize(points[area_col], sort=True)
+        self.areas = np.asarray(self.areas).astype(str)
+        order = np.argsort(area, kind="stable")
+        area = area[order]
+        self.offsets = np.searchsorted(area, np.arange(len(self.areas) + 1))
+
+        self.x = points["x"].to_numpy()[order]
+        self.y = points["y"].to_numpy()[order]
+        L0, L0_names = pd.factorize(points["category"], sort=True)
+        L1, L1_names = pd.factorize(points["subcategory"], sort=True)
+
+        # every point belongs to one (L0, L1) pair
+        pairs, self.pair = np.unique(L0[order] * len(L1_names) + L1[order], return_inverse=True)
+        self.pair_L0 = np.asarray(L0_names).astype(str)[pairs // len(L1_names)]
+        self.pair_L1 = np.asarray(L1_names).astype(str)[pairs % len(L1_names)]
+
+        n_pairs = len(pairs)
+        self.counts = np.bincount(
+            area * n_pairs + self.pair, minlength=len(self.areas) * n_pairs
+        ).reshape(len(self.areas), n_pairs)
+
+        # the labels of a level, shared L1 names (e.g. "Other") are one label like in calculate_entropies
+        self.labels = {}
+        self.pair_labels = {}
+        for level, names in enumerate([self.pair_L0, self.pair_L1]):
+            self.pair_labels[level], self.labels[level] = np.unique(names, return_inverse=True)[::-1]
+
+        self.max_workers = max_workers
+        self.max_points = max_points
+        self.cache = StatsCache("custom_spatial_entropy", threshold=20000)
+        self._executor = None
+        self._pending = {}
+        # reentrant: a future that is already done runs its callback in _submit
+        self._lock = threading.RLock()
+
+    # ----------- FILTERS ------------#
+
+    def categories(self):
+        """This function is used to get the (L0, L1) pairs that can be excluded"""
+
+        return list(zip(self.pair_L0, self.pair_L1))
+
+    def _keep(self, L0_blacklist, L1_blacklist):
+        excluded = np.isin(self.pair_L0, list(L0_blacklist))
+        for l0, l1s in L1_blacklist.items():
+            excluded |= (self.pair_L0 == l0) & np.isin(self.pair_L1, list(l1s))
+        return ~excluded
+
+    def shannon(self, level, L0_blacklist, L1_blacklist):
+        """This function is used to get the Shannon entropy of all areas under a filter
+
+        Args:
+            level (int): the category level, 0 or 1
+            L0_blacklist (list): the excluded L0 categories
+            L1_blacklist (dict): the excluded L1 categories per L0 category
+
+        Returns:
+            Series: the entropy in bits by area, 0 for areas without amenities
+        """
+
+        keep = self._keep(L0_blacklist, L1_blacklist)
+        onehot = np.zeros((len(keep), len(self.labels[level])))
+        onehot[np.flatnonzero(keep), self.pair_labels[level][keep]] = 1
+        return pd.Series(_shannon(self.counts @ onehot), index=self.areas)
+
+    def area_points(self, area):
+        """This function is used to get the amenities of an area
+
+        Returns:
+            DataFrame: the x, y, category and subcategory of every amenity
+        """
+
+        i = np.searchsorted(self.areas, area)
+        if i == len(self.areas) or self.areas[i] != area:
+            raise KeyError(area)
+        lo, hi = self.offsets[i], self.offsets[i + 1]
+        return pd.DataFrame(
+            {
+                "x": self.x[lo:hi],
+                "y": self.y[lo:hi],
+                "category": self.pair_L0[self.pair[lo:hi]],
+                "subcategory": self.pair_L1[self.pair[lo:hi]],
+            }
+        )
+
+    # ----------- SPATIAL ------------#
+
+    def start(self):
+        """This function is used to start the process pool of the spatial entropies and its workers
+
+        The workers are forked from the calling thread, call it at startup instead of
+        on the first request.
+        """
+
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=self.max_workers)
+                futures = [
+                    self._executor.submit(_ready) for _ in range(self.max_workers)
+                ]
+                for future in futures:
+                    future.result()
+
+    def _area_points(self, i, level, keep):
+        lo, hi = self.offsets[i], self.offsets[i + 1]
+        mask = keep[self.pair[lo:hi]]
+        points = np.column_stack([self.x[lo:hi][mask], self.y[lo:hi][mask]]).tolist()
+        labels = self.labels[level][self.pair_labels[level][self.pair[lo:hi][mask]]]
+        return points, np.asarray(labels)
+
+    def _submit(self, key, measure, points, labels, approximate):
+        self.start()
+        future = self._executor.submit(
+            _spatial_entropy, measure, points, labels, approximate
+        )
+        self._pending[key] = future
+
+        def done(future):
+            try:
+                value = future.result()
+            except Exception as e:
+                print(f"Custom filter entropy {key} failed: {e!r}")
+                value = float("nan")
+            self.cache.set(key, value)
+            with self._lock:
+                self._pending.pop(key, None)
+
+        future.add_done_callback(done)
+
+    def spatial(self, measure, level, L0_blacklist, L1_blacklist, areas, zoom=None):
+        """This function is used to get the spatial entropy of areas under a filter, computing missing ones in the background
+
+        Args:
+            measure (str): "altieri" or "leibovici"
+            level (int): the category level, 0 or 1
+            L0_blacklist (list): the excluded L0 categories
+            L1_blacklist (dict): the excluded L1 categories per L0 category
+            areas (list): the areas to compute, e.g. the visible ones
+            zoom (int, optional): the map zoom level, below SPATIAL_MIN_ZOOM nothing is
+                computed
+
+        Returns:
+            tuple: the entropies that are ready by area, the number of areas still being
+                computed and the areas with too many points, which are estimated
+        """
+
+        assert measure in SPATIAL_MEASURES, "Measure must be altieri or leibovici"
+        if zoom is not None and zoom < SPATIAL_MIN_ZOOM:
+            return {}, 0, []
+        sig = signature(L0_blacklist, L1_blacklist)
+        keep = self._keep(L0_blacklist, L1_blacklist)
+
+        values, pending, approximated = {}, 0, []
+        for area in areas:
+            i = np.searchsorted(self.areas, area)
+            if i == len(self.areas) or self.areas[i] != area:
+                continue
+            key = f"{sig}/{measure}/{level}/{area}"
+            lo, hi = self.offsets[i], self.offsets[i + 1]
+            large = np.count_nonzero(keep[self.pair[lo:hi]]) > self.max_points
+            if large:
+                approximated.append(area)
+            value = self.cache.get(key)
+            if value is not None:
+                values[area] = value
+                continue
+
+            with self._lock:
+                if key in self._pending:
+                    pending += 1
+                    continue
+                points, labels = self._area_points(i, level, keep)
+                if len(points) == 0:
+                    values[area] = 0.0
+                else:
+                    self._submit(key, measure, points, labels, large)
+                    pending += 1
+        return values, pending, approximated
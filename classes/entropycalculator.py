@@ -6,12 +6,20 @@ from spatialentropy import altieri_entropy, leibovici_entropy
 from scipy.stats import entropy
 import numpy as np
 import gc
+import hashlib
+import threading
 from numpy import AxisError
 
 
 # import shapely.geometry
+from . import amenitydedup
+from . import approxentropy
+from . import buildingstore
 from . import osmapi
 from . import gdfbuilder
+from . import pipelinetrace
+from . import statscache
+from . import tagtable
 
 builder = gdfbuilder.GdfBuilder()
 api = osmapi.OSM_API()
@@ -21,8 +29,16 @@ api = osmapi.OSM_API()
 # categorisation
 CATEGORISATION = pd.read_excel("data/categorisation.xlsx")
 
-# cleaning
-COLS_TO_KEEP = ["type", "tags", "geometry"]
+# cleaning, the OSM id keys the amenities in the snapshot store
+COLS_TO_KEEP = ["type", "id", "tags", "geometry"]
+# the keys of the primary tags, in order of preference
+PRIMARY_TAGS = list(CATEGORISATION["primary tag"].unique())
+# de-duplication, amenities sharing one of these tags (with the same value) can be
+# the same facility
+DEDUP_TAGS = PRIMARY_TAGS
+
+# the number of areas whose pipelines are kept
+PIPELINE_CACHE_SIZE = 4
 
 # ----------- FILTER 0 ------------#
 L0_BLACKLIST = [
@@ -120,25 +136,14 @@ def getfilter(filter_i):
     return (L0_BLACKLIST, L1_BLACKLIST)
 
 
-def find_primary_tag(x):
-    for tag in CATEGORISATION["primary tag"].unique():
-        if tag in x:
-            return tag
-
-
-def _extract_tags(gdf):
+def _extract_tags(gdf, tags):
     if gdf.empty:
         return gdf
-    gdf.loc[:, "primary_tag"] = gdf.loc[:, "tags"].apply(lambda x: find_primary_tag(x))
-    try:
-        gdf.loc[:, "secondary_tag"] = gdf.apply(
-            lambda x: x.tags.get(x.primary_tag, None),
-            axis=1,
-        )
-    except ValueError:
-        print("ValueError, Saving to file")
-        gdf.to_parquet("errors/error.gdf")
-        gdf.loc[:, "secondary_tag"] = "Uncategorised"
+    # the first primary tag of every amenity and its value, over the interned tags of
+    # all amenities at once
+    primary, secondary = tags.first(PRIMARY_TAGS)
+    gdf.loc[:, "primary_tag"] = primary
+    gdf.loc[:, "secondary_tag"] = secondary
     return gdf
 
 
@@ -157,6 +162,14 @@ def _clean_amenities(gdf, area):
     return gdf
 
 
+def _deduplicate_amenities(gdf, tags):
+    # the union query returns a facility both as a node and as its building way
+    keep = amenitydedup.representatives(gdf, DEDUP_TAGS, tags=tags)
+    if len(keep) == len(gdf):
+        return gdf, tags, 0
+    return gdf.iloc[keep].reset_index(drop=True), tags.take(keep), len(gdf) - len(keep)
+
+
 def _categorise_L0(x):
     primary = x.primary_tag
     secondary = x.secondary_tag
@@ -225,52 +238,233 @@ def _get_shannon_entropy(labels, base=2):
     return entropy(probs, base=base)
 
 
-def calculate_entropies_fromapi(area):
+def _filter_key(L0_blacklist, L1_blacklist):
+    L1 = [(key, tuple(sorted(value))) for key, value in L1_blacklist.items()]
+    return (tuple(sorted(L0_blacklist)), tuple(sorted(L1)))
+
+
+class AreaPipeline:
+    """The stages of the amenity pipeline of one area, computed on first access
+
+    fetch -> json_to_gdf -> clean -> intern_tags -> deduplicate -> extract_tags ->
+    categorise -> filter, every stage starts from a copy of the previous one, so the
+    kept frames are never changed. The tags are interned once after cleaning into a
+    TagTable on the pipeline, the kept frames have no tags column. Only the
+    categorised amenities and the entropies per filter are kept: the fetched and
+    cleaned frames are dropped once the amenities are categorised, and a filter is a
+    mask on the categorised amenities that is applied on every call. The pipelines are shared through area_pipeline, keyed by the hash
+    of the area geometry, so the entropies and the categorised amenities of an area
+    need one fetch.
+    """
+
+    def __init__(self, area, area_id=None):
+        """
+        Args:
+            area (Polygon or MultiPolygon): the area
+            area_id (str, optional): the name of the area in the trace, when a stage is
+                not given one
+        """
+
+        self.area = area
+        self.area_id = area_id
+        self.stages = {}
+        # the number of amenities of the area that were merged as duplicates
+        self.merged = None
+        # the interned tags of the amenities, row i is the amenity at position i of the
+        # cleaned and categorised frames (and of index i of a filtered frame)
+        self.tags = None
+        # stages use earlier stages, so the same thread takes the lock again
+        self._lock = threading.RLock()
+
+    def stage(self, key, build):
+        """This function is used to get a stage, building it on first access
+
+        Args:
+            key (hashable): the name of the stage, with its parameters
+            build (callable): function without arguments that builds the stage
+        """
+
+        with self._lock:
+            if key not in self.stages:
+                self.stages[key] = build()
+            return self.stages[key]
+
+    def _traced(self, area_id, name, build):
+        with pipelinetrace.current().stage(area_id, name) as record:
+            value = build()
+            record["rows"] = len(value)
+        return value
+
+    def amenities(self, area_id=None):
+        """This function is used to get the amenities in the bounding box of the area from the OSM API"""
+
+        area_id = self.area_id if area_id is None else area_id
+
+        def build():
+            trace = pipelinetrace.current()
+            with trace.stage(area_id, "fetch") as record:
+                data = api.query_amenities(shapely.total_bounds(self.area))
+                record["rows"] = len(data.get("elements", []))
+            # only the frame is kept
+            return self._traced(
+                area_id, "json_to_gdf", lambda: builder.json_to_gdf(data)
+            )
+
+        return self.stage("amenities", build)
+
+    def cleaned(self, area_id=None):
+        """This function is used to get the amenities within the area, without duplicates"""
+
+        area_id = self.area_id if area_id is None else area_id
+
+        def build():
+            gdf = self.amenities(area_id)
+            if gdf.empty:
+                self.merged = 0
+                self.tags = tagtable.TagTable.from_dicts([])
+                return gdf
+            gdf = self._traced(
+                area_id, "clean", lambda: _clean_amenities(gdf.copy(), self.area)
+            )
+            # the dicts of the API are only walked once, the frame keeps no tags
+            tags = self._traced(
+                area_id,
+                "intern_tags",
+                lambda: tagtable.TagTable.from_dicts(gdf["tags"]),
+            )
+            gdf = gdf.drop(columns="tags")
+            # merge the duplicates of the overlapping query clauses
+            with pipelinetrace.current().stage(area_id, "deduplicate") as record:
+                gdf, self.tags, self.merged = _deduplicate_amenities(gdf, tags)
+                record["merged"] = self.merged
+                record["rows"] = len(gdf)
+            return gdf
+
+        return self.stage("cleaned", build)
+
+    def categorised(self, area_id=None):
+        """This function is used to get the amenities within the area with their primary and secondary tag and categories, the other tags are in self.tags"""
+
+        area_id = self.area_id if area_id is None else area_id
+
+        def build():
+            gdf = self.cleaned(area_id)
+            if not gdf.empty:
+                gdf = self._traced(
+                    area_id,
+                    "extract_tags",
+                    lambda: _extract_tags(gdf.copy(), self.tags),
+                )
+                gdf = self._traced(
+                    area_id, "categorise", lambda: _categorise_amenities(gdf)
+                )
+            # the earlier frames are no longer needed, the fetched one holds the tags
+            # of every amenity in the bounding box
+            self.stages.pop("amenities", None)
+            self.stages.pop("cleaned", None)
+            return gdf
+
+        return self.stage("categorised", build)
+
+    def filtered(
+        self, L0_blacklist=L0_BLACKLIST, L1_blacklist=L1_BLACKLIST, area_id=None
+    ):
+        """This function is used to get the categorised amenities that pass a filter
+
+        The result is a new frame, it is not kept.
+
+        Args:
+            L0_blacklist (list): the L0 categories to leave out
+            L1_blacklist (dict): the L1 categories to leave out, by L0 category
+            area_id (str, optional): the name of the area in the trace
+        """
+
+        area_id = self.area_id if area_id is None else area_id
+        gdf = self.categorised(area_id)
+        if gdf.empty:
+            return gdf.copy()
+        with pipelinetrace.current().stage(area_id, "filter") as record:
+            # filter out the uncategorised amenities
+            gdf = _filter_uncategorised(gdf)
+
+            # filter out prespecified categories
+            gdf = gdf[~gdf.L0_category.isin(L0_blacklist)]
+            for key, value in L1_blacklist.items():
+                gdf = gdf[~((gdf.L0_category == key) & (gdf.L1_category.isin(value)))]
+            record["rows"] = len(gdf)
+        return gdf
+
+
+# the pipelines of the areas used last, a pipeline keeps the categorised amenities of
+# its area
+_pipelines = statscache.LRUCache("area_pipelines", max_items=PIPELINE_CACHE_SIZE)
+
+
+def area_pipeline(area, area_id=None):
+    """This function is used to get the shared pipeline of an area, see AreaPipeline
+
+    Args:
+        area (Polygon or MultiPolygon): the area
+        area_id (str, optional): the name of the area in the trace of a new pipeline,
+            give it to the stages to trace them under another name
+    """
+
     assert isinstance(
         area,
         (shapely.geometry.multipolygon.MultiPolygon, shapely.geometry.polygon.Polygon),
     ), "Area must be a shapely Polygon or MultiPolygon"
 
-    # get the amenity data from the OSM API and convert it to a GeoDataFrame
-    data = api.query_amenities(shapely.total_bounds(area))
-    gdf = builder.json_to_gdf(data)
+    key = hashlib.sha1(shapely.to_wkb(area)).hexdigest()
+    return _pipelines.get_or_build(key, lambda: AreaPipeline(area, area_id))
 
-    if gdf.empty:
-        return [0, 0, 0, 0, 0, 0]
 
-    # clean the data
-    gdf = _clean_amenities(gdf, area)
+def calculate_entropies_fromapi(area, area_id=None):
+    """This function is used to calculate the six entropies of an area from the OSM API
 
-    if gdf.empty:
-        return [0, 0, 0, 0, 0, 0]
+    The amenities come from the shared pipeline of the area (see area_pipeline), the
+    entropies are kept in it as well.
+    The stages can be traced with pipelinetrace.enable (or the URBAN_PIPELINE_TRACE
+    environment variable), records are then written per stage for area_id, for the
+    stages that are computed.
 
-    # Extract primary and secondary tags
-    gdf = _extract_tags(gdf)
+    Args:
+        area (Polygon or MultiPolygon): the area
+        area_id (str, optional): the name of the area in the trace
+    """
 
-    # categorise the amenities
-    gdf = _categorise_amenities(gdf)
+    pipeline = area_pipeline(area, area_id)
+    filter_key = _filter_key(L0_BLACKLIST, L1_BLACKLIST)
+    return list(
+        pipeline.stage(
+            ("entropies",) + filter_key,
+            lambda: _entropies_fromapi(pipeline, area_id),
+        )
+    )
 
-    # filter out the uncategorised amenities
-    gdf = _filter_uncategorised(gdf)
 
-    # filter out prespecified categories
-    gdf = gdf[~gdf.L0_category.isin(L0_BLACKLIST)]
-    if L1_BLACKLIST:
-        for key, value in L1_BLACKLIST.items():
-            gdf = gdf[~((gdf.L0_category == key) & (gdf.L1_category.isin(value)))]
+def _entropies_fromapi(pipeline, area_id):
+    trace = pipelinetrace.current()
+    gdf = pipeline.filtered(L0_BLACKLIST, L1_BLACKLIST, area_id=area_id)
+    if gdf.empty:
+        return [0, 0, 0, 0, 0, 0]
 
     points = _points_to_2darray(gdf)
-
     L0 = gdf.loc[:, "L0_category"].values
     L1 = gdf.loc[:, "L1_category"].values
 
     try:
-        L0_entropy_shannon = _get_shannon_entropy(L0, base=2)
-        L1_entropy_shannon = _get_shannon_entropy(L1, base=2)
-        L0_entropy_altieri = altieri_entropy(points, L0, base=2).entropy
-        L1_entropy_altieri = altieri_entropy(points, L1, base=2).entropy
-        L0_entropy_leibovici = leibovici_entropy(points, L0, base=2).entropy
-        L1_entropy_leibovici = leibovici_entropy(points, L1, base=2).entropy
+        with trace.stage(area_id, "shannon") as record:
+            L0_entropy_shannon = _get_shannon_entropy(L0, base=2)
+            L1_entropy_shannon = _get_shannon_entropy(L1, base=2)
+            record["rows"] = len(points)
+        with trace.stage(area_id, "altieri") as record:
+            L0_entropy_altieri = altieri_entropy(points, L0, base=2).entropy
+            L1_entropy_altieri = altieri_entropy(points, L1, base=2).entropy
+            record["rows"] = len(points)
+        with trace.stage(area_id, "leibovici") as record:
+            L0_entropy_leibovici = leibovici_entropy(points, L0, base=2).entropy
+            L1_entropy_leibovici = leibovici_entropy(points, L1, base=2).entropy
+            record["rows"] = len(points)
     except AxisError:
         print("AxisError", gdf.head(10))
         return [0, 0, 0, 0, 0, 0]
@@ -279,8 +473,9 @@ def calculate_entropies_fromapi(area):
         return [0, 0, 0, 0, 0, 0]
 
     # collect the garbage to free up memory
-    del data, gdf, points, L0, L1
-    gc.collect()
+    with trace.stage(area_id, "gc"):
+        del gdf, points, L0, L1
+        gc.collect()
 
     return [
         L0_entropy_shannon,
@@ -292,7 +487,22 @@ def calculate_entropies_fromapi(area):
     ]
 
 
-def calculate_entropies(area, gm_name, entropy_types, filter_i):
+def calculate_entropies(
+    area, gm_name, entropy_types, filter_i, sample_size=None, time_budget=None
+):
+    """This function is used to calculate entropies of an area from the stored amenities of its municipality
+
+    With a sample size or a time budget the spatial entropies are estimated from a
+    sample of point pairs (see approxentropy), which is much faster on large areas.
+
+    Args:
+        area (Polygon or MultiPolygon): the area
+        gm_name (str): the municipality of the area
+        entropy_types (list): the entropies to calculate, e.g. "L0_altieri"
+        filter_i (int): the filter number, see getfilter
+        sample_size (int, optional): the number of point pairs to sample
+        time_budget (float, optional): the number of seconds to sample per entropy
+    """
 
     legal_entropy_types = [
         "L0_shannon",
@@ -311,7 +521,11 @@ def calculate_entropies(area, gm_name, entropy_types, filter_i):
     L0_BLACKLIST, L1_BLACKLIST = getfilter(filter_i)
 
     # gather amenities
-    amenity_gdf = gpd.read_parquet(f"data/gm_amenities/amenities_{gm_name}.parquet")
+    # only the columns that are used, the tags take most of the memory
+    amenity_gdf = gpd.read_parquet(
+        f"data/gm_amenities/amenities_{gm_name}.parquet",
+        columns=["geometry", "L0_category", "L1_category"],
+    )
     amenity_gdf = amenity_gdf[amenity_gdf.within(area)]
 
     if amenity_gdf.empty:
@@ -337,15 +551,36 @@ def calculate_entropies(area, gm_name, entropy_types, filter_i):
     # points = amenity_gdf.points_tup.values
     points = [[point.x, point.y] for point in amenity_gdf.geometry]
     calculated_entropies = []
+    approximate = sample_size is not None or time_budget is not None
 
     for entropy_type in entropy_types:
         cat, enttype = entropy_type.split("_")
         if enttype == "shannon":
             calculated_entropies.append(_get_shannon_entropy(eval(cat), base=2))
+        elif enttype == "altieri" and approximate:
+            calculated_entropies.append(
+                approxentropy.approximate_altieri(
+                    points,
+                    eval(cat),
+                    sample_size=sample_size,
+                    time_budget=time_budget,
+                    base=2,
+                ).entropy
+            )
         elif enttype == "altieri":
             calculated_entropies.append(
                 altieri_entropy(points, eval(cat), base=2).entropy
             )
+        elif enttype == "leibovici" and approximate:
+            calculated_entropies.append(
+                approxentropy.approximate_leibovici(
+                    points,
+                    eval(cat),
+                    sample_size=sample_size,
+                    time_budget=time_budget,
+                    base=2,
+                ).entropy
+            )
         elif enttype == "leibovici":
             calculated_entropies.append(
                 leibovici_entropy(points, eval(cat), base=2).entropy
@@ -355,38 +590,22 @@ def calculate_entropies(area, gm_name, entropy_types, filter_i):
 
 
 def calculate_entropies_fromapi_no_leibo(area):
-    assert isinstance(
-        area,
-        (shapely.geometry.multipolygon.MultiPolygon, shapely.geometry.polygon.Polygon),
-    ), "Area must be a shapely Polygon or MultiPolygon"
-
-    # get the amenity data from the OSM API and convert it to a GeoDataFrame
-    data = api.query_amenities(shapely.total_bounds(area))
-    gdf = builder.json_to_gdf(data)
-
-    if gdf.empty:
-        return [0, 0, 0, 0]
+    pipeline = area_pipeline(area)
+    # only the L0 blacklist, the L1 blacklist is not applied here
+    filter_key = _filter_key(L0_BLACKLIST, {})
+    return list(
+        pipeline.stage(
+            ("entropies_no_leibo",) + filter_key,
+            lambda: _entropies_fromapi_no_leibo(pipeline),
+        )
+    )
 
-    # clean the data
-    gdf = _clean_amenities(gdf, area)
 
+def _entropies_fromapi_no_leibo(pipeline):
+    gdf = pipeline.filtered(L0_BLACKLIST, {})
     if gdf.empty:
         return [0, 0, 0, 0]
 
-    # Extract primary and secondary tags
-    gdf = _extract_tags(gdf)
-
-    # categorise the amenities
-    gdf = _categorise_amenities(gdf)
-
-    # filter out the uncategorised amenities
-    gdf = _filter_uncategorised(gdf)
-
-    # filter out prespecified categories
-    gdf = gdf[~gdf.L0_category.isin(L0_BLACKLIST)]
-    # for key, value in L1_BLACKLIST.items():
-    #     gdf = gdf[~((gdf.L0_category == key) & (gdf.L1_category.isin(value)))]
-
     points = _points_to_2darray(gdf)
 
     L0 = gdf.loc[:, "L0_category"].values
@@ -405,7 +624,7 @@ def calculate_entropies_fromapi_no_leibo(area):
         return [0, 0, 0, 0]
 
     # collect the garbage to free up memory
-    del data, gdf, points, L0, L1
+    del gdf, points, L0, L1
     gc.collect()
 
     return [
@@ -417,50 +636,41 @@ def calculate_entropies_fromapi_no_leibo(area):
 
 
 def return_categorised_amenities(area):
-    assert isinstance(
-        area,
-        (shapely.geometry.multipolygon.MultiPolygon, shapely.geometry.polygon.Polygon),
-    ), "Area must be a shapely Polygon or MultiPolygon"
-
-    # get the amenity data from the OSM API and convert it to a GeoDataFrame
-    data = api.query_amenities(shapely.total_bounds(area))
-    gdf = builder.json_to_gdf(data)
-
-    # clean the data
-    gdf = _clean_amenities(gdf, area)
-
-    if gdf.empty:
-        return gdf
-
-    # Extract primary and secondary tags
-    gdf = _extract_tags(gdf)
+    pipeline = area_pipeline(area)
+    # a new frame, the categorised amenities in the pipeline are not changed
+    gdf = pipeline.filtered(L0_BLACKLIST, L1_BLACKLIST)
 
-    # categorise the amenities
-    gdf = _categorise_amenities(gdf)
+    # the number of duplicates merged in the area
+    gdf.attrs["merged"] = pipeline.merged
+    return gdf
 
-    # filter out the uncategorised amenities
-    gdf = _filter_uncategorised(gdf)
 
-    # filter out prespecified categories
-    gdf = gdf[~gdf.L0_category.isin(L0_BLACKLIST)]
-    if L1_BLACKLIST:
-        for key, value in L1_BLACKLIST.items():
-            gdf = gdf[~((gdf.L0_category == key) & (gdf.L1_category.isin(value)))]
+def return_buildings(area, simplify=None):
+    """This function is used to get the buildings around and within an area
 
-    return gdf
+    The buildings come from the local store (see buildingstore.build_building_store),
+    only when it has not been built they are fetched from the OSM API.
 
+    Args:
+        area (Polygon or MultiPolygon): the area
+        simplify (float, optional): the tolerance to simplify the footprints with, in degrees
 
-def return_buildings(area):
+    Returns:
+        tuple: the buildings in the bounding box outside the area, and within the area
+    """
     assert isinstance(
         area,
         (shapely.geometry.multipolygon.MultiPolygon, shapely.geometry.polygon.Polygon),
     ), "Area must be a shapely Polygon or MultiPolygon"
 
-    # get the amenity data from the OSM API and convert it to a GeoDataFrame
+    store = buildingstore.load_building_store()
+    if store is not None:
+        return store.split(area, simplify=simplify)
+
+    # get the building data from the OSM API and convert it to a GeoDataFrame
     data = api.query_buildings(shapely.total_bounds(area))
     gdf = builder.json_to_gdf(data)
+    if gdf.empty:
+        return gdf, gdf
 
-    outer = gdf[~gdf.geometry.within(area)]
-    inner = gdf[gdf.geometry.within(area)]
-
-    return outer, inner
+    return buildingstore.split_buildings(gdf, area, simplify=simplify)
@@ -0,0 +1,182 @@
+import os
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+from pyproj import Transformer
+from scipy.signal import fftconvolve
+
+from .amenitypoints import POINTS_PATH, load_amenity_points
+from .metrics import timed
+
+# ------- CONSTANTS -------#
+
+SURFACE_PATH = "data/grid/entropy_surface.parquet"
+
+# the grid is laid out in the Dutch national grid, so the cells are square in meters
+GRID_CRS = "EPSG:28992"
+CELL_SIZE = 250
+# the neighbourhood of a cell for the shannon entropy, in cells around it
+RADIUS = 2
+# distance in meters at which the weight of an amenity has dropped to 1/e
+BANDWIDTH = 500
+# the decay kernel is cut off at this many bandwidths
+KERNEL_CUTOFF = 3
+
+
+class _EntropyAccumulator:
+    """Shannon entropy of every cell, accumulated one category raster at a time
+
+    H = log2(T) - sum(c log2 c) / T, with T the total of the cell, so only the total
+    and the sum of c log2 c have to be kept instead of a raster per category.
+    """
+
+    def __init__(self, shape):
+        self.total = np.zeros(shape)
+        self.clogc = np.zeros(shape)
+
+    def add(self, counts):
+        counts = np.clip(counts, 0, None)
+        self.total += counts
+        with np.errstate(divide="ignore", invalid="ignore"):
+            self.clogc += np.where(counts > 0, counts * np.log2(counts), 0.0)
+
+    def entropy(self):
+        with np.errstate(divide="ignore", invalid="ignore"):
+            entropy = np.log2(self.total) - self.clogc / self.total
+        # no amenities or one category, rounding can give tiny negative values
+        return np.where(self.total > 0, np.clip(entropy, 0, None), 0.0)
+
+
+def window_sum(raster, radius):
+    """This function is used to sum a raster over a square window of (2 radius + 1) cells around every cell
+
+    Uses a summed-area table, so the cost does not depend on the window size.
+    """
+
+    k = 2 * radius + 1
+    padded = np.pad(raster, ((radius + 1, radius), (radius + 1, radius)))
+    table = padded.cumsum(axis=0).cumsum(axis=1)
+    return table[k:, k:] - table[:-k, k:] - table[k:, :-k] + table[:-k, :-k]
+
+
+def decay_kernel(cell_size=CELL_SIZE, bandwidth=BANDWIDTH, cutoff=KERNEL_CUTOFF):
+    """This function is used to get the exponential distance decay kernel on the grid, 1 at the centre"""
+
+    r = int(np.ceil(cutoff * bandwidth / cell_size))
+    offsets = np.arange(-r, r + 1) * cell_size
+    distance = np.hypot(offsets[:, None], offsets[None, :])
+    return np.where(distance <= cutoff * bandwidth, np.exp(-distance / bandwidth), 0.0)
+
+
+def bin_points(x, y, cell_size=CELL_SIZE):
+    """This function is used to assign points to the cells of a regular grid around them
+
+    Args:
+        x, y (array): the coordinates in meters
+        cell_size (float): the size of a cell in meters
+
+    Returns:
+        tuple: the row and column of every point, the shape of the grid and the
+            coordinates of its lower left corner
+    """
+
+    minx = np.floor(x.min() / cell_size) * cell_size
+    miny = np.floor(y.min() / cell_size) * cell_size
+    col = ((x - minx) // cell_size).astype(np.int64)
+    row = ((y - miny) // cell_size).astype(np.int64)
+    return row, col, (row.max() + 1, col.max() + 1), (minx, miny)
+
+
+@timed
+def build_surface(
+    points,
+    level=0,
+    cell_size=CELL_SIZE,
+    radius=RADIUS,
+    bandwidth=BANDWIDTH,
+    path=SURFACE_PATH,
+):
+    """This function is used to compute a continuous entropy surface of the amenities on a regular grid
+
+    The amenities are counted per cell and category. For every cell, the shannon
+    entropy of the amenities in the square window around it is computed with a
+    summed-area table, and a distance decay entropy, in which every amenity is
+    weighted by exp(-distance / bandwidth), with an FFT convolution. The category
+    rasters are processed one at a time, so memory stays at a few rasters.
+
+    Args:
+        points (DataFrame): the point table from load_amenity_points
+        level (int): the category level, 0 or 1
+        cell_size (float): the size of a cell in meters
+        radius (int): the window of the shannon entropy, in cells around a cell
+        bandwidth (float): the bandwidth of the distance decay in meters
+        path (str, optional): where to write the surface as GeoParquet
+
+    Returns:
+        GeoDataFrame: the cells with amenities in their window, in EPSG:4326, with the
+            columns count, window_count, shannon and decay_shannon
+    """
+
+    assert level in [0, 1], "Level must be 0 or 1"
+    transformer = Transformer.from_crs("EPSG:4326", GRID_CRS, always_xy=True)
+    x, y = transformer.transform(points["x"].to_numpy(), points["y"].to_numpy())
+    row, col, shape, (minx, miny) = bin_points(x, y, cell_size)
+    cell = row * shape[1] + col
+
+    category_col = "category" if level == 0 else "subcategory"
+    category, _ = pd.factorize(points[category_col])
+    valid = category >= 0
+    order = np.argsort(category[valid], kind="stable")
+    category, cell = category[valid][order], cell[valid][order]
+    bounds = np.searchsorted(category, np.arange(category.max() + 2))
+
+    kernel = decay_kernel(cell_size, bandwidth)
+    count = np.zeros(shape, dtype=np.int64)
+    window = _EntropyAccumulator(shape)
+    decay = _EntropyAccumulator(shape)
+    for lo, hi in zip(bounds[:-1], bounds[1:]):
+        raster = np.bincount(cell[lo:hi], minlength=shape[0] * shape[1]).reshape(shape)
+        count += raster
+        window.add(window_sum(raster, radius))
+        decay.add(fftconvolve(raster, kernel, mode="same"))
+
+    # only cells with amenities in their window
+    rows, cols = np.nonzero(window.total > 0)
+    x0 = minx + cols * cell_size
+    y0 = miny + rows * cell_size
+    surface = gpd.GeoDataFrame(
+        {
+            "count": count[rows, cols],
+            "window_count": window.total[rows, cols].astype(np.int64),
+            "shannon": window.entropy()[rows, cols],
+            "decay_shannon": decay.entropy()[rows, cols],
+        },
+        geometry=shapely.box(x0, y0, x0 + cell_size, y0 + cell_size),
+        crs=GRID_CRS,
+    ).to_crs("EPSG:4326")
+
+    if path:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        surface.to_parquet(path)
+    return surface
+
+
+@timed
+def load_surface(points=None, path=SURFACE_PATH, points_path=POINTS_PATH):
+    """This function is used to load the entropy surface, building it first from the amenity points if it does not exist or is older than the point table
+
+    Args:
+        points (DataFrame, optional): the point table from load_amenity_points, loaded when needed
+        path (str): the surface parquet file
+        points_path (str): the point table the surface is built from
+    """
+
+    if os.path.exists(path) and (
+        not os.path.exists(points_path)
+        or os.path.getmtime(path) >= os.path.getmtime(points_path)
+    ):
+        return gpd.read_parquet(path)
+    points = load_amenity_points(points_path) if points is None else points
+    return build_surface(points, path=path)
@@ -0,0 +1,227 @@
+import functools
+import hashlib
+import json
+import os
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pcsv
+import pyarrow.parquet as pq
+import shapely
+
+# ------- CONSTANTS -------#
+
+EXPORT_FILES = {
+    "gemeenten": "data/gemeenten/gemeenten_stats.parquet",
+    "wijken": "data/wijken/wijken_stats_lisa.parquet",
+    "buurten": "data/buurten/buurten_stats.parquet",
+}
+FORMATS = {
+    "arrow": "application/vnd.apache.arrow.stream",
+    "parquet": "application/vnd.apache.parquet",
+    "csv": "text/csv",
+}
+GEOMETRY = "geometry"
+MUNICIPALITY = "gemeentenaam"
+# the number of rows read, filtered and sent at once
+BATCH_ROWS = 2048
+
+
+class ExportError(ValueError):
+    """A request for columns or filters the dataset does not have"""
+
+
+class _ChunkSink:
+    """A writable file that hands out what was written since the last drain
+
+    tell() keeps counting, so a parquet writer computes the right offsets for its
+    footer.
+    """
+
+    closed = False
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def write(self, data):
+        data = bytes(data)
+        self.chunks.append(data)
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+@functools.lru_cache(maxsize=32)
+def _file_hash(path, mtime_ns, size):
+    sha = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024**2), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def dataset_hash(level):
+    """This function is used to get the hash of the stats file of a level, recomputed only when the file changes"""
+
+    path = EXPORT_FILES[level]
+    stat = os.stat(path)
+    return _file_hash(path, stat.st_mtime_ns, stat.st_size)
+
+
+def parse_query(level, columns=None, gemeenten=None, bbox=None):
+    """This function is used to check the columns and filters of an export against the dataset
+
+    Args:
+        level (str): "gemeenten", "wijken" or "buurten"
+        columns (str, optional): comma separated columns, all by default
+        gemeenten (list, optional): the municipalities to keep, all by default
+        bbox (str, optional): "minx,miny,maxx,maxy" in EPSG:4326, areas that intersect it are kept
+
+    Returns:
+        dict: the columns, municipalities and bounding box of the export
+    """
+
+    if level not in EXPORT_FILES:
+        raise KeyError(level)
+    names = pq.read_schema(EXPORT_FILES[level]).names
+    names = [name for name in names if not name.startswith("__index_level_")]
+    if columns:
+        columns = [col for col in columns.split(",") if col]
+        unknown = [col for col in columns if col not in names]
+        if unknown:
+            raise ExportError(f"Unknown columns: {', '.join(unknown)}")
+    else:
+        columns = names
+
+    if bbox:
+        try:
+            bbox = tuple(float(value) for value in bbox.split(","))
+        except ValueError:
+            raise ExportError("The bbox must be four numbers")
+        if len(bbox) != 4 or bbox[0] > bbox[2] or bbox[1] > bbox[3]:
+            raise ExportError("The bbox must be minx,miny,maxx,maxy")
+    return {
+        "columns": columns,
+        "gemeenten": sorted(gemeenten) if gemeenten else None,
+        "bbox": bbox or None,
+    }
+
+
+def export_etag(level, fmt, query):
+    """This function is used to get the ETag of an export, from the dataset hash and the query"""
+
+    key = json.dumps([dataset_hash(level), fmt, query], sort_keys=True)
+    return hashlib.sha1(key.encode()).hexdigest()
+
+
+def _schema(source, columns, filtered):
+    # keep the geoparquet metadata if the geometry is exported, the pandas metadata
+    # describes columns that may have been left out
+    schema = pa.schema([source.field(col) for col in columns])
+    metadata = {}
+    if GEOMETRY in columns and source.metadata and b"geo" in source.metadata:
+        geo = json.loads(source.metadata[b"geo"])
+        if filtered:
+            # the bounding box of the file no longer describes the rows
+            for column in geo.get("columns", {}).values():
+                column.pop("bbox", None)
+        metadata[b"geo"] = json.dumps(geo).encode()
+    return schema.with_metadata(metadata)
+
+
+def _batches(level, query):
+    # the record batches of the stats file that pass the filters, with the requested
+    # columns
+    columns, gemeenten, bbox = query["columns"], query["gemeenten"], query["bbox"]
+    read = list(columns)
+    if gemeenten and MUNICIPALITY not in read:
+        read.append(MUNICIPALITY)
+    if bbox and GEOMETRY not in read:
+        read.append(GEOMETRY)
+
+    source = pq.ParquetFile(EXPORT_FILES[level])
+    for batch in source.iter_batches(batch_size=BATCH_ROWS, columns=read):
+        mask = None
+        if gemeenten:
+            mask = pc.is_in(batch.column(MUNICIPALITY), value_set=pa.array(gemeenten))
+        if bbox:
+            geoms = shapely.from_wkb(
+                batch.column(GEOMETRY).to_numpy(zero_copy_only=False)
+            )
+            inside = pa.array(shapely.intersects(geoms, shapely.box(*bbox)))
+            mask = inside if mask is None else pc.and_(mask, inside)
+        if mask is not None:
+            batch = batch.filter(mask)
+        if batch.num_rows:
+            yield batch.select(columns)
+
+
+def _csv_batch(batch):
+    # geometries are written as WKT
+    if GEOMETRY not in batch.schema.names:
+        return batch
+    wkt = shapely.to_wkt(
+        shapely.from_wkb(batch.column(GEOMETRY).to_numpy(zero_copy_only=False))
+    )
+    i = batch.schema.get_field_index(GEOMETRY)
+    return batch.set_column(i, GEOMETRY, pa.array(wkt, type=pa.string()))
+
+
+def stream_export(level, fmt, query):
+    """This function is used to stream the stats of a level as Arrow IPC, GeoParquet or CSV
+
+    The file is read, filtered and written one record batch at a time, so only one
+    batch is in memory and the first bytes go out before the last rows are read.
+
+    Args:
+        level (str): "gemeenten", "wijken" or "buurten"
+        fmt (str): "arrow", "parquet" or "csv"
+        query (dict): the columns and filters, from parse_query
+
+    Yields:
+        bytes: the next part of the response
+    """
+
+    assert fmt in FORMATS, f"Format must be one of {list(FORMATS)}"
+    filtered = bool(query["gemeenten"] or query["bbox"])
+    schema = _schema(pq.read_schema(EXPORT_FILES[level]), query["columns"], filtered)
+
+    sink = _ChunkSink()
+    if fmt == "arrow":
+        writer = pa.ipc.new_stream(sink, schema)
+    elif fmt == "parquet":
+        writer = pq.ParquetWriter(sink, schema)
+    else:
+        if GEOMETRY in schema.names:
+            i = schema.get_field_index(GEOMETRY)
+            schema = schema.set(i, pa.field(GEOMETRY, pa.string()))
+        writer = pcsv.CSVWriter(sink, schema)
+
+    for batch in _batches(level, query):
+        if fmt == "csv":
+            batch = _csv_batch(batch)
+        batch = batch.replace_schema_metadata(schema.metadata)
+        if fmt == "parquet":
+            # every batch is a row group
+            writer.write_table(pa.Table.from_batches([batch]))
+        else:
+            writer.write_batch(batch)
+        data = sink.drain()
+        if data:
+            yield data
+    writer.close()
+    yield sink.drain()
@@ -0,0 +1,201 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+import shapely
+
+# ------- CONSTANTS -------#
+
+PERMUTATIONS = 999
+SEED = 12345
+
+# memory budget of one batch of permutations, in bytes
+BATCH_BYTES = 64 * 1024**2
+
+
+def contiguity_weights(gdf, kind="queen"):
+    """This function is used to build the contiguity weights of areas as a sparse matrix
+
+    Neighbours are found with an STRtree. Queen contiguity needs a shared point, rook
+    contiguity a shared edge.
+
+    Args:
+        gdf (GeoDataFrame): the areas, e.g. gemeenten, wijken or buurten
+        kind (str): "queen" or "rook"
+
+    Returns:
+        csr_matrix: binary and symmetric n x n weights, without self neighbours
+    """
+
+    assert kind in ["queen", "rook"], "Kind must be queen or rook"
+    geoms = np.asarray(gdf.geometry.values)
+    tree = shapely.STRtree(geoms)
+    i, j = tree.query(geoms, predicate="intersects")
+
+    # every pair once, without self neighbours
+    keep = i < j
+    i, j = i[keep], j[keep]
+
+    if kind == "rook":
+        # a shared edge has a dimension of at least one, a shared corner of zero
+        shared = shapely.intersection(geoms[i], geoms[j])
+        keep = shapely.get_dimensions(shared) >= 1
+        i, j = i[keep], j[keep]
+
+    n = len(geoms)
+    weights = sp.coo_matrix((np.ones(len(i)), (i, j)), shape=(n, n))
+    return (weights + weights.T).tocsr()
+
+
+def row_standardise(weights):
+    """This function is used to scale the weights of every area so they sum to one, areas without neighbours stay zero"""
+
+    cardinality = np.asarray(weights.sum(axis=1)).ravel()
+    with np.errstate(divide="ignore"):
+        scale = np.where(cardinality > 0, 1 / cardinality, 0)
+    return (sp.diags(scale) @ weights).tocsr()
+
+
+def _standardise(y):
+    z = y - y.mean()
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return z / y.std()
+
+
+def _quadrant(z, lag):
+    # 1 high-high, 2 low-high, 3 low-low, 4 high-low, like esda
+    return np.select(
+        [(z > 0) & (lag > 0), (z <= 0) & (lag > 0), (z <= 0) & (lag <= 0)], [1, 2, 3], 4
+    )
+
+
+def _permute_batch(z, rows, neighbour_weights, permutations, seed):
+    """Conditional randomisation of a batch of areas
+
+    Every permutation draws, for all areas of the batch at once, random neighbours from
+    the other n - 1 areas. The same draw is shifted per area to skip the area itself.
+
+    Returns:
+        array: the simulated local Moran's I, rows x permutations
+    """
+
+    n = len(z)
+    max_k = neighbour_weights.shape[1]
+    rng = np.random.default_rng(seed)
+    # max_k distinct random areas out of the n - 1 other areas, per permutation
+    draws = np.stack(
+        [rng.choice(n - 1, size=max_k, replace=False) for _ in range(permutations)]
+    )
+
+    ids = draws[None, :, :] + (draws[None, :, :] >= rows[:, None, None])
+    lag = (z[ids] * neighbour_weights[:, None, :]).sum(axis=2)
+    return (n - 1) * z[rows, None] * lag / (z * z).sum()
+
+
+def _batches(weights, batch_size):
+    weights = weights.tocsr()
+    cardinality = np.diff(weights.indptr)
+    for start in range(0, weights.shape[0], batch_size):
+        rows = np.arange(start, min(start + batch_size, weights.shape[0]))
+        # the weights of the neighbours of every area, padded with zeros
+        neighbour_weights = np.zeros((len(rows), max(cardinality[rows].max(), 1)))
+        for r, row in enumerate(rows):
+            values = weights.data[weights.indptr[row] : weights.indptr[row + 1]]
+            neighbour_weights[r, : len(values)] = values
+        yield rows, neighbour_weights
+
+
+def local_moran(y, weights, permutations=PERMUTATIONS, seed=SEED, workers=None, executor=None):
+    """This function is used to compute local Moran's I with conditional permutation inference
+
+    Follows esda.Moran_Local: y is standardised, the weights are row standardised and
+    the pseudo p-value is folded, so it is the smaller tail. The permutations are done
+    in vectorised batches, spread over a process pool. Every batch has its own seed
+    derived from seed, so the results do not depend on the number of workers.
+
+    Args:
+        y (array): the values of the areas, without missing values
+        weights (sparse matrix): binary contiguity weights, e.g. from contiguity_weights
+        permutations (int): the number of permutations, 0 to skip the inference
+        seed (int): seed of the random number generator
+        workers (int, optional): the number of processes, 1 runs in this process
+        executor (Executor, optional): an existing pool to run the batches on
+
+    Returns:
+        DataFrame: the local Moran's I (Is), the quadrant (q) and the pseudo p-value (p_sim)
+    """
+
+    y = np.asarray(y, dtype=np.float64)
+    assert not np.isnan(y).any(), "Values must not be missing"
+    weights = row_standardise(weights)
+    n = len(y)
+
+    z = _standardise(y)
+    lag = weights @ z
+    Is = (n - 1) * z * lag / (z * z).sum()
+    result = pd.DataFrame({"Is": Is, "q": _quadrant(z, lag), "p_sim": np.nan})
+    if not permutations:
+        return result
+
+    max_k = max(np.diff(weights.indptr).max(), 1)
+    batch_size = max(1, BATCH_BYTES // (permutations * max_k * 8 * 2))
+    batches = list(_batches(weights, batch_size))
+    seeds = np.random.SeedSequence(seed).spawn(len(batches))
+    args = [
+        (z, rows, neighbour_weights, permutations, s)
+        for (rows, neighbour_weights), s in zip(batches, seeds)
+    ]
+
+    if executor is not None:
+        simulated = executor.map(_permute_batch, *zip(*args))
+    elif workers == 1:
+        simulated = (_permute_batch(*a) for a in args)
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            simulated = list(pool.map(_permute_batch, *zip(*args)))
+
+    larger = np.concatenate(
+        [(sim >= Is[rows, None]).sum(axis=1) for (rows, _), sim in zip(batches, simulated)]
+    )
+    low_extreme = (permutations - larger) < larger
+    larger[low_extreme] = permutations - larger[low_extreme]
+    p_sim = (larger + 1.0) / (permutations + 1.0)
+
+    # areas without neighbours have no inference
+    p_sim[np.diff(weights.indptr) == 0] = np.nan
+    result["p_sim"] = p_sim
+    return result
+
+
+def lisa_columns(
+    gdf, columns, kind="queen", permutations=PERMUTATIONS, seed=SEED, workers=None
+):
+    """This function is used to compute the LISA statistics of several columns, e.g. all entropy columns
+
+    The weights are built once and one process pool is shared by all columns.
+
+    Args:
+        gdf (GeoDataFrame): the areas with the columns
+        columns (list): the columns to compute the statistics for
+        kind (str): "queen" or "rook" contiguity
+
+    Returns:
+        DataFrame: the columns <column>_Is, <column>_q and <column>_p_sim, with the index of gdf
+    """
+
+    weights = contiguity_weights(gdf, kind=kind)
+    results = {}
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+        for col in columns:
+            lisa = local_moran(
+                gdf[col].to_numpy(),
+                weights,
+                permutations=permutations,
+                seed=seed,
+                executor=executor,
+            )
+            for stat in lisa.columns:
+                results[f"{col}_{stat}"] = lisa[stat].to_numpy()
+    return pd.DataFrame(results, index=gdf.index)
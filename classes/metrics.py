@@ -0,0 +1,207 @@
+import bisect
+import functools
+import threading
+import time
+
+from . import statscache
+
+# ------- CONSTANTS -------#
+
+# upper bounds of the histogram buckets, in seconds and bytes
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+SIZE_BUCKETS = tuple(1024 * 4**i for i in range(8))  # 1 KiB up to 16 MiB
+
+# name, type, help and statistic of the cache metrics
+CACHE_METRICS = [
+    ("urban_cache_hits_total", "counter", "Cache hits", "hits"),
+    ("urban_cache_misses_total", "counter", "Cache misses", "misses"),
+    ("urban_cache_hit_rate", "gauge", "Cache hit rate", "hit_rate"),
+    ("urban_cache_bytes", "gauge", "Size of the cached values", "bytes"),
+]
+
+# all metrics by name, in the order they were created
+METRICS = {}
+
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(key, extra=()):
+    items = list(key) + list(extra)
+    if not items:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in items) + "}"
+
+
+def _format_value(value):
+    return repr(float(value)) if value != float("inf") else "+Inf"
+
+
+class Histogram:
+    """Prometheus style histogram, with a count, sum and cumulative buckets per set of labels"""
+
+    kind = "histogram"
+
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.series = {}
+        self._lock = threading.Lock()
+        METRICS[name] = self
+
+    def observe(self, value, **labels):
+        key = _label_key(labels)
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self.series.get(key)
+            if series is None:
+                series = self.series[key] = {
+                    "buckets": [0] * (len(self.buckets) + 1),
+                    "sum": 0.0,
+                    "count": 0,
+                }
+            series["buckets"][i] += 1
+            series["sum"] += value
+            series["count"] += 1
+
+    def samples(self):
+        with self._lock:
+            series = {
+                key: (list(s["buckets"]), s["sum"], s["count"])
+                for key, s in self.series.items()
+            }
+        for key, (buckets, total, count) in series.items():
+            cumulative = 0
+            for bound, n in zip(self.buckets + (float("inf"),), buckets):
+                cumulative += n
+                yield f"{self.name}_bucket", key, (("le", _format_value(bound)),), cumulative
+            yield f"{self.name}_sum", key, (), total
+            yield f"{self.name}_count", key, (), count
+
+
+class Counter:
+    """Prometheus style counter per set of labels"""
+
+    kind = "counter"
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.series = {}
+        self._lock = threading.Lock()
+        METRICS[name] = self
+
+    def inc(self, amount=1, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            self.series[key] = self.series.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            series = dict(self.series)
+        for key, value in series.items():
+            yield self.name, key, (), value
+
+
+class Gauge(Counter):
+    """Prometheus style gauge per set of labels"""
+
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        with self._lock:
+            self.series[_label_key(labels)] = value
+
+
+callback_seconds = Histogram(
+    "urban_callback_seconds", "Time spent in a Dash callback, including serialisation"
+)
+callback_response_bytes = Histogram(
+    "urban_callback_response_bytes",
+    "Size of the serialised response of a Dash callback",
+    buckets=SIZE_BUCKETS,
+)
+callback_errors = Counter(
+    "urban_callback_errors_total", "Dash callbacks that raised, by exception type"
+)
+load_seconds = Histogram("urban_load_seconds", "Time spent in a data loading function")
+startup_seconds = Gauge("urban_startup_seconds", "Time spent in a phase of the startup")
+
+
+def timed(func):
+    """This function is used as decorator to record the duration of a data loading function in urban_load_seconds"""
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            load_seconds.observe(time.perf_counter() - start, function=func.__name__)
+
+    return wrapper
+
+
+def _instrument_callback(func):
+    name = func.__name__
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            response = func(*args, **kwargs)
+        except Exception as e:
+            # PreventUpdate and friends are control flow, but still worth counting
+            callback_errors.inc(callback=name, exception=type(e).__name__)
+            raise
+        finally:
+            callback_seconds.observe(time.perf_counter() - start, callback=name)
+        if isinstance(response, (str, bytes)):
+            callback_response_bytes.observe(len(response), callback=name)
+        return response
+
+    return wrapper
+
+
+def instrument_callbacks(app):
+    """This function is used to record the latency and response size of every callback of a Dash app
+
+    Must be called after all callbacks are registered. The callbacks are wrapped where
+    Dash stores them, so the serialisation of the response is included.
+
+    Args:
+        app (Dash): the app with its callbacks registered
+    """
+
+    for spec in app.callback_map.values():
+        if not getattr(spec["callback"], "_instrumented", False):
+            spec["callback"] = _instrument_callback(spec["callback"])
+            spec["callback"]._instrumented = True
+
+
+def render():
+    """This function is used to render all metrics and cache statistics in the Prometheus text format"""
+
+    lines = []
+    for metric in METRICS.values():
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        for name, key, extra, value in metric.samples():
+            lines.append(f"{name}{_format_labels(key, extra)} {_format_value(value)}")
+
+    caches = statscache.all_stats()
+    for name, kind, help, stat in CACHE_METRICS:
+        lines.append(f"# HELP {name} {help}")
+        lines.append(f"# TYPE {name} {kind}")
+        for cache, stats in caches.items():
+            if stat in stats:
+                key = (("cache", cache),)
+                lines.append(f"{name}{_format_labels(key)} {_format_value(stats[stat])}")
+
+    return "\n".join(lines) + "\n"
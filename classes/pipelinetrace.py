@@ -0,0 +1,188 @@
+import json
+import os
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+import pandas as pd
+
+# the active trace, None when tracing is off
+_active = None
+# the URBAN_PIPELINE_TRACE environment variable turns on tracing, unless overruled
+_from_env = True
+
+
+class PipelineTrace:
+    """Writes a JSON-lines record with the cost of every stage of the entropy pipeline
+
+    A record holds the area, the stage, the wall and cpu time, the peak of the memory
+    allocated during the stage and the number of rows after the stage. Several
+    processes can append to the same file, every record is written with a single call.
+
+    tracemalloc keeps one peak for the whole process, so a peak is only recorded for a
+    stage that ran alone. A stage that overlapped with another one, nested or in
+    another thread, records the growth of the memory allocated by the process instead
+    ("memory" is "growth" rather than "peak" in its record).
+    """
+
+    def __init__(self, path, memory=True):
+        """
+        Args:
+            path (str): the JSON-lines file the records are appended to
+            memory (bool): trace the memory allocations, this slows python code down
+        """
+
+        self.path = path
+        self.memory = memory
+        self._lock = threading.Lock()
+        # whether another stage ran during every running stage, by stage token
+        self._running = {}
+        # only stop tracemalloc if it was started here
+        self._started = memory and not tracemalloc.is_tracing()
+        if self._started:
+            tracemalloc.start()
+        folder = os.path.dirname(path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+
+    def _memory_start(self, token):
+        if not self.memory:
+            return None
+        if self._running:
+            # the running stages and this one share the peak
+            for other in self._running:
+                self._running[other] = True
+            self._running[token] = True
+        else:
+            self._running[token] = False
+            # reset_peak is only available from python 3.9
+            if hasattr(tracemalloc, "reset_peak"):
+                tracemalloc.reset_peak()
+        return tracemalloc.get_traced_memory()[0]
+
+    def _memory_end(self, token, start, record):
+        if start is None:
+            return None
+        overlapped = self._running.pop(token)
+        current, peak = tracemalloc.get_traced_memory()
+        if hasattr(tracemalloc, "reset_peak") and not overlapped:
+            record["memory"] = "peak"
+            return max(peak - start, 0)
+        # the growth during the stage is the best estimate
+        record["memory"] = "growth"
+        return max(current - start, 0)
+
+    def close(self):
+        """This function is used to stop tracing the memory, if this trace started it"""
+
+        if self._started:
+            tracemalloc.stop()
+            self._started = False
+
+    @contextmanager
+    def stage(self, area_id, name):
+        """This function is used to time a stage, the yielded record can be given a row count
+
+        Args:
+            area_id (str): the area the pipeline runs for
+            name (str): the name of the stage
+        """
+
+        record = {"area": area_id, "stage": name, "rows": None}
+        token = object()
+        with self._lock:
+            memory = self._memory_start(token)
+        wall, cpu = time.perf_counter(), time.thread_time()
+        try:
+            yield record
+        finally:
+            record["wall_s"] = time.perf_counter() - wall
+            record["cpu_s"] = time.thread_time() - cpu
+            with self._lock:
+                record["peak_bytes"] = self._memory_end(token, memory, record)
+            record["pid"] = os.getpid()
+            record["timestamp"] = time.time()
+            self.write(record)
+
+    def write(self, record):
+        line = json.dumps(record, default=str) + "\n"
+        with self._lock, open(self.path, "a") as f:
+            f.write(line)
+
+
+class _NoTrace:
+    @contextmanager
+    def stage(self, area_id, name):
+        yield {}
+
+
+NO_TRACE = _NoTrace()
+
+
+def enable(path, memory=True):
+    """This function is used to turn on the tracing of the entropy pipeline
+
+    Args:
+        path (str): the JSON-lines file the records are appended to
+        memory (bool): trace the memory allocations
+    """
+
+    global _active, _from_env
+    if _active is not None:
+        _active.close()
+    _active = PipelineTrace(path, memory=memory)
+    _from_env = False
+    return _active
+
+
+def disable():
+    global _active, _from_env
+    _from_env = False
+    if _active is not None:
+        _active.close()
+    _active = None
+
+
+def current():
+    """This function is used to get the active trace, or a trace that records nothing"""
+
+    if _from_env and os.environ.get("URBAN_PIPELINE_TRACE"):
+        enable(os.environ["URBAN_PIPELINE_TRACE"])
+    return _active or NO_TRACE
+
+
+def load_trace(path):
+    """This function is used to read a trace file into a DataFrame"""
+
+    return pd.read_json(path, lines=True)
+
+
+def summarise(path, top=10):
+    """This function is used to find the most expensive stages and areas of a trace
+
+    Args:
+        path (str): the trace file
+        top (int): the number of areas to return
+
+    Returns:
+        tuple: the totals per stage and the slowest areas, as DataFrames
+    """
+
+    trace = load_trace(path)
+    per_stage = (
+        trace.groupby("stage")
+        .agg(
+            wall_s=("wall_s", "sum"),
+            cpu_s=("cpu_s", "sum"),
+            max_peak_bytes=("peak_bytes", "max"),
+            calls=("wall_s", "size"),
+        )
+        .sort_values("wall_s", ascending=False)
+    )
+    per_area = trace.pivot_table(
+        index="area", columns="stage", values="wall_s", aggfunc="sum"
+    )
+    per_area["total"] = per_area.sum(axis=1)
+    per_area = per_area.sort_values("total", ascending=False).head(top)
+    return per_stage, per_area
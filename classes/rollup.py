@@ -0,0 +1,349 @@
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+from scipy import sparse
+from scipy.stats import entropy
+
+from .amenitypoints import load_amenity_points
+from .countstore import CODE_COLS, COUNT_COLUMN, L0_CATEGORIES, N_FILTERS
+from .entropycalculator import CATEGORISATION, getfilter
+from .metrics import timed
+
+# ------- CONSTANTS -------#
+
+STATS_FILES = {
+    "buurten": "data/buurten/buurten_stats.parquet",
+    "wijken": "data/wijken/wijken_stats_lisa.parquet",
+    "gemeenten": "data/gemeenten/gemeenten_stats.parquet",
+}
+# finest first, every area lies in one area of the next level
+LEVELS = ["buurten", "wijken", "gemeenten"]
+# the column that links an area to the area of the next level it lies in, it is in
+# the stats of both levels (the gemeenten are known by name in the wijken stats)
+PARENT_KEYS = {"buurten": "wijkcode", "wijken": "gemeentenaam"}
+
+
+class AreaHierarchy:
+    """The buurten of every wijk and every gemeente, as sparse membership matrices
+
+    Row i of the matrix of a level has a 1 for every buurt of area i of that level, so
+    the counts of the areas of any level are one sparse product with the counts of
+    the buurten.
+    """
+
+    def __init__(self, codes, parents):
+        """
+        Args:
+            codes (dict): the area codes of every level, in the order of its stats
+            parents (dict): for every level but gemeenten, the position of the area of
+                the next level every area lies in
+        """
+
+        self.codes = {level: np.asarray(codes[level]).astype(str) for level in LEVELS}
+        self.parents = {
+            level: np.asarray(parents[level], dtype=np.int64) for level in LEVELS[:-1]
+        }
+
+        # one step up, areas of the next level x areas
+        self.steps = {}
+        for child, parent in zip(LEVELS[:-1], LEVELS[1:]):
+            n = len(self.codes[child])
+            self.steps[child] = sparse.csr_matrix(
+                (np.ones(n, dtype=np.int64), (self.parents[child], np.arange(n))),
+                shape=(len(self.codes[parent]), n),
+            )
+
+        # from the buurten, areas x buurten
+        n = len(self.codes[LEVELS[0]])
+        matrix = sparse.identity(n, dtype=np.int64, format="csr")
+        self.matrices = {LEVELS[0]: matrix}
+        for child, parent in zip(LEVELS[:-1], LEVELS[1:]):
+            matrix = self.steps[child] @ matrix
+            self.matrices[parent] = matrix
+
+    @classmethod
+    def from_stats(cls, files=STATS_FILES):
+        """This function is used to build the hierarchy from the stats of the three levels"""
+
+        codes, parents, stats = {}, {}, {}
+        for level in LEVELS:
+            columns = [CODE_COLS[level]]
+            for key in [PARENT_KEYS.get(level), PARENT_KEYS.get(_child(level))]:
+                if key and key not in columns:
+                    columns.append(key)
+            stats[level] = pd.read_parquet(files[level], columns=columns)
+            codes[level] = stats[level][CODE_COLS[level]].to_numpy()
+
+        for child, parent in zip(LEVELS[:-1], LEVELS[1:]):
+            key = PARENT_KEYS[child]
+            index = pd.Index(stats[parent][key])
+            assert index.is_unique, f"The {key} of the {parent} is not unique"
+            position = index.get_indexer(stats[child][key])
+            missing = stats[child].loc[position < 0, key].unique()
+            message = f"{len(missing)} {key} of the {child} are not in the {parent}"
+            assert len(missing) == 0, f"{message}: {missing[:5]}"
+            parents[child] = position
+
+        return cls(codes, parents)
+
+    def rollup(self, counts, level):
+        """This function is used to sum counts of the buurten into the areas of a level
+
+        Args:
+            counts (DataFrame): a row per buurt, in the order of the hierarchy
+            level (str): "buurten", "wijken" or "gemeenten"
+
+        Returns:
+            DataFrame: a row per area of the level, by area code
+        """
+
+        assert len(counts) == len(self.codes[LEVELS[0]]), "Counts are not per buurt"
+        values = self.matrices[level] @ counts.to_numpy()
+        return pd.DataFrame(
+            values,
+            index=pd.Index(self.codes[level], name=CODE_COLS[level]),
+            columns=counts.columns,
+        )
+
+    def areas_of(self, buurt, level):
+        """This function is used to get the area of a level of buurten, -1 stays -1
+
+        With the buurt of every amenity from assign_points, the amenities of a wijk or
+        gemeente (for its spatial entropies) are found without a polygon test.
+        """
+
+        area = np.asarray(buurt, dtype=np.int64)
+        outside = area < 0
+        for child in LEVELS[: LEVELS.index(level)]:
+            area = self.parents[child][np.where(outside, 0, area)]
+        return np.where(outside, -1, area)
+
+
+def _child(level):
+    # the level below, None for the buurten
+    i = LEVELS.index(level)
+    return LEVELS[i - 1] if i > 0 else None
+
+
+def category_groups():
+    """This function is used to get the categories of every (level, filter) group, in the order of the categorisation"""
+
+    pairs = CATEGORISATION[["L0 category", "L1 category"]].drop_duplicates()
+    groups = {}
+    for filter_i in range(N_FILTERS):
+        L0_blacklist, L1_blacklist = getfilter(filter_i)
+        groups[(0, filter_i)] = [c for c in L0_CATEGORIES if c not in L0_blacklist]
+        keep = ~pairs["L0 category"].isin(L0_blacklist)
+        for key, value in L1_blacklist.items():
+            keep &= ~((pairs["L0 category"] == key) & pairs["L1 category"].isin(value))
+        groups[(1, filter_i)] = list(pairs.loc[keep, "L1 category"].unique())
+    return groups
+
+
+def _filter_mask(L0, L1, filter_i):
+    # the amenities that pass a filter, like calculate_entropies
+    L0_blacklist, L1_blacklist = getfilter(filter_i)
+    keep = ~np.isin(L0, L0_blacklist)
+    for key, value in L1_blacklist.items():
+        keep &= ~((L0 == key) & np.isin(L1, value))
+    return keep
+
+
+def assign_points(points, areas):
+    """This function is used to find the area every point lies within
+
+    A point in overlapping areas is given to the first, so no point is counted twice.
+
+    Args:
+        points (DataFrame): the points, with x and y columns in EPSG:4326
+        areas (array): the polygons of the areas, in EPSG:4326
+
+    Returns:
+        array: the position of the area of every point, -1 for points outside all areas
+    """
+
+    geoms = shapely.points(points["x"].to_numpy(), points["y"].to_numpy())
+    point_i, area_i = shapely.STRtree(areas).query(geoms, predicate="within")
+    order = np.lexsort((area_i, point_i))
+    point_i, area_i = point_i[order], area_i[order]
+    first = np.ones(len(point_i), dtype=bool)
+    first[1:] = point_i[1:] != point_i[:-1]
+
+    area = np.full(len(points), -1, dtype=np.int64)
+    area[point_i[first]] = area_i[first]
+    return area
+
+
+def _read_areas(level):
+    # the areas of a level in EPSG:4326, in the order of the stats
+    areas = gpd.read_parquet(STATS_FILES[level], columns=[CODE_COLS[level], "geometry"])
+    return areas.to_crs("EPSG:4326")
+
+
+@timed
+def count_areas(points, areas, code_col=CODE_COLS["buurten"], groups=None):
+    """This function is used to count the amenities of every area, for every (level, filter) group
+
+    Args:
+        points (DataFrame): the amenity points, see load_amenity_points
+        areas (GeoDataFrame): the areas, the buurten for a rollup, in EPSG:4326
+        code_col (str): the column with the area code
+        groups (dict, optional): the categories of every group, see category_groups
+
+    Returns:
+        tuple: the wide counts of the areas, in their order with columns
+            L<level>_<filter>_count_<category>, and the area of every point
+    """
+
+    groups = category_groups() if groups is None else groups
+    area = assign_points(points, areas.geometry.values)
+    n = len(areas)
+    labels = {
+        0: points["category"].to_numpy(dtype=object),
+        1: points["subcategory"].to_numpy(dtype=object),
+    }
+
+    columns = {}
+    for (level, filter_i), categories in groups.items():
+        category = pd.Index(categories).get_indexer(labels[level])
+        keep = (
+            (area >= 0)
+            & (category >= 0)
+            & _filter_mask(labels[0], labels[1], filter_i)
+        )
+        cell = area[keep] * len(categories) + category[keep]
+        table = np.bincount(cell, minlength=n * len(categories)).reshape(
+            n, len(categories)
+        )
+        for i, name in enumerate(categories):
+            columns[f"L{level}_{filter_i}_count_{name}"] = table[:, i]
+
+    counts = pd.DataFrame(
+        columns, index=pd.Index(areas[code_col].to_numpy(), name=code_col)
+    )
+    return counts, area
+
+
+def shannon_entropies(counts):
+    """This function is used to compute the Shannon entropy (base 2) of every area and (level, filter) group
+
+    Areas without amenities in a group get 0, like calculate_entropies.
+
+    Args:
+        counts (DataFrame): wide counts with columns L<level>_<filter>_count_<category>
+
+    Returns:
+        DataFrame: the columns L<level>_shannon_<filter>, by the index of counts
+    """
+
+    groups = {}
+    for col in counts.columns:
+        match = COUNT_COLUMN.match(col)
+        if match:
+            name = f"L{match['level']}_shannon_{match['filter']}"
+            groups.setdefault(name, []).append(col)
+
+    entropies = {}
+    for name, cols in groups.items():
+        values = counts[cols].to_numpy(dtype=np.float64)
+        with np.errstate(invalid="ignore"):
+            entropies[name] = np.nan_to_num(entropy(values, base=2, axis=1))
+    return pd.DataFrame(entropies, index=counts.index)
+
+
+def verify_rollups(counts, points, buurt, hierarchy, groups=None):
+    """This function is used to check the rolled up counts against the polygons of the wijken and gemeenten
+
+    The sums of the rollup agree by construction, what can differ is the geometry:
+    a wijk or gemeente that its buurten do not cover, or a buurt whose wijkcode
+    does not match the wijk it lies in. The amenities are assigned to the areas of
+    every coarser level and counted directly, and compared with the rollup.
+
+    Args:
+        counts (dict): the wide counts of every level, from build_rollups
+        points (DataFrame): the amenity points that were counted
+        buurt (array): the buurt of every point, from count_areas
+        hierarchy (AreaHierarchy): the hierarchy the counts were rolled up with
+        groups (dict, optional): the categories of every group, see category_groups
+
+    Returns:
+        DataFrame: per level the number of areas whose counts differ, the total
+            difference of the counts, the amenities outside the buurten but within
+            an area of the level, and the amenities whose buurt lies in another area
+    """
+
+    report = []
+    for level in LEVELS[1:]:
+        areas = _read_areas(level)
+        code_col = CODE_COLS[level]
+        assert np.array_equal(
+            areas[code_col].to_numpy().astype(str), hierarchy.codes[level]
+        ), f"The {level} are not in the order of the hierarchy"
+
+        direct, area = count_areas(points, areas, code_col, groups=groups)
+        difference = direct.to_numpy() - counts[level][direct.columns].to_numpy()
+        rolled = hierarchy.areas_of(buurt, level)
+        report.append(
+            {
+                "level": level,
+                "areas": int((difference != 0).any(axis=1).sum()),
+                "difference": int(np.abs(difference).sum()),
+                "outside_buurten": int(((buurt < 0) & (area >= 0)).sum()),
+                "other_area": int(((buurt >= 0) & (rolled != area)).sum()),
+            }
+        )
+    return pd.DataFrame(report).set_index("level")
+
+
+@timed
+def build_rollups(points=None, hierarchy=None, write=False, verify=True):
+    """This function is used to count the amenities once per buurt and roll them up to wijken and gemeenten
+
+    The amenities are assigned to the buurten with one polygon pass, the counts of
+    the wijken and gemeenten are sparse sums of those of their buurten and the Shannon
+    entropies of every level are computed from its counts. Only the spatial entropies
+    still need the amenities of the coarser levels, see AreaHierarchy.areas_of.
+
+    Args:
+        points (DataFrame, optional): the amenity points, load_amenity_points by default
+        hierarchy (AreaHierarchy, optional): the hierarchy, from the stats by default
+        write (bool): write the counts to data/<level>/<level>_counts.parquet and the
+            Shannon entropies to the stats
+        verify (bool): compare the rollup with the polygons of the coarser levels, see
+            verify_rollups
+
+    Returns:
+        tuple: the wide counts and the Shannon entropies of every level, by area code
+    """
+
+    hierarchy = AreaHierarchy.from_stats() if hierarchy is None else hierarchy
+    points = load_amenity_points() if points is None else points
+    buurten = _read_areas("buurten")
+    assert np.array_equal(
+        buurten[CODE_COLS["buurten"]].to_numpy().astype(str), hierarchy.codes["buurten"]
+    ), "The buurten are not in the order of the hierarchy"
+
+    groups = category_groups()
+    buurt_counts, buurt = count_areas(points, buurten, groups=groups)
+    print(f"{(buurt < 0).sum()} of {len(buurt)} amenities lie outside the buurten")
+
+    counts, entropies = {}, {}
+    for level in LEVELS:
+        counts[level] = hierarchy.rollup(buurt_counts, level)
+        entropies[level] = shannon_entropies(counts[level])
+    if verify:
+        report = verify_rollups(counts, points, buurt, hierarchy, groups=groups)
+        print(f"Rollup against the polygons of the coarser levels:\n{report}")
+
+    if write:
+        for level in LEVELS:
+            counts[level].reset_index().to_parquet(
+                f"data/{level}/{level}_counts.parquet", index=False
+            )
+            stats = gpd.read_parquet(STATS_FILES[level])
+            # the stats are in the order of the hierarchy
+            for col in entropies[level].columns:
+                stats[col] = entropies[level][col].to_numpy()
+            stats.to_parquet(STATS_FILES[level])
+    return counts, entropies
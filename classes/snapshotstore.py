@@ -0,0 +1,332 @@
+import datetime
+import glob
+import json
+import os
+
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+import shapely
+
+from .amenitypoints import AMENITY_FOLDER
+from .entropycalculator import getfilter
+from .metrics import timed
+from .whatif import IncrementalEntropy
+
+# ------- CONSTANTS -------#
+
+SNAPSHOT_FOLDER = "data/snapshots"
+MANIFEST = "manifest.json"
+
+# the columns of a snapshot besides the key, an amenity changed if one of them changed
+VALUE_COLUMNS = ["gemeentenaam", "x", "y", "L0_category", "L1_category"]
+ENTROPY_TYPES = [
+    "L0_shannon",
+    "L1_shannon",
+    "L0_altieri",
+    "L1_altieri",
+    "L0_leibovici",
+    "L1_leibovici",
+]
+
+# OSM ids are only unique per element type
+OSM_TYPES = {"node": 0, "way": 1, "relation": 2}
+
+# a snapshot is stored as a new base when its delta would have more rows than this
+# share of the base
+REBASE_FRACTION = 0.3
+
+
+def amenity_keys(frame):
+    """This function is used to get the key of every amenity, from its OSM type and id
+
+    Amenities harvested without their id get a key hashed from their type, location and
+    categories instead, so a moved or recategorised amenity is then a deletion plus an
+    insertion rather than a change.
+
+    Args:
+        frame (DataFrame): the amenities, with the column type and either id or the value columns
+    """
+
+    types = frame["type"].map(OSM_TYPES).fillna(3).to_numpy(dtype=np.int64)
+    if "id" in frame.columns:
+        return frame["id"].to_numpy(dtype=np.int64) * 4 + types
+    hashed = pd.util.hash_pandas_object(
+        frame[["type"] + VALUE_COLUMNS], index=False
+    ).to_numpy()
+    # negative, so they never collide with OSM keys
+    return -(hashed >> np.uint64(1)).astype(np.int64) - 1
+
+
+def read_amenities(folder=AMENITY_FOLDER):
+    """This function is used to read the harvested amenities of all municipalities as a snapshot
+
+    Returns:
+        DataFrame: the amenities indexed by key, with the value columns
+    """
+
+    frames = []
+    for file in sorted(glob.glob(os.path.join(folder, "amenities_*.parquet"))):
+        gm_name = os.path.basename(file)[len("amenities_") : -len(".parquet")]
+        columns = ["type", "geometry", "L0_category", "L1_category"]
+        if "id" in pq.read_schema(file).names:
+            columns.append("id")
+        df = pd.read_parquet(file, columns=columns)
+        coords = shapely.get_coordinates(shapely.from_wkb(df["geometry"].values))
+        df = df.drop(columns="geometry").assign(
+            gemeentenaam=gm_name, x=coords[:, 0], y=coords[:, 1]
+        )
+        frames.append(df)
+
+    amenities = pd.concat(frames, ignore_index=True)
+    amenities.index = pd.Index(amenity_keys(amenities), name="key")
+    duplicated = amenities.index.duplicated()
+    if duplicated.any():
+        # an amenity on the border of two municipalities, or identical amenities
+        print(f"{duplicated.sum()} duplicate amenities dropped")
+    return _compact(amenities[~duplicated])
+
+
+def _compact(frame):
+    frame = frame[VALUE_COLUMNS].copy()
+    for col in ["gemeentenaam", "L0_category", "L1_category"]:
+        frame[col] = frame[col].astype(str).astype("category")
+    return frame.sort_index()
+
+
+def diff(old, new):
+    """This function is used to compare two snapshots
+
+    Args:
+        old, new (DataFrame): snapshots indexed by key
+
+    Returns:
+        tuple: the keys of the inserted, deleted and changed amenities
+    """
+
+    inserted = new.index.difference(old.index)
+    deleted = old.index.difference(new.index)
+    common = old.index.intersection(new.index)
+    a, b = old.reindex(common), new.reindex(common)
+    changed = np.zeros(len(common), dtype=bool)
+    for col in VALUE_COLUMNS:
+        if col in ["x", "y"]:
+            changed |= a[col].to_numpy() != b[col].to_numpy()
+        else:
+            changed |= a[col].astype(str).to_numpy() != b[col].astype(str).to_numpy()
+    return inserted, deleted, common[changed]
+
+
+def _keep(frame, filter_i):
+    # the amenities that pass the filter, like calculate_entropies
+    L0_BLACKLIST, L1_BLACKLIST = getfilter(filter_i)
+    keep = ~frame["L0_category"].isin(L0_BLACKLIST)
+    for key, value in L1_BLACKLIST.items():
+        keep &= ~((frame["L0_category"] == key) & frame["L1_category"].isin(value))
+    return keep.to_numpy()
+
+
+def _assign(tree, frame):
+    # the area every amenity lies in, -1 outside all areas
+    area = np.full(len(frame), -1, dtype=np.int64)
+    i, j = tree.query(
+        shapely.points(frame["x"].to_numpy(), frame["y"].to_numpy()), predicate="within"
+    )
+    area[i] = j
+    return area
+
+
+def _entropies(frame):
+    if frame.empty:
+        return [0.0] * len(ENTROPY_TYPES)
+    entropies = IncrementalEntropy(
+        frame[["x", "y"]].to_numpy(),
+        frame["L0_category"].to_numpy(),
+        frame["L1_category"].to_numpy(),
+    ).entropies()
+    return [entropies[entropy_type] for entropy_type in ENTROPY_TYPES]
+
+
+class SnapshotStore:
+    """Versioned amenity snapshots, stored as deltas against a base
+
+    Every refresh of the amenities is recorded as the rows that were inserted, deleted
+    or changed, keyed by OSM id, against the latest base. A snapshot is then one base
+    and at most one delta, so it is rebuilt with a single merge. When the delta grows
+    too large compared to the base, the snapshot becomes the new base.
+
+    Layout of the folder: manifest.json lists the snapshots in order, with their base
+    and delta file. Bases hold the value columns, deltas also a deleted column (the
+    deleted rows keep their old values).
+    """
+
+    def __init__(self, folder=SNAPSHOT_FOLDER):
+        self.folder = folder
+        path = os.path.join(folder, MANIFEST)
+        if os.path.exists(path):
+            with open(path) as f:
+                self.manifest = json.load(f)
+        else:
+            self.manifest = {"snapshots": []}
+        # the last base that was read, consecutive snapshots mostly share it
+        self._cached_base = (None, None)
+
+    @property
+    def names(self):
+        return [entry["name"] for entry in self.manifest["snapshots"]]
+
+    def _entry(self, name):
+        assert name in self.names, f"Snapshot {name} does not exist"
+        return self.manifest["snapshots"][self.names.index(name)]
+
+    def _base(self, file):
+        if self._cached_base[0] != file:
+            self._cached_base = (file, pd.read_parquet(os.path.join(self.folder, file)))
+        return self._cached_base[1]
+
+    @timed
+    def record(self, name=None, amenities=None, folder=AMENITY_FOLDER):
+        """This function is used to record the current amenities as a new snapshot
+
+        Args:
+            name (str, optional): the name of the snapshot, the date by default
+            amenities (DataFrame, optional): the amenities indexed by key, read from folder by default
+            folder (str): the folder with the amenities_<gemeente>.parquet files
+
+        Returns:
+            dict: the manifest entry, with the numbers of inserted, deleted and changed
+                amenities since the previous snapshot
+        """
+
+        name = name or datetime.date.today().isoformat()
+        assert name not in self.names, f"Snapshot {name} already exists"
+        amenities = read_amenities(folder) if amenities is None else _compact(amenities)
+        position = len(self.names)
+        entry = {
+            "name": name,
+            "created": datetime.datetime.now().isoformat(timespec="seconds"),
+            "rows": len(amenities),
+            "base": None,
+            "delta": None,
+        }
+
+        os.makedirs(self.folder, exist_ok=True)
+        if position:
+            previous = self.snapshot(self.names[-1])
+            inserted, deleted, changed = diff(previous, amenities)
+            entry.update(
+                inserted=len(inserted), deleted=len(deleted), changed=len(changed)
+            )
+
+            file = self.manifest["snapshots"][-1]["base"]
+            base = self._base(file)
+            inserted, deleted, changed = diff(base, amenities)
+            rows = len(inserted) + len(deleted) + len(changed)
+            if rows <= REBASE_FRACTION * len(base):
+                delta = pd.concat(
+                    [
+                        amenities.reindex(inserted.union(changed)).assign(
+                            deleted=False
+                        ),
+                        base.reindex(deleted).assign(deleted=True),
+                    ]
+                )
+                entry.update(base=file, delta=f"delta_{position:04d}.parquet")
+                _compact(delta).assign(deleted=delta["deleted"]).to_parquet(
+                    os.path.join(self.folder, entry["delta"])
+                )
+
+        if entry["base"] is None:
+            entry["base"] = f"base_{position:04d}.parquet"
+            amenities.to_parquet(os.path.join(self.folder, entry["base"]))
+            self._cached_base = (entry["base"], amenities)
+
+        self.manifest["snapshots"].append(entry)
+        with open(os.path.join(self.folder, MANIFEST), "w") as f:
+            json.dump(self.manifest, f, indent=2)
+        return entry
+
+    def snapshot(self, name):
+        """This function is used to rebuild a snapshot from its base and delta
+
+        Returns:
+            DataFrame: the amenities indexed by key, with the value columns
+        """
+
+        entry = self._entry(name)
+        base = self._base(entry["base"])
+        if entry["delta"] is None:
+            return base
+        delta = pd.read_parquet(os.path.join(self.folder, entry["delta"]))
+        return _compact(
+            pd.concat(
+                [
+                    base.reindex(base.index.difference(delta.index)),
+                    delta[~delta["deleted"]],
+                ]
+            )
+        )
+
+    @timed
+    def entropy_series(self, areas, code_col, filter_i=1, names=None):
+        """This function is used to compute the entropies of every area in every snapshot
+
+        Only the areas with amenities that were inserted, deleted or changed since the
+        previous snapshot are recomputed, the others keep their entropies. The spatial
+        entropies look at all pairs of amenities of an area, so this is meant for
+        wijken and buurten.
+
+        Args:
+            areas (GeoDataFrame): the areas, in EPSG:4326
+            code_col (str): the column with the area code
+            filter_i (int): the filter number, see getfilter
+            names (list, optional): the snapshots, all by default
+
+        Returns:
+            DataFrame: per snapshot and area the number of amenities, the six entropies
+                and whether they were recomputed
+        """
+
+        names = self.names if names is None else names
+        tree = shapely.STRtree(areas.geometry.values)
+        codes = areas[code_col].to_numpy()
+        values = np.zeros((len(areas), len(ENTROPY_TYPES)))
+        counts = np.zeros(len(areas), dtype=np.int64)
+
+        frames = []
+        previous = None
+        for name in names:
+            current = self.snapshot(name).copy()
+            if previous is None:
+                current["area"] = _assign(tree, current)
+                touched = np.unique(current["area"])
+            else:
+                inserted, deleted, changed = diff(previous, current)
+                moved = inserted.union(changed)
+                area = previous["area"].reindex(current.index)
+                area[moved] = _assign(tree, current.loc[moved])
+                current["area"] = area.astype(np.int64)
+                touched = np.union1d(
+                    previous.loc[deleted.union(changed), "area"],
+                    current.loc[moved, "area"],
+                )
+            touched = touched[touched >= 0]
+
+            kept = current[_keep(current, filter_i)]
+            groups = kept.groupby("area").indices
+            for i in touched:
+                group = kept.iloc[groups.get(i, [])]
+                values[i] = _entropies(group)
+                counts[i] = len(group)
+
+            recomputed = np.zeros(len(areas), dtype=bool)
+            recomputed[touched] = True
+            frame = pd.DataFrame(values.copy(), columns=ENTROPY_TYPES)
+            frame.insert(0, "amenities", counts.copy())
+            frame.insert(0, code_col, codes)
+            frame.insert(0, "snapshot", name)
+            frame["recomputed"] = recomputed
+            frames.append(frame)
+            previous = current
+
+        return pd.concat(frames, ignore_index=True)
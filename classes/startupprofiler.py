@@ -0,0 +1,84 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+
+class StartupProfiler:
+    """Keeps track of the time spent in each phase of the startup of the dashboard
+
+    Phases are either marked one after another with mark, or timed with the phase
+    context manager, which may also be used from several threads at once.
+    """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.phases = {}
+        self.ready = None
+        self.first_request = None
+        self._last = self.start
+        self._lock = threading.Lock()
+
+    def mark(self, name):
+        """This function is used to record the time since the previous mark (or the start) as a phase"""
+
+        now = time.perf_counter()
+        with self._lock:
+            self.phases[name] = now - self._last
+            self._last = now
+
+    @contextmanager
+    def phase(self, name):
+        """This function is used to time a block of code as a phase"""
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.phases[name] = time.perf_counter() - start
+
+    def set_ready(self):
+        self.ready = time.perf_counter() - self.start
+
+    def request_started(self):
+        """This function is used to record the time to the first request, meant for Flask's before_request"""
+
+        if self.first_request is None:
+            self.first_request = time.perf_counter() - self.start
+            print(f"First request {self.first_request:.2f}s after startup")
+
+    def report(self):
+        """This function is used to print the time spent in each phase"""
+
+        print("Startup profile:")
+        for name, seconds in self.phases.items():
+            print(f"  {name:<30} {seconds:>7.2f}s")
+        if self.ready is not None:
+            print(f"  {'ready to serve':<30} {self.ready:>7.2f}s")
+
+
+def load_parallel(tasks, profiler=None, max_workers=None):
+    """This function is used to run independent loading tasks concurrently in a thread pool
+
+    Reading parquet files (pyarrow) and most shapely operations release the GIL, so the
+    datasets load side by side.
+
+    Args:
+        tasks (dict): the name and function without arguments of every task
+        profiler (StartupProfiler, optional): records the duration of every task as a phase
+        max_workers (int, optional): the number of threads, defaults to the number of tasks
+
+    Returns:
+        dict: the result of every task by name
+    """
+
+    def run(name):
+        if profiler is None:
+            return tasks[name]()
+        with profiler.phase(f"load {name}"):
+            return tasks[name]()
+
+    with ThreadPoolExecutor(max_workers=max_workers or len(tasks)) as executor:
+        futures = {name: executor.submit(run, name) for name in tasks}
+        return {name: future.result() for name, future in futures.items()}
@@ -0,0 +1,197 @@
+import threading
+from collections import OrderedDict
+
+from cachelib import SimpleCache
+
+# all caches by name, so their statistics can be reported together
+CACHES = {}
+
+
+class StatsCache:
+    """Bounded server-side cache that keeps track of its hit rate"""
+
+    def __init__(self, name, threshold=1000, timeout=0):
+        self.name = name
+        self.cache = SimpleCache(threshold=threshold, default_timeout=timeout)
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        CACHES[name] = self
+
+    def get(self, key):
+        """This function is used to get a value from the cache, None on a miss"""
+
+        value = self.cache.get(key)
+        with self._lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value
+
+    def set(self, key, value):
+        self.cache.set(key, value)
+
+    def get_or_build(self, key, build):
+        """This function is used to get a value from the cache, building and storing it on a miss
+
+        Args:
+            key (str): the cache key, e.g. the area code
+            build (callable): function without arguments that builds the value
+        """
+
+        value = self.get(key)
+        if value is None:
+            value = build()
+            self.set(key, value)
+        return value
+
+    def clear(self):
+        self.cache.clear()
+        with self._lock:
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            requests = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / requests if requests else 0.0,
+            }
+
+
+class LRUBytesCache:
+    """Least recently used cache bounded by the total size of its values, keeping track of its hit rate
+
+    The values are kept as they are, so this suits immutable values such as bytes.
+    """
+
+    def __init__(self, name, max_bytes=64 * 1024**2, sizeof=len):
+        """
+        Args:
+            name (str): the name of the cache
+            max_bytes (int): the maximum total size of the cached values
+            sizeof (callable): function that returns the size of a value in bytes
+        """
+
+        self.name = name
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.cache = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        CACHES[name] = self
+
+    def get_or_build(self, key, build):
+        """This function is used to get a value from the cache, building and storing it on a miss
+
+        Args:
+            key (str): the cache key
+            build (callable): function without arguments that builds the value
+        """
+
+        with self._lock:
+            if key in self.cache:
+                self.hits += 1
+                self.cache.move_to_end(key)
+                return self.cache[key]
+            self.misses += 1
+
+        value = build()
+        size = self.sizeof(value)
+        with self._lock:
+            if key not in self.cache and size <= self.max_bytes:
+                self.cache[key] = value
+                self.nbytes += size
+                while self.nbytes > self.max_bytes:
+                    _, oldest = self.cache.popitem(last=False)
+                    self.nbytes -= self.sizeof(oldest)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self.cache.clear()
+            self.nbytes = 0
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            requests = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / requests if requests else 0.0,
+                "bytes": self.nbytes,
+            }
+
+
+class LRUCache:
+    """Least recently used cache bounded by the number of its values, keeping track of its hit rate
+
+    The values are kept as they are, for objects whose size is not known up front.
+    """
+
+    def __init__(self, name, max_items=8):
+        """
+        Args:
+            name (str): the name of the cache
+            max_items (int): the maximum number of cached values
+        """
+
+        self.name = name
+        self.max_items = max_items
+        self.cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        CACHES[name] = self
+
+    def get_or_build(self, key, build):
+        """This function is used to get a value from the cache, building and storing it on a miss
+
+        Args:
+            key (str): the cache key
+            build (callable): function without arguments that builds the value
+        """
+
+        with self._lock:
+            if key in self.cache:
+                self.hits += 1
+                self.cache.move_to_end(key)
+                return self.cache[key]
+            self.misses += 1
+
+        value = build()
+        with self._lock:
+            if self.max_items > 0 and key not in self.cache:
+                self.cache[key] = value
+                while len(self.cache) > self.max_items:
+                    self.cache.popitem(last=False)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self.cache.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            requests = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / requests if requests else 0.0,
+                "items": len(self.cache),
+            }
+
+
+def all_stats():
+    """This function is used to get the statistics of all caches by name"""
+
+    return {name: cache.stats() for name, cache in CACHES.items()}
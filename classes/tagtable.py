@@ -0,0 +1,248 @@
+import glob
+import os
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from .amenitypoints import AMENITY_FOLDER
+
+# ------- CONSTANTS -------#
+
+TAGS = "tags"
+MAP_TYPE = pa.map_(pa.string(), pa.string())
+
+
+class TagTable:
+    """The OSM tags of a set of amenities as interned key and value codes
+
+    The tags of amenity i are the entries offsets[i] to offsets[i + 1], every entry a
+    code into the key names and a code into the value names. Only the tags an amenity
+    has are stored, each key and value string once, instead of a dict per amenity (or,
+    read from a struct column, a dict with every key of the file). Looking up tags is
+    then a vectorised operation over the entries.
+    """
+
+    def __init__(self, offsets, keys, values, key_names, value_names):
+        """
+        Args:
+            offsets (array): the first entry of every amenity, and the number of entries
+            keys (array): the key code of every entry
+            values (array): the value code of every entry
+            key_names (array): the key strings
+            value_names (array): the value strings
+        """
+
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.keys = np.asarray(keys, dtype=np.int32)
+        self.values = np.asarray(values, dtype=np.int32)
+        self.key_names = np.asarray(key_names, dtype=object)
+        self.value_names = np.asarray(value_names, dtype=object)
+
+    @classmethod
+    def _from_entries(cls, rows, keys, values, n):
+        # entries in any order, with the amenity of every entry
+        order = np.argsort(rows, kind="stable")
+        key_codes, key_names = pd.factorize(np.asarray(keys, dtype=object)[order])
+        value_codes, value_names = pd.factorize(np.asarray(values, dtype=object)[order])
+        offsets = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=n), out=offsets[1:])
+        return cls(offsets, key_codes, value_codes, key_names, value_names)
+
+    @classmethod
+    def from_dicts(cls, tags):
+        """This function is used to intern the tags of the API, a dict (or (key, value) pairs) per amenity
+
+        Tags without a value are left out.
+        """
+
+        rows, keys, values = [], [], []
+        for row, amenity_tags in enumerate(tags):
+            # a map column is read as a list of (key, value) pairs
+            if isinstance(amenity_tags, dict):
+                amenity_tags = amenity_tags.items()
+            elif not isinstance(amenity_tags, (list, tuple, np.ndarray)):
+                continue
+            for key, value in amenity_tags:
+                if value is not None:
+                    rows.append(row)
+                    keys.append(key)
+                    values.append(value)
+        rows = np.asarray(rows, dtype=np.int64)
+        return cls._from_entries(rows, keys, values, len(tags))
+
+    @classmethod
+    def from_arrow(cls, array):
+        """This function is used to intern a struct or map column of tags, without a dict per amenity"""
+
+        if isinstance(array, pa.ChunkedArray):
+            array = array.combine_chunks()
+        n = len(array)
+        if pa.types.is_map(array.type):
+            # the offsets point into the keys and items of all maps, a missing map
+            # has no entries
+            offsets = array.offsets.to_numpy()
+            counts = np.diff(offsets)
+            if array.null_count:
+                counts[~array.is_valid().to_numpy(zero_copy_only=False)] = 0
+            rows = np.repeat(np.arange(n), counts)
+            starts = np.repeat(offsets[:-1] - np.cumsum(counts) + counts, counts)
+            entries = starts + np.arange(len(rows))
+            keys = array.keys.to_numpy(zero_copy_only=False)[entries]
+            values = array.items.to_numpy(zero_copy_only=False)[entries]
+            valid = ~pd.isna(values)
+            return cls._from_entries(rows[valid], keys[valid], values[valid], n)
+
+        assert pa.types.is_struct(array.type), "Tags must be a struct or map column"
+        rows, keys, values = [], [], []
+        # a field per key, flatten takes the missing amenities into account
+        for field, column in zip(array.type, array.flatten()):
+            valid = np.flatnonzero(column.is_valid().to_numpy(zero_copy_only=False))
+            if len(valid) == 0:
+                continue
+            rows.append(valid)
+            keys.append(np.full(len(valid), field.name, dtype=object))
+            column = column.cast(pa.string()).take(valid)
+            values.append(column.to_numpy(zero_copy_only=False))
+        if not rows:
+            return cls._from_entries(np.zeros(0, dtype=np.int64), [], [], n)
+        return cls._from_entries(
+            np.concatenate(rows), np.concatenate(keys), np.concatenate(values), n
+        )
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    @property
+    def nbytes(self):
+        strings = sum(len(s) for s in self.key_names) + sum(
+            len(s) for s in self.value_names
+        )
+        return self.offsets.nbytes + self.keys.nbytes + self.values.nbytes + strings
+
+    def counts(self):
+        """This function is used to get the number of tags of every amenity"""
+
+        return np.diff(self.offsets)
+
+    def rows(self):
+        """This function is used to get the amenity of every entry"""
+
+        return np.repeat(np.arange(len(self)), self.counts())
+
+    def _key_codes(self, keys):
+        # the code of every key, -1 for keys that no amenity has
+        lookup = {name: code for code, name in enumerate(self.key_names)}
+        return np.array([lookup.get(key, -1) for key in keys], dtype=np.int64)
+
+    def get(self, key):
+        """This function is used to get the value of a tag of every amenity, None where it is missing"""
+
+        result = np.full(len(self), None, dtype=object)
+        code = self._key_codes([key])[0]
+        if code >= 0:
+            entries = np.flatnonzero(self.keys == code)
+            result[self.rows()[entries]] = self.value_names[self.values[entries]]
+        return result
+
+    def first(self, keys):
+        """This function is used to find the first of keys every amenity has, and its value
+
+        Args:
+            keys (list): the keys, in order of preference
+
+        Returns:
+            tuple: the key and the value of every amenity, None where it has none of keys
+        """
+
+        rank = np.full(len(self.key_names) + 1, len(keys), dtype=np.int64)
+        codes = self._key_codes(keys)
+        # a key listed twice keeps its first rank
+        for position, code in reversed(list(enumerate(codes))):
+            if code >= 0:
+                rank[code] = position
+        entry_rank = rank[self.keys]
+
+        key_result = np.full(len(self), None, dtype=object)
+        value_result = np.full(len(self), None, dtype=object)
+        rows = self.rows()
+        # the best ranked entry of every amenity comes first
+        order = np.lexsort((entry_rank, rows))
+        nonempty = np.flatnonzero(self.counts() > 0)
+        best = order[self.offsets[nonempty]]
+        found = entry_rank[best] < len(keys)
+        rows, best = nonempty[found], best[found]
+        key_result[rows] = np.asarray(keys, dtype=object)[entry_rank[best]]
+        value_result[rows] = self.value_names[self.values[best]]
+        return key_result, value_result
+
+    def take(self, indices):
+        """This function is used to get the tags of some amenities, in the given order"""
+
+        indices = np.asarray(indices, dtype=np.int64)
+        counts = self.counts()[indices]
+        offsets = np.zeros(len(indices) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        # the entries of every amenity, amenity after amenity
+        starts = np.repeat(self.offsets[indices] - offsets[:-1], counts)
+        entries = starts + np.arange(offsets[-1])
+        return TagTable(
+            offsets,
+            self.keys[entries],
+            self.values[entries],
+            self.key_names,
+            self.value_names,
+        )
+
+    def to_arrow(self):
+        """This function is used to get the tags as an Arrow map column, to store them"""
+
+        keys = pa.array(self.key_names[self.keys], type=pa.string())
+        values = pa.array(self.value_names[self.values], type=pa.string())
+        return pa.MapArray.from_arrays(
+            pa.array(self.offsets, type=pa.int32()), keys, values
+        )
+
+    def to_dicts(self):
+        """This function is used to get a dict of tags per amenity, like the API returns them"""
+
+        keys = self.key_names[self.keys]
+        values = self.value_names[self.values]
+        return [
+            dict(zip(keys[lo:hi], values[lo:hi]))
+            for lo, hi in zip(self.offsets[:-1], self.offsets[1:])
+        ]
+
+
+def read_tags(path):
+    """This function is used to read the tags of an amenity file, without a dict per amenity"""
+
+    return TagTable.from_arrow(pq.read_table(path, columns=[TAGS]).column(TAGS))
+
+
+def compact_amenity_files(folder=AMENITY_FOLDER):
+    """This function is used to rewrite the tags of the amenity files as Arrow maps
+
+    A struct column has a field for every key in the file, a map only the tags an
+    amenity has. Files that already have a map are left as they are.
+
+    Returns:
+        tuple: the total size of the files before and after, in bytes
+    """
+
+    before = after = 0
+    for file in sorted(glob.glob(os.path.join(folder, "amenities_*.parquet"))):
+        size = os.path.getsize(file)
+        before += size
+        table = pq.read_table(file)
+        i = table.schema.get_field_index(TAGS)
+        if i < 0 or pa.types.is_map(table.schema.field(i).type):
+            after += size
+            continue
+        tags = TagTable.from_arrow(table.column(i)).to_arrow()
+        table = table.set_column(i, pa.field(TAGS, MAP_TYPE), tags)
+        pq.write_table(table, file)
+        after += os.path.getsize(file)
+    print(f"Amenity files: {before / 1024**2:.1f} MB -> {after / 1024**2:.1f} MB")
+    return before, after
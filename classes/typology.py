@@ -0,0 +1,278 @@
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+from scipy.cluster.hierarchy import fcluster, linkage
+
+from .metrics import timed
+
+# ------- CONSTANTS -------#
+
+STATS_FILES = {
+    "gemeenten": ("data/gemeenten/gemeenten_stats.parquet", "gemeentecode"),
+    "wijken": ("data/wijken/wijken_stats_lisa.parquet", "wijkcode"),
+    "buurten": ("data/buurten/buurten_stats.parquet", "buurtcode"),
+}
+
+# entropy and demographic profile of an area, the first four are the featurelist of
+# the similar neighbourhoods in the dashboard
+FEATURES = [
+    "L0_altieri_1_T_norm",
+    "L0_altieri_1_T_Is_norm",
+    "L1_altieri_1_T_norm",
+    "L1_altieri_1_T_Is_norm",
+    "L0_shannon_1_T_norm",
+    "L1_shannon_1_T_norm",
+    "P_00_14_JR",
+    "P_15_24_JR",
+    "P_25_44_JR",
+    "P_45_64_JR",
+    "P_65_EO_JR",
+    "P_GEBNL_NL_PC",
+    "P_GEBNL_EU_PC",
+    "P_GEBNL_NE_PC",
+    "P_GEBBL_EU_PC",
+    "P_GEBBL_NE_PC",
+]
+METHODS = ["kmeans", "ward"]
+# the cluster labels are written back to the stats as typology_<method>_<k>
+COLUMN_PREFIX = "typology_"
+
+SEED = 12345
+# memory budget of one block of pairwise distances, in bytes
+BLOCK_BYTES = 64 * 1024**2
+# ward clustering runs on this many k-means clusters of the areas
+MICRO_CLUSTERS = 256
+
+
+def feature_matrix(stats, columns=FEATURES):
+    """This function is used to get the standardised features of the areas as float32
+
+    Missing values get the mean of their column, so they do not pull an area to any
+    cluster.
+    """
+
+    X = stats[columns].to_numpy(dtype=np.float64)
+    mean = np.nanmean(X, axis=0)
+    X = np.where(np.isnan(X), mean, X)
+    std = X.std(axis=0)
+    return ((X - mean) / np.where(std > 0, std, 1)).astype(np.float32)
+
+
+def pairwise_blocks(X, Y=None, squared=False, max_bytes=BLOCK_BYTES):
+    """This function is used to compute the euclidean distances between two sets of rows in blocks
+
+    Only one block of rows of X against all rows of Y is in memory at a time.
+
+    Args:
+        X (array): n x features
+        Y (array, optional): m x features, X by default
+        squared (bool): return squared distances
+        max_bytes (int): memory budget of one block
+
+    Yields:
+        tuple: the first row of the block and its float32 distances, rows x m
+    """
+
+    X = np.asarray(X, dtype=np.float32)
+    Y = X if Y is None else np.asarray(Y, dtype=np.float32)
+    yy = (Y * Y).sum(axis=1)
+    # the product and the distances are in memory at the same time
+    rows = max(1, max_bytes // (len(Y) * 4 * 2))
+    for start in range(0, len(X), rows):
+        block = X[start : start + rows]
+        d2 = (block * block).sum(axis=1)[:, None] + yy[None, :] - 2 * (block @ Y.T)
+        np.maximum(d2, 0, out=d2)
+        yield start, d2 if squared else np.sqrt(d2, out=d2)
+
+
+def nearest(X, k=5, max_bytes=BLOCK_BYTES):
+    """This function is used to find the k most similar areas of every area
+
+    Returns:
+        tuple: the indices and the distances of the neighbours, n x k, nearest first
+    """
+
+    n = len(X)
+    k = min(k, n - 1)
+    indices = np.zeros((n, k), dtype=np.int64)
+    distances = np.zeros((n, k), dtype=np.float32)
+    for start, block in pairwise_blocks(X, max_bytes=max_bytes):
+        rows = np.arange(len(block))
+        block[rows, start + rows] = np.inf
+        part = np.argpartition(block, k - 1, axis=1)[:, :k]
+        order = np.argsort(block[rows[:, None], part], axis=1, kind="stable")
+        part = part[rows[:, None], order]
+        indices[start : start + len(block)] = part
+        distances[start : start + len(block)] = block[rows[:, None], part]
+    return indices, distances
+
+
+def _assign(X, centres, max_bytes):
+    labels = np.zeros(len(X), dtype=np.int64)
+    d2 = np.zeros(len(X), dtype=np.float64)
+    for start, block in pairwise_blocks(X, centres, squared=True, max_bytes=max_bytes):
+        labels[start : start + len(block)] = block.argmin(axis=1)
+        d2[start : start + len(block)] = block.min(axis=1)
+    return labels, d2
+
+
+def _kmeans_plusplus(X, k, rng, max_bytes):
+    centres = [X[rng.integers(len(X))]]
+    d2 = _assign(X, np.array(centres), max_bytes)[1]
+    for _ in range(1, k):
+        p = d2 / d2.sum() if d2.sum() > 0 else None
+        centres.append(X[rng.choice(len(X), p=p)])
+        d2 = np.minimum(d2, _assign(X, centres[-1][None, :], max_bytes)[1])
+    return np.array(centres)
+
+
+def kmeans(
+    X, k, seed=SEED, n_init=4, max_iter=100, tol=1e-6, max_bytes=BLOCK_BYTES
+):
+    """This function is used to cluster the rows of X with k-means (k-means++ initialisation)
+
+    The assignment step computes the distances to the centres in blocks, so memory
+    stays at one block.
+
+    Returns:
+        tuple: the cluster of every row, the centres and the sum of squared distances
+    """
+
+    assert 1 <= k <= len(X), "k must be between 1 and the number of areas"
+    X = np.asarray(X, dtype=np.float32)
+    rng = np.random.default_rng(seed)
+    best = None
+    for _ in range(n_init):
+        centres = _kmeans_plusplus(X, k, rng, max_bytes)
+        for _ in range(max_iter):
+            labels, d2 = _assign(X, centres, max_bytes)
+            counts = np.bincount(labels, minlength=k)
+            sums = np.stack(
+                [np.bincount(labels, weights=col, minlength=k) for col in X.T], axis=1
+            )
+            new = sums / np.maximum(counts, 1)[:, None]
+            # an empty cluster restarts at the row furthest from its centre
+            for c in np.flatnonzero(counts == 0):
+                far = np.argmax(d2)
+                new[c], d2[far] = X[far], 0
+            shift = ((new - centres) ** 2).sum()
+            centres = new.astype(np.float32)
+            if shift <= tol:
+                break
+        labels, d2 = _assign(X, centres, max_bytes)
+        if best is None or d2.sum() < best[2]:
+            best = (labels, centres, d2.sum())
+    return best
+
+
+def ward(X, k, seed=SEED, micro_clusters=MICRO_CLUSTERS, max_bytes=BLOCK_BYTES):
+    """This function is used to cluster the rows of X hierarchically (Ward linkage)
+
+    A full linkage needs all n^2 / 2 distances at once, so above micro_clusters rows
+    the areas are first grouped with k-means and the linkage is built on the centres
+    of those groups.
+
+    Returns:
+        array: the cluster of every row
+    """
+
+    X = np.asarray(X, dtype=np.float32)
+    if len(X) <= micro_clusters:
+        micro, centres = np.arange(len(X)), X
+    else:
+        micro, centres, _ = kmeans(
+            X, micro_clusters, seed=seed, n_init=1, max_bytes=max_bytes
+        )
+    tree = linkage(centres.astype(np.float64), method="ward")
+    return fcluster(tree, k, criterion="maxclust")[micro] - 1
+
+
+def silhouette(X, labels, max_bytes=BLOCK_BYTES):
+    """This function is used to compute the mean silhouette of a clustering from blocked all-pairs distances"""
+
+    labels = np.asarray(labels)
+    k = labels.max() + 1
+    counts = np.bincount(labels, minlength=k)
+    onehot = np.zeros((len(labels), k), dtype=np.float32)
+    onehot[np.arange(len(labels)), labels] = 1
+    scores = np.zeros(len(labels))
+    for start, block in pairwise_blocks(X, max_bytes=max_bytes):
+        own = labels[start : start + len(block)]
+        mean = (block @ onehot).astype(np.float64)
+        rows = np.arange(len(block))
+        # the distance to itself is 0, so the own mean leaves one area out
+        a = mean[rows, own] / np.maximum(counts[own] - 1, 1)
+        mean = mean / np.maximum(counts, 1)
+        mean[rows, own] = np.inf
+        mean[:, counts == 0] = np.inf
+        b = mean.min(axis=1)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            s = np.where(counts[own] > 1, (b - a) / np.maximum(a, b), 0.0)
+        scores[start : start + len(block)] = s
+    return float(scores.mean())
+
+
+def cluster_areas(stats, k, columns=FEATURES, method="kmeans", seed=SEED, score=False):
+    """This function is used to cluster areas into typologies of similar entropy and demographics
+
+    Args:
+        stats (DataFrame): the stats of the areas
+        k (int): the number of clusters
+        columns (list): the feature columns
+        method (str): "kmeans" or "ward"
+        score (bool): compute the mean silhouette of the clustering, an all-pairs pass
+            that costs more than k-means itself
+
+    Returns:
+        Series: the typology of every area, named typology_<method>_<k>, the largest
+            cluster is 0, with the silhouette in its attrs when scored
+    """
+
+    assert method in METHODS, f"Method must be one of {METHODS}"
+    X = feature_matrix(stats, columns)
+    if method == "kmeans":
+        labels = kmeans(X, k, seed=seed)[0]
+    else:
+        labels = ward(X, k, seed=seed)
+
+    # number the clusters by size, so the labels do not depend on the initialisation
+    sizes = np.bincount(labels, minlength=k)
+    rank = np.empty(k, dtype=np.int64)
+    rank[np.argsort(-sizes, kind="stable")] = np.arange(k)
+    labels = rank[labels]
+    typology = pd.Series(labels, index=stats.index, name=f"{COLUMN_PREFIX}{method}_{k}")
+    if score:
+        typology.attrs["silhouette"] = silhouette(X, labels)
+    return typology
+
+
+@timed
+def build_typology(
+    areatype, k, columns=FEATURES, method="kmeans", seed=SEED, score=False
+):
+    """This function is used to cluster the areas of an area type and write the typology back to its stats
+
+    The dashboard colours wijken and buurten by the typology_* columns of their stats.
+
+    Args:
+        areatype (str): "gemeenten", "wijken" or "buurten"
+        k (int): the number of clusters
+        columns (list): the feature columns
+        method (str): "kmeans" or "ward"
+        score (bool): report the mean silhouette of the clustering
+
+    Returns:
+        Series: the typology of every area, by area code
+    """
+
+    assert areatype in STATS_FILES, f"Area type must be one of {list(STATS_FILES)}"
+    path, code_col = STATS_FILES[areatype]
+    stats = gpd.read_parquet(path)
+    labels = cluster_areas(
+        stats, k, columns=columns, method=method, seed=seed, score=score
+    )
+    if score:
+        print(f"{method} k={k}: silhouette {labels.attrs['silhouette']:.3f}")
+    stats[labels.name] = labels
+    stats.to_parquet(path)
+    return labels.set_axis(stats[code_col])
@@ -0,0 +1,85 @@
+import json
+import math
+
+import shapely
+
+from .statscache import StatsCache
+
+EMPTY = {"type": "FeatureCollection", "features": []}
+
+
+class ViewportLayer:
+    """Serves the features of a GeoDataFrame that intersect the current map viewport
+
+    The geometries are indexed once with an STRtree and every feature is serialised
+    to GeoJSON the first time it is served, so a bbox query mostly only selects
+    features. The viewport is snapped outwards to a grid, so small pans hit the cache.
+    """
+
+    def __init__(self, name, gdf, min_zoom=12, grid_size=0.02, threshold=256):
+        """
+        Args:
+            name (str): the name of the layer, also used for its cache
+            gdf (GeoDataFrame): the features of the layer, in EPSG:4326
+            min_zoom (int): below this zoom level no features are served
+            grid_size (float): the size in degrees of the grid the viewport is snapped to
+            threshold (int): the maximum number of cached viewports
+        """
+
+        self.name = name
+        self.min_zoom = min_zoom
+        self.grid_size = grid_size
+        self.tree = shapely.STRtree(gdf.geometry.values)
+        self.gdf = gdf
+        # serialised features by index, filled on demand so startup stays cheap
+        self.features = {}
+        self.cache = StatsCache(f"{name}_viewports", threshold=threshold)
+
+    def _snap(self, bounds):
+        minx, miny, maxx, maxy = bounds
+        return (
+            math.floor(minx / self.grid_size),
+            math.floor(miny / self.grid_size),
+            math.ceil(maxx / self.grid_size),
+            math.ceil(maxy / self.grid_size),
+        )
+
+    def _intersecting(self, cell_bounds):
+        bbox = shapely.box(*[i * self.grid_size for i in cell_bounds])
+        indices = self.tree.query(bbox, predicate="intersects")
+        indices.sort()
+        return indices
+
+    def _serialise(self, indices):
+        missing = [i for i in indices if i not in self.features]
+        if missing:
+            features = json.loads(self.gdf.iloc[missing].to_json(drop_id=True))["features"]
+            self.features.update(zip(missing, features))
+
+    def query(self, bounds, zoom):
+        """This function is used to get the features within the bounds as a FeatureCollection
+
+        Args:
+            bounds (tuple): minx, miny, maxx, maxy of the viewport
+            zoom (int): the zoom level of the map
+        """
+
+        if zoom is None or zoom < self.min_zoom:
+            return EMPTY
+
+        cell_bounds = self._snap(bounds)
+        key = "_".join(str(i) for i in cell_bounds)
+        # only the indices are cached, the features themselves are shared
+        indices = self.cache.get_or_build(key, lambda: self._intersecting(cell_bounds))
+        self._serialise(indices)
+        return {
+            "type": "FeatureCollection",
+            "features": [self.features[i] for i in indices],
+        }
+
+
+def leaflet_bounds(bounds):
+    """This function is used to convert dash-leaflet map bounds [[south, west], [north, east]] to minx, miny, maxx, maxy"""
+
+    (south, west), (north, east) = bounds
+    return west, south, east, north
@@ -0,0 +1,233 @@
+import copy
+
+import numpy as np
+
+# ------- CONSTANTS -------#
+
+LEVELS = ["L0", "L1"]
+# the default cut-off distance of leibovici_entropy
+LEIBOVICI_DISTANCE = 10
+# the number of point pairs counted at once when the counters are (re)built
+CHUNK_PAIRS = 4 * 1024**2
+
+
+def _entropy_terms(counts):
+    # -sum(p log p) of a count array, 0 when it is empty
+    total = counts.sum()
+    if total == 0:
+        return 0.0, None
+    probs = counts / total
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return -np.where(probs > 0, probs * np.log(probs), 0.0).sum(), probs
+
+
+class IncrementalEntropy:
+    """Shannon, Altieri and Leibovici entropy of a set of amenities that can be edited one amenity at a time
+
+    For both category levels the number of ordered pairs of amenities is kept per pair
+    of categories and per distance class of altieri_entropy (no distance, the first and
+    the second half of the diagonal of the bounding box), and within the cut-off
+    distance of leibovici_entropy. Adding or removing an amenity only needs its
+    distances to the other amenities, so it costs O(n) instead of the O(n^2) of a full
+    calculation. Only when the bounding box changes, the distance classes change and
+    the counters are rebuilt.
+
+    The entropies are the same as those of spatialentropy with the defaults used by
+    calculate_entropies.
+    """
+
+    def __init__(self, points, L0, L1, d=LEIBOVICI_DISTANCE, base=2):
+        """
+        Args:
+            points (array): the [x, y] of every amenity
+            L0 (array): the L0 category of every amenity
+            L1 (array): the L1 category of every amenity
+            d (float): the cut-off distance of the Leibovici entropy
+            base (float): the base of the logarithm
+        """
+
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        assert len(points) == len(L0) == len(L1), "Points and categories must have the same length"
+        self.d = d
+        self.base = base
+        self.x = points[:, 0].copy()
+        self.y = points[:, 1].copy()
+        self.alive = np.ones(len(points), dtype=bool)
+
+        self.categories = {}
+        self.codes = {}
+        for level, labels in zip(LEVELS, [L0, L1]):
+            self.categories[level], codes = np.unique(
+                np.asarray(labels).astype(str), return_inverse=True
+            )
+            self.categories[level] = list(self.categories[level])
+            self.codes[level] = codes.astype(np.int64)
+        self._rebuild()
+
+    # ----------- COUNTERS ------------#
+
+    def _bounds(self):
+        x, y = self.x[self.alive], self.y[self.alive]
+        if len(x) == 0:
+            return (0.0, 0.0, 0.0, 0.0)
+        return (x.min(), y.min(), x.max(), y.max())
+
+    def _classify(self, distance):
+        # 0 no distance, 1 and 2 the halves of the diagonal, like altieri_entropy
+        return np.searchsorted(self.breaks, distance, side="left")
+
+    def _add_pairs(self, level, a, b, classes, near, sign):
+        # every pair of amenities counts in both orders
+        n = len(self.categories[level])
+        pair = a * n + b
+        pairs = np.bincount(classes * n * n + pair, minlength=3 * n * n)
+        pairs = pairs.reshape(3, n, n)
+        self.pairs[level] += sign * (pairs + pairs.transpose(0, 2, 1))
+        near = np.bincount(pair[near], minlength=n * n).reshape(n, n)
+        self.near[level] += sign * (near + near.T)
+
+    def _rebuild(self):
+        self.bounds = self._bounds()
+        minx, miny, maxx, maxy = self.bounds
+        self.breaks = np.array([0, np.hypot(maxx - minx, maxy - miny) / 2])
+        self.pairs, self.near = {}, {}
+        for level in LEVELS:
+            n = len(self.categories[level])
+            self.pairs[level] = np.zeros((3, n, n), dtype=np.int64)
+            self.near[level] = np.zeros((n, n), dtype=np.int64)
+
+        alive = np.flatnonzero(self.alive)
+        chunk = max(1, CHUNK_PAIRS // max(len(alive), 1))
+        for start in range(0, len(alive), chunk):
+            rows = alive[start : start + chunk]
+            # every unordered pair once: the other amenity comes later in alive
+            r, c = np.triu_indices(len(rows), k=1, m=len(alive) - start)
+            i, j = rows[r], alive[start + c]
+            distance = np.hypot(self.x[i] - self.x[j], self.y[i] - self.y[j])
+            classes, near = self._classify(distance), distance <= self.d
+            for level in LEVELS:
+                codes = self.codes[level]
+                self._add_pairs(level, codes[i], codes[j], classes, near, 1)
+
+    def _update(self, index, sign):
+        others = np.flatnonzero(self.alive)
+        others = others[others != index]
+        distance = np.hypot(self.x[others] - self.x[index], self.y[others] - self.y[index])
+        classes, near = self._classify(distance), distance <= self.d
+        for level in LEVELS:
+            codes = self.codes[level]
+            a = np.full(len(others), codes[index])
+            self._add_pairs(level, a, codes[others], classes, near, sign)
+
+    def _code(self, level, category):
+        if category not in self.categories[level]:
+            # a new category, grow the counters
+            self.categories[level].append(category)
+            self.pairs[level] = np.pad(self.pairs[level], ((0, 0), (0, 1), (0, 1)))
+            self.near[level] = np.pad(self.near[level], ((0, 1), (0, 1)))
+        return self.categories[level].index(category)
+
+    # ----------- EDITS ------------#
+
+    def add(self, x, y, L0, L1):
+        """This function is used to add an amenity
+
+        Args:
+            x, y (float): the location, in the units of the points
+            L0, L1 (str): the categories of the amenity
+
+        Returns:
+            int: the id of the amenity, to remove it again
+        """
+
+        index = len(self.x)
+        self.x = np.append(self.x, x)
+        self.y = np.append(self.y, y)
+        self.alive = np.append(self.alive, True)
+        for level, category in zip(LEVELS, [L0, L1]):
+            self.codes[level] = np.append(self.codes[level], self._code(level, str(category)))
+
+        minx, miny, maxx, maxy = self.bounds
+        if self.alive.sum() == 1 or not (minx <= x <= maxx and miny <= y <= maxy):
+            self._rebuild()
+        else:
+            self._update(index, 1)
+        return index
+
+    def remove(self, index):
+        """This function is used to remove an amenity by its id"""
+
+        assert 0 <= index < len(self.alive) and self.alive[index], "Amenity does not exist"
+        self.alive[index] = False
+        if self._bounds() != self.bounds:
+            self._rebuild()
+        else:
+            self._update(index, -1)
+
+    def nearest(self, x, y, L0=None, L1=None):
+        """This function is used to find the id of the amenity nearest to a location, optionally of a category
+
+        Returns:
+            int: the id, None if there is no such amenity
+        """
+
+        candidates = self.alive.copy()
+        for level, category in zip(LEVELS, [L0, L1]):
+            if category is not None:
+                if category not in self.categories[level]:
+                    return None
+                candidates &= self.codes[level] == self.categories[level].index(category)
+        candidates = np.flatnonzero(candidates)
+        if len(candidates) == 0:
+            return None
+        distance = np.hypot(self.x[candidates] - x, self.y[candidates] - y)
+        return int(candidates[np.argmin(distance)])
+
+    def copy(self):
+        return copy.deepcopy(self)
+
+    # ----------- ENTROPIES ------------#
+
+    def __len__(self):
+        return int(self.alive.sum())
+
+    def shannon(self, level):
+        counts = np.bincount(
+            self.codes[level][self.alive], minlength=len(self.categories[level])
+        )
+        return _entropy_terms(counts)[0] / np.log(self.base)
+
+    def altieri(self, level):
+        # ordered pairs of categories, like altieri_entropy with order=True
+        pairs = self.pairs[level].reshape(3, -1)
+        _, pz = _entropy_terms(pairs[1] + pairs[2])
+        entropy = 0.0
+        for k in [1, 2]:
+            H, v = _entropy_terms(pairs[k])
+            if v is None:
+                continue
+            with np.errstate(divide="ignore", invalid="ignore"):
+                PI = np.where(v > 0, v * np.log(v / pz), 0.0).sum()
+            # the two halves of the diagonal have the same weight
+            entropy += (H + PI) / 2
+        return entropy / np.log(self.base)
+
+    def leibovici(self, level):
+        # unordered pairs of categories, like leibovici_entropy with order=False, which
+        # also counts every amenity as its own neighbour
+        near = self.near[level]
+        unordered = np.triu(near + near.T - np.diag(np.diag(near)))
+        own = np.bincount(
+            self.codes[level][self.alive], minlength=len(self.categories[level])
+        )
+        unordered += np.diag(own)
+        return _entropy_terms(unordered.ravel())[0] / np.log(self.base)
+
+    def entropies(self):
+        """This function is used to get all six entropies, named like the columns of the stats"""
+
+        values = {}
+        for measure in ["shannon", "altieri", "leibovici"]:
+            for level in LEVELS:
+                values[f"{level}_{measure}"] = float(getattr(self, measure)(level))
+        return values